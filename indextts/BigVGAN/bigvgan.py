@@ -371,9 +371,17 @@ class BigVGAN(
                 ch = h.upsample_initial_channel // (2 ** (i + 1))
                 self.conds.append(nn.Conv1d(h.speaker_embedding_dim, ch, 1))
 
-    def forward(self, x, mel_refer, lens=None):
+    def speaker_embedding(self, mel_refer, lens=None):
+        """
+        ECAPA-TDNN speaker embedding of the reference mel [B, num_mels, T], in shape [B, 1, speaker_embedding_dim].
+        It only depends on the reference audio, so it can be computed once and passed to `forward()`.
+        """
+        return self.speaker_encoder(mel_refer, lens)
+
+    def forward(self, x, mel_refer=None, lens=None, speaker_embedding=None):
         # Speaker reference
-        speaker_embedding = self.speaker_encoder(mel_refer, lens)
+        if speaker_embedding is None:
+            speaker_embedding = self.speaker_embedding(mel_refer, lens)
         n_batch = x.size(0)
         contrastive_loss = None
         if n_batch * 2 == speaker_embedding.size(0):
@@ -198,8 +198,16 @@ class BigVGAN(torch.nn.Module):
 
         # self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
 
-    def forward(self, x, mel_ref, lens=None):
-        speaker_embedding = self.speaker_encoder(mel_ref, lens)
+    def speaker_embedding(self, mel_ref, lens=None):
+        """
+        ECAPA-TDNN speaker embedding of the reference mel [B, num_mels, T], in shape [B, 1, speaker_embedding_dim].
+        It only depends on the reference audio, so it can be computed once and passed to `forward()`.
+        """
+        return self.speaker_encoder(mel_ref, lens)
+
+    def forward(self, x, mel_ref=None, lens=None, speaker_embedding=None):
+        if speaker_embedding is None:
+            speaker_embedding = self.speaker_embedding(mel_ref, lens)
         n_batch = x.size(0)
         contrastive_loss = None
         if n_batch * 2 == speaker_embedding.size(0):
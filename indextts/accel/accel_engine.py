@@ -1,5 +1,5 @@
 import sys
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 import torch
 from torch import nn
@@ -13,21 +13,91 @@ from .attention import (
 from .kv_manager import KVCacheManager, Seq
 
 
+def _apply_top_k(logits: torch.Tensor, top_ks: torch.Tensor) -> torch.Tensor:
+    # top_k <= 0 keeps the whole vocabulary
+    vocab_size = logits.size(-1)
+    top_ks = torch.where(top_ks > 0, top_ks, vocab_size).clamp(max=vocab_size)
+    sorted_logits = logits.sort(dim=-1, descending=True).values
+    kth_logits = sorted_logits.gather(-1, (top_ks - 1).unsqueeze(-1))
+    return logits.masked_fill(logits < kth_logits, -float("inf"))
+
+
+def _apply_top_p(logits: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    # same as transformers.TopPLogitsWarper, top_p >= 1 keeps the whole vocabulary
+    sorted_logits, sorted_indices = logits.sort(dim=-1)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    sorted_to_remove = cumulative_probs <= (1 - top_ps).unsqueeze(-1)
+    sorted_to_remove[:, -1] = False
+    to_remove = sorted_to_remove.scatter(-1, sorted_indices, sorted_to_remove)
+    return logits.masked_fill(to_remove, -float("inf"))
+
+
+def _apply_typical(logits: torch.Tensor, typical_masses: torch.Tensor) -> torch.Tensor:
+    # same as indextts.utils.typical_sampling.TypicalLogitsWarper, mass >= 1 keeps the whole vocabulary
+    normalized = torch.log_softmax(logits, dim=-1)
+    p = torch.exp(normalized)
+    ent = -(normalized * p).nansum(-1, keepdim=True)
+    shifted_scores = torch.abs((-normalized) - ent)
+    sorted_scores, sorted_indices = torch.sort(shifted_scores, descending=False)
+    sorted_logits = logits.gather(-1, sorted_indices)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    last_ind = (cumulative_probs < typical_masses.unsqueeze(-1)).sum(dim=-1).clamp(max=logits.size(-1) - 1)
+    sorted_to_remove = sorted_scores > sorted_scores.gather(-1, last_ind.unsqueeze(-1))
+    to_remove = sorted_to_remove.scatter(-1, sorted_indices, sorted_to_remove)
+    to_remove &= (typical_masses < 1).unsqueeze(-1)
+    return logits.masked_fill(to_remove, -float("inf"))
+
+
 class Sampler(nn.Module):
+    """
+    Batched logits processing and sampling with per-sequence parameters, in the order of HF `generate()`:
+    repetition penalty -> typical -> temperature -> top-k -> top-p.
+    Typical sampling is the custom `TypicalLogitsWarper` of `inference_speech()`, which HF runs with the
+    `logits_processor` argument, before its own temperature/top-k/top-p warpers.
+    The optional parameters are None when disabled for the whole batch, see `AccelInferenceEngine._prepare_sample()`.
+    """
+
     def __init__(self):
         super().__init__()
 
     @torch.compile
-    def forward(self, logits: torch.Tensor, temperatures: torch.Tensor):
-        temperatures = temperatures.to(logits.device).clamp(min=1e-8)
+    def forward(
+        self,
+        logits: torch.Tensor,
+        temperatures: torch.Tensor,
+        top_ks: Optional[torch.Tensor] = None,
+        top_ps: Optional[torch.Tensor] = None,
+        typical_masses: Optional[torch.Tensor] = None,
+        repetition_penalties: Optional[torch.Tensor] = None,
+        seen_tokens: Optional[torch.Tensor] = None,
+    ):
+        """
+        Args:
+            logits: [batch_size, vocab_size]
+            temperatures: [batch_size], the sequences with temperature <= 0 are decoded greedily
+            top_ks, top_ps, typical_masses, repetition_penalties: [batch_size]
+            seen_tokens: [batch_size, vocab_size] bool mask of the tokens to penalize
+        Returns:
+            sampled token IDs [batch_size]
+        """
+        logits = logits.float()
+        if repetition_penalties is not None and seen_tokens is not None:
+            penalties = repetition_penalties.unsqueeze(-1)
+            penalized = torch.where(logits < 0, logits * penalties, logits / penalties)
+            logits = torch.where(seen_tokens, penalized, logits)
         greedy_mask = temperatures < 1e-5
-        temp_for_scaling = torch.where(greedy_mask, 1.0, temperatures)
-        scaled_logits = logits / temp_for_scaling.unsqueeze(-1)
-        probs = torch.softmax(scaled_logits, dim=-1, dtype=torch.float32)
-        q = torch.empty_like(probs)
-        q.exponential_()
-        sampled_tokens = probs.div_(q).argmax(dim=-1)
         greedy_tokens = logits.argmax(dim=-1)
+        if typical_masses is not None:
+            logits = _apply_typical(logits, typical_masses)
+        logits = logits / torch.where(greedy_mask, 1.0, temperatures).unsqueeze(-1)
+        if top_ks is not None:
+            logits = _apply_top_k(logits, top_ks)
+        if top_ps is not None:
+            logits = _apply_top_p(logits, top_ps)
+        probs = torch.softmax(logits, dim=-1)
+        sampled_tokens = probs.div_(
+            torch.empty_like(probs).exponential_(1).clamp_min_(1e-10)
+        ).argmax(dim=-1)
         return torch.where(greedy_mask, greedy_tokens, sampled_tokens)
 
 
@@ -58,7 +128,11 @@ class AccelInferenceEngine:
         self.lm_head = lm_head
         self.block_size = block_size
         self.num_blocks = num_blocks
-        self.use_cuda_graph = use_cuda_graph and torch.cuda.is_available()
+        # CUDA: flash-attn + triton, otherwise the pure PyTorch paged attention
+        self.device = next(model.parameters()).device
+        self.use_cuda_graph = (
+            use_cuda_graph and torch.cuda.is_available() and self.device.type == "cuda"
+        )
         self.hidden_size = (
             model.config.hidden_size
             if hasattr(model, "config")
@@ -70,7 +144,11 @@ class AccelInferenceEngine:
             head_dim=head_dim,
             block_size=block_size,
             num_blocks=num_blocks,
-            dtype=torch.float16,  # Force fp16 for FlashAttention
+            # Force fp16 for FlashAttention, the model dtype for the PyTorch backend
+            dtype=torch.float16
+            if self.device.type == "cuda"
+            else next(model.parameters()).dtype,
+            device=self.device,
         )
         self.kv_manager.wire_kv_cache_to_model(model)
         self.sampler = Sampler()
@@ -80,6 +158,12 @@ class AccelInferenceEngine:
         self.graph_pool = None
         self.graph_captured = False
 
+    def _to_device(self, data, dtype: torch.dtype) -> torch.Tensor:
+        pin_memory = self.device.type == "cuda"
+        return torch.tensor(data, dtype=dtype, pin_memory=pin_memory).to(
+            self.device, non_blocking=pin_memory
+        )
+
     def _prepare_prefill(self, requests: List[Seq]):
         input_ids = []
         positions = []
@@ -111,21 +195,11 @@ class AccelInferenceEngine:
                     slot_idx = block_id * self.block_size + block_offset
                     slot_mapping.append(slot_idx)
 
-        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=True).cuda(
-            non_blocking=True
-        )
-        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=True).cuda(
-            non_blocking=True
-        )
-        cu_seqlens_q = torch.tensor(
-            cu_seqlens_q, dtype=torch.int32, pin_memory=True
-        ).cuda(non_blocking=True)
-        cu_seqlens_k = torch.tensor(
-            cu_seqlens_k, dtype=torch.int32, pin_memory=True
-        ).cuda(non_blocking=True)
-        slot_mapping = torch.tensor(
-            slot_mapping, dtype=torch.int32, pin_memory=True
-        ).cuda(non_blocking=True)
+        input_ids = self._to_device(input_ids, torch.int64)
+        positions = self._to_device(positions, torch.int64)
+        cu_seqlens_q = self._to_device(cu_seqlens_q, torch.int32)
+        cu_seqlens_k = self._to_device(cu_seqlens_k, torch.int32)
+        slot_mapping = self._to_device(slot_mapping, torch.int32)
 
         block_tables = None
         if cu_seqlens_k[-1] > cu_seqlens_q[-1]:
@@ -134,9 +208,7 @@ class AccelInferenceEngine:
             for req in requests:
                 table = req.block_table + [-1] * (max_len - len(req.block_table))
                 block_tables_list.append(table)
-            block_tables = torch.tensor(
-                block_tables_list, dtype=torch.int32, pin_memory=True
-            ).cuda(non_blocking=True)
+            block_tables = self._to_device(block_tables_list, torch.int32)
 
         set_forward_context(
             True,
@@ -151,7 +223,12 @@ class AccelInferenceEngine:
 
         return input_ids, positions
 
-    def _prepare_decode(self, requests: List[Seq]):
+    def _prepare_decode(self, requests: List[Seq], per_seq_positions: bool = False):
+        """
+        Args:
+            per_seq_positions: the mel positions start after the prompt of each sequence
+                instead of the (padded) prompt of the static batch, see `ContinuousBatchingScheduler`
+        """
         if not requests:
             raise RuntimeError("FATAL: No requests provided to _prepare_decode!")
 
@@ -164,7 +241,9 @@ class AccelInferenceEngine:
             input_ids.append(req.last_token)
 
             pos = len(req) - 1
-            if hasattr(self, "_tts_mode") and self._tts_mode:
+            if per_seq_positions:
+                pos = len(req) - req.num_prompt_tokens
+            elif hasattr(self, "_tts_mode") and self._tts_mode:
                 pos = pos - (self._tts_prompt_len - 1)
             positions.append(pos)
 
@@ -173,27 +252,17 @@ class AccelInferenceEngine:
                 req.block_table[-1] * self.block_size + req.last_block_num_tokens - 1
             )
 
-        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=True).cuda(
-            non_blocking=True
-        )
-        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=True).cuda(
-            non_blocking=True
-        )
-        slot_mapping = torch.tensor(
-            slot_mapping, dtype=torch.int32, pin_memory=True
-        ).cuda(non_blocking=True)
-        context_lens = torch.tensor(
-            context_lens, dtype=torch.int32, pin_memory=True
-        ).cuda(non_blocking=True)
+        input_ids = self._to_device(input_ids, torch.int64)
+        positions = self._to_device(positions, torch.int64)
+        slot_mapping = self._to_device(slot_mapping, torch.int32)
+        context_lens = self._to_device(context_lens, torch.int32)
 
         max_len = max(len(req.block_table) for req in requests)
         block_tables_list = []
         for req in requests:
             table = req.block_table + [-1] * (max_len - len(req.block_table))
             block_tables_list.append(table)
-        block_tables = torch.tensor(
-            block_tables_list, dtype=torch.int32, pin_memory=True
-        ).cuda(non_blocking=True)
+        block_tables = self._to_device(block_tables_list, torch.int32)
 
         assert block_tables.dim() == 2, (
             f"block_tables must be 2D, got shape {block_tables.shape}"
@@ -211,30 +280,54 @@ class AccelInferenceEngine:
 
         return input_ids, positions
 
-    def _prepare_sample(self, requests: List[Seq], temperature: float):
-        temperatures = [temperature] * len(requests)
-        temperatures = torch.tensor(
-            temperatures, dtype=torch.float32, pin_memory=True
-        ).cuda(non_blocking=True)
-        return temperatures
+    def _prepare_sample(
+        self,
+        requests: List[Seq],
+        temperature,
+        top_k=0,
+        top_p=1.0,
+        typical_mass=1.0,
+        repetition_penalty=1.0,
+    ) -> dict:
+        """
+        Each parameter is either shared by the batch or a list with one value per sequence.
+        Returns: the kwargs of `Sampler.forward()`, a parameter is None if disabled for all the sequences
+        """
+
+        def per_seq(value, dtype, disabled=None):
+            if not isinstance(value, (list, tuple)):
+                value = [value] * len(requests)
+            assert len(value) == len(requests), "one sampling parameter per sequence"
+            value = [disabled if v is None else v for v in value]
+            if disabled is not None and all(v == disabled for v in value):
+                return None
+            return self._to_device(value, dtype)
+
+        return dict(
+            temperatures=per_seq(temperature, torch.float32),
+            top_ks=per_seq(top_k, torch.int64, disabled=0),
+            top_ps=per_seq(top_p, torch.float32, disabled=1.0),
+            typical_masses=per_seq(typical_mass, torch.float32, disabled=1.0),
+            repetition_penalties=per_seq(repetition_penalty, torch.float32, disabled=1.0),
+        )
 
     def _capture_cuda_graphs(self, tts_mel_embedding=None, tts_text_pos_embedding=None):
         print("Capturing CUDA graphs for decode optimization...")
         max_bs = 8  # Support up to batch size 8
         max_num_blocks = (2048 + self.block_size - 1) // self.block_size
         model_dtype = next(self.model.parameters()).dtype
-        input_ids = torch.ones(max_bs, dtype=torch.int64, device="cuda")
-        positions = torch.ones(max_bs, dtype=torch.int64, device="cuda")
-        slot_mapping = torch.zeros(max_bs, dtype=torch.int32, device="cuda")
-        context_lens = torch.zeros(max_bs, dtype=torch.int32, device="cuda")
+        input_ids = torch.ones(max_bs, dtype=torch.int64, device=self.device)
+        positions = torch.ones(max_bs, dtype=torch.int64, device=self.device)
+        slot_mapping = torch.zeros(max_bs, dtype=torch.int32, device=self.device)
+        context_lens = torch.zeros(max_bs, dtype=torch.int32, device=self.device)
         block_tables = torch.zeros(
-            max_bs, max_num_blocks, dtype=torch.int32, device="cuda"
+            max_bs, max_num_blocks, dtype=torch.int32, device=self.device
         )
         outputs = torch.zeros(
-            max_bs, self.hidden_size, dtype=model_dtype, device="cuda"
+            max_bs, self.hidden_size, dtype=model_dtype, device=self.device
         )
         inputs_embeds_buffer = torch.zeros(
-            max_bs, self.hidden_size, dtype=model_dtype, device="cuda"
+            max_bs, self.hidden_size, dtype=model_dtype, device=self.device
         )
 
         self.graph_bs = [1, 2, 4, 8]
@@ -244,7 +337,7 @@ class AccelInferenceEngine:
         for bs in reversed(self.graph_bs):
             graph = torch.cuda.CUDAGraph()
 
-            slot_mapping[:bs] = torch.arange(bs, dtype=torch.int32, device="cuda")
+            slot_mapping[:bs] = torch.arange(bs, dtype=torch.int32, device=self.device)
             context_lens[:bs] = bs + 1
             block_tables[:bs, :] = 0
 
@@ -382,6 +475,8 @@ class AccelInferenceEngine:
         temperature: float = 1.0,
         top_k: int = 50,
         top_p: float = 1.0,
+        typical_mass: float = 1.0,
+        repetition_penalty: float = 1.0,
         stop_tokens: Optional[List[int]] = None,
         attention_mask: Optional[torch.Tensor] = None,
         tts_embeddings: Optional[
@@ -391,20 +486,35 @@ class AccelInferenceEngine:
         tts_text_pos_embedding: Optional[
             torch.nn.Module
         ] = None,  # TTS: text_pos_embedding layer
-    ) -> torch.Tensor:
+        return_hidden_states: bool = False,
+        prompt_token_ids: Optional[List[List[int]]] = None,
+        prefix_hash: Optional[bytes] = None,
+        stopping_criteria: Optional[Callable] = None,
+    ):
         """
         Generate tokens.
 
         Args:
             input_ids: Input token IDs [batch_size, seq_len]
             max_new_tokens: Maximum number of tokens to generate
-            temperature: Sampling temperature
-            top_k: Top-k sampling
+            temperature: Sampling temperature, <= 0 for greedy decoding
+            top_k: Top-k sampling, <= 0 to disable
             top_p: Nucleus sampling threshold
+            typical_mass: Typical sampling mass, >= 1 to disable
+            repetition_penalty: Penalty of the tokens in ``input_ids`` and the generated tokens, as HF `generate()`
+                (the sampling parameters are either shared by the batch or one value per sequence)
             stop_tokens: List of token IDs that stop generation
+            return_hidden_states: Also return the last hidden state (before lm_head) of each decode step
+            prompt_token_ids: TTS: the prefix cache keys of the prompt tokens of each sequence (without padding,
+                with the start_mel_token), instead of the dummy ids
+            prefix_hash: TTS: fingerprint of the conditioning embeddings which are not covered by ``prompt_token_ids``
+            stopping_criteria: HF `StoppingCriteriaList`, checked after each decode step with the tokens sampled
+                at this step [batch_size, 1] and the logits, the generation stops when it is true for all sequences
 
         Returns:
             Generated token IDs [batch_size, total_len]
+            and if return_hidden_states, the hidden states of each sequence [[num_generated, hidden_size]],
+            the i-th one is the hidden state which predicted the i-th generated token
         """
         batch_size = input_ids.size(0)
         device = input_ids.device
@@ -450,13 +560,21 @@ class AccelInferenceEngine:
         for i in range(batch_size):
             seq_len = seq_lens[i]
             token_ids = [1] * seq_len
-            if tts_embeddings is not None and seq_len > 0:
+            if tts_embeddings is not None and prompt_token_ids is not None:
+                token_ids = list(prompt_token_ids[i])
+                assert len(token_ids) == seq_len, (
+                    f"prompt_token_ids length mismatch: {len(token_ids)} vs {seq_len}"
+                )
+            elif tts_embeddings is not None and seq_len > 0:
                 token_ids[-1] = input_ids[i, -1].item() if input_ids.size(1) > 0 else 1
             else:
                 token_ids = input_ids[i].tolist()
-            req = Seq(token_ids)
+            req = Seq(token_ids, block_size=self.block_size, prefix_hash=prefix_hash)
             self.kv_manager.allocate(req)
             sequences.append(req)
+        # some prompt blocks are reused from the prefix cache, only the rest is prefilled
+        has_cached = any(req.num_cached_tokens > 0 for req in sequences)
+        is_packed = is_varlen_batch or has_cached
 
         self.current_sequences = sequences
 
@@ -470,17 +588,17 @@ class AccelInferenceEngine:
             start_token_id = input_ids[0, -1] if input_ids.size(1) > 0 else 8192
 
             start_emb = tts_mel_embedding(
-                torch.tensor([[start_token_id]], device="cuda")
+                torch.tensor([[start_token_id]], device=self.device)
             )  # [1, 1, hidden_dim]
 
             start_pos = torch.tensor(
-                [[tts_embeddings.size(1)]], device="cuda", dtype=torch.long
+                [[tts_embeddings.size(1)]], device=self.device, dtype=torch.long
             )
             pos_emb = tts_text_pos_embedding.emb(start_pos)
             start_emb = start_emb + pos_emb
             start_emb = start_emb.repeat(batch_size, 1, 1)
 
-            if is_varlen_batch:
+            if is_packed:
                 valid_embeddings = []
                 for i in range(batch_size):
                     emb_len = seq_lens[i] - 1
@@ -488,8 +606,9 @@ class AccelInferenceEngine:
                     valid_emb = tts_embeddings[i, padding_len:].unsqueeze(
                         0
                     )  # [1, emb_len, hidden_dim]
+                    full_emb = torch.cat([valid_emb, start_emb[i : i + 1]], dim=1)
                     valid_embeddings.append(
-                        torch.cat([valid_emb, start_emb[i : i + 1]], dim=1)
+                        full_emb[:, sequences[i].num_cached_tokens :]
                     )
                 full_embeddings = torch.cat(
                     valid_embeddings, dim=1
@@ -512,7 +631,7 @@ class AccelInferenceEngine:
                 input_ids=input_ids, attention_mask=attention_mask, return_dict=True
             ).last_hidden_state
 
-        if is_varlen_batch:
+        if is_packed:
             context = get_forward_context()
             cu_seqlens = context.cu_seqlens_q.cpu().tolist()
             last_hidden = torch.stack(
@@ -523,6 +642,8 @@ class AccelInferenceEngine:
 
         reset_forward_context()
 
+        step_hidden_states = [last_hidden] if return_hidden_states else None
+
         if self.lm_head is not None:
             if last_hidden.dtype != next(self.lm_head.parameters()).dtype:
                 last_hidden = last_hidden.to(next(self.lm_head.parameters()).dtype)
@@ -530,11 +651,20 @@ class AccelInferenceEngine:
         else:
             logits = self.model.compute_logits(last_hidden)  # [batch_size, vocab_size]
 
-        temperatures = self._prepare_sample(sequences, temperature)
-        if temperature > 0:
-            first_token = self.sampler(logits, temperatures)
-        else:
-            first_token = torch.argmax(logits, dim=-1)
+        sampling = self._prepare_sample(
+            sequences, temperature, top_k, top_p, typical_mass, repetition_penalty
+        )
+        if sampling["repetition_penalties"] is not None:
+            # the penalized tokens: the prompt input ids, then every sampled token
+            vocab_size = logits.size(-1)
+            prompt_ids = input_ids.clamp(0, vocab_size - 1)
+            seen_tokens = torch.zeros(
+                batch_size, vocab_size, dtype=torch.bool, device=logits.device
+            ).scatter_(1, prompt_ids.to(logits.device), True)
+            sampling["seen_tokens"] = seen_tokens
+        first_token = self.sampler(logits, **sampling)
+        if "seen_tokens" in sampling:
+            sampling["seen_tokens"].scatter_(1, first_token.unsqueeze(1), True)
 
         first_token_list = first_token.tolist()
 
@@ -560,6 +690,8 @@ class AccelInferenceEngine:
                 output_ids.append(full_sequence)
 
             output = torch.tensor(output_ids, dtype=torch.long, device=device)
+            if return_hidden_states:
+                return output, self._collect_hidden_states(step_hidden_states, generated_tokens)
             return output
 
         remaining_tokens = max_new_tokens - 1
@@ -575,6 +707,9 @@ class AccelInferenceEngine:
                 tts_mel_embedding=tts_mel_embedding,
                 tts_text_pos_embedding=tts_text_pos_embedding,
             )
+            if return_hidden_states:
+                # the CUDA graph output buffer is overwritten by the next replay
+                step_hidden_states.append(hidden_states.clone())
 
             # Get logits
             if self.lm_head is not None:
@@ -586,11 +721,9 @@ class AccelInferenceEngine:
 
             reset_forward_context()
 
-            temperatures = self._prepare_sample(sequences, temperature)
-            if temperature > 0:
-                next_token = self.sampler(logits, temperatures)
-            else:
-                next_token = torch.argmax(logits, dim=-1)
+            next_token = self.sampler(logits, **sampling)
+            if "seen_tokens" in sampling:
+                sampling["seen_tokens"].scatter_(1, next_token.unsqueeze(1), True)
             next_token_list = next_token.tolist()
 
             for i, token_id in enumerate(next_token_list):
@@ -605,6 +738,8 @@ class AccelInferenceEngine:
 
             if all(is_finished):
                 break
+            if stopping_criteria is not None and stopping_criteria(next_token.unsqueeze(1), logits).all():
+                break
 
         for req in sequences:
             self.kv_manager.remove_seq(req)
@@ -642,18 +777,20 @@ class AccelInferenceEngine:
             f"Output batch size mismatch: {output.size(0)} != {batch_size}"
         )
 
+        if return_hidden_states:
+            return output, self._collect_hidden_states(step_hidden_states, generated_tokens)
         return output
 
+    def _collect_hidden_states(
+        self, step_hidden_states: List[torch.Tensor], generated_tokens: List[List[int]]
+    ) -> List[torch.Tensor]:
+        hidden_states = []
+        for i, tokens in enumerate(generated_tokens):
+            if len(tokens) == 0:
+                hidden_states.append(step_hidden_states[0].new_zeros(0, self.hidden_size))
+            else:
+                hidden_states.append(
+                    torch.stack([step_hidden_states[k][i] for k in range(len(tokens))])
+                )
+        return hidden_states
 
-class Sampler(nn.Module):
-    def __init__(self):
-        super().__init__()
-
-    @torch.compile
-    def forward(self, logits: torch.Tensor, temperatures: torch.Tensor):
-        logits = logits.float().div_(temperatures.unsqueeze(dim=1))
-        probs = torch.softmax(logits, dim=-1)
-        sample_tokens = probs.div_(
-            torch.empty_like(probs).exponential_(1).clamp_min_(1e-10)
-        ).argmax(dim=-1)
-        return sample_tokens
\ No newline at end of file
@@ -1,11 +1,19 @@
 from dataclasses import dataclass
 
 import torch
-import triton
-import triton.language as tl
-from flash_attn import flash_attn_varlen_func, flash_attn_with_kvcache
+import torch.nn.functional as F
 from torch import nn
 
+try:
+    import triton
+    import triton.language as tl
+    from flash_attn import flash_attn_varlen_func, flash_attn_with_kvcache
+
+    HAS_FLASH_ATTN = True
+except ImportError:
+    # CPU only nodes: fall back to the pure PyTorch paged attention below
+    HAS_FLASH_ATTN = False
+
 
 @dataclass
 class ForwardContext:
@@ -54,39 +62,41 @@ def reset_forward_context():
     _FORWARD_CONTEXT = ForwardContext()
 
 
-@triton.jit
-def store_kvcache_kernel(
-    key_ptr,
-    key_stride,
-    value_ptr,
-    value_stride,
-    k_cache_ptr,
-    v_cache_ptr,
-    slot_mapping_ptr,
-    D: tl.constexpr,
-):
-    BLOCK_SIZE: tl.constexpr = 2048
-    idx = tl.program_id(0)
-    slot = tl.load(slot_mapping_ptr + idx)
-    if slot == -1:
-        return
-    d_offset = 0
-    while d_offset < D:
-        cur_block_size = min(BLOCK_SIZE, D - d_offset)
-        key_offsets = idx * key_stride + d_offset + tl.arange(0, BLOCK_SIZE)
-        value_offsets = idx * value_stride + d_offset + tl.arange(0, BLOCK_SIZE)
-        cache_offsets = slot * D + d_offset + tl.arange(0, BLOCK_SIZE)
-
-        mask = tl.arange(0, BLOCK_SIZE) < cur_block_size
-        key = tl.load(key_ptr + key_offsets, mask=mask, other=0.0)
-        value = tl.load(value_ptr + value_offsets, mask=mask, other=0.0)
-        tl.store(k_cache_ptr + cache_offsets, key, mask=mask)
-        tl.store(v_cache_ptr + cache_offsets, value, mask=mask)
-
-        d_offset += BLOCK_SIZE
+if HAS_FLASH_ATTN:
 
+    @triton.jit
+    def store_kvcache_kernel(
+        key_ptr,
+        key_stride,
+        value_ptr,
+        value_stride,
+        k_cache_ptr,
+        v_cache_ptr,
+        slot_mapping_ptr,
+        D: tl.constexpr,
+    ):
+        BLOCK_SIZE: tl.constexpr = 2048
+        idx = tl.program_id(0)
+        slot = tl.load(slot_mapping_ptr + idx)
+        if slot == -1:
+            return
+        d_offset = 0
+        while d_offset < D:
+            cur_block_size = min(BLOCK_SIZE, D - d_offset)
+            key_offsets = idx * key_stride + d_offset + tl.arange(0, BLOCK_SIZE)
+            value_offsets = idx * value_stride + d_offset + tl.arange(0, BLOCK_SIZE)
+            cache_offsets = slot * D + d_offset + tl.arange(0, BLOCK_SIZE)
 
-def store_kvcache(
+            mask = tl.arange(0, BLOCK_SIZE) < cur_block_size
+            key = tl.load(key_ptr + key_offsets, mask=mask, other=0.0)
+            value = tl.load(value_ptr + value_offsets, mask=mask, other=0.0)
+            tl.store(k_cache_ptr + cache_offsets, key, mask=mask)
+            tl.store(v_cache_ptr + cache_offsets, value, mask=mask)
+
+            d_offset += BLOCK_SIZE
+
+
+def store_kvcache_triton(
     key: torch.Tensor,
     value: torch.Tensor,
     k_cache: torch.Tensor,
@@ -104,6 +114,111 @@ def store_kvcache(
     )
 
 
+def store_kvcache_torch(
+    key: torch.Tensor,
+    value: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    slot_mapping: torch.Tensor,
+):
+    """
+    Pure PyTorch version of `store_kvcache_triton`, the slots of -1 are skipped.
+    """
+    N, num_heads, head_dim = key.shape
+    assert slot_mapping.numel() == N
+    slots = slot_mapping.long()
+    valid = slots >= 0
+    if not bool(valid.all()):
+        slots, key, value = slots[valid], key[valid], value[valid]
+    k_cache.view(-1, num_heads, head_dim)[slots] = key.to(k_cache.dtype)
+    v_cache.view(-1, num_heads, head_dim)[slots] = value.to(v_cache.dtype)
+
+
+def store_kvcache(
+    key: torch.Tensor,
+    value: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    slot_mapping: torch.Tensor,
+):
+    if HAS_FLASH_ATTN and key.is_cuda:
+        store_kvcache_triton(key, value, k_cache, v_cache, slot_mapping)
+    else:
+        store_kvcache_torch(key, value, k_cache, v_cache, slot_mapping)
+
+
+def gather_kvcache(cache: torch.Tensor, block_table: torch.Tensor, seqlen: int) -> torch.Tensor:
+    """
+    Gather the first ``seqlen`` tokens of a sequence from the paged cache.
+    cache: [num_blocks, block_size, num_heads, head_dim], block_table: [max_num_blocks] padded with -1
+    Returns: [seqlen, num_heads, head_dim]
+    """
+    block_size = cache.size(1)
+    num_blocks = (seqlen + block_size - 1) // block_size
+    blocks = block_table[:num_blocks].long()
+    return cache[blocks].flatten(0, 1)[:seqlen]
+
+
+def _sdpa(q, k, v, attn_mask, scale):
+    # [L, H, D] -> [H, L, D]
+    o = F.scaled_dot_product_attention(
+        q.transpose(0, 1).to(k.dtype),
+        k.transpose(0, 1),
+        v.transpose(0, 1),
+        attn_mask=attn_mask,
+        scale=scale,
+    )
+    return o.transpose(0, 1).to(q.dtype)
+
+
+def paged_attention_prefill_torch(q, k, v, k_cache, v_cache, context: ForwardContext, scale: float):
+    """
+    Pure PyTorch version of the varlen causal prefill of `flash_attn_varlen_func`.
+    q, k, v: [total_tokens, num_heads, head_dim] packed by ``context.cu_seqlens_q/k``.
+    With ``context.block_tables`` (prefix cache hit), the keys/values are read from the paged cache.
+    """
+    cu_seqlens_q = context.cu_seqlens_q.tolist()
+    cu_seqlens_k = context.cu_seqlens_k.tolist()
+    outputs = []
+    for i in range(len(cu_seqlens_q) - 1):
+        q_i = q[cu_seqlens_q[i]:cu_seqlens_q[i + 1]]
+        seqlen_q = q_i.size(0)
+        seqlen_k = cu_seqlens_k[i + 1] - cu_seqlens_k[i]
+        if context.block_tables is not None:
+            k_i = gather_kvcache(k_cache, context.block_tables[i], seqlen_k)
+            v_i = gather_kvcache(v_cache, context.block_tables[i], seqlen_k)
+        else:
+            k_i = k[cu_seqlens_k[i]:cu_seqlens_k[i + 1]]
+            v_i = v[cu_seqlens_k[i]:cu_seqlens_k[i + 1]]
+        # causal, aligned to the end: the cached tokens are visible by all the queries
+        attn_mask = torch.ones(seqlen_q, seqlen_k, dtype=torch.bool, device=q.device).tril(
+            diagonal=seqlen_k - seqlen_q
+        )
+        outputs.append(_sdpa(q_i, k_i, v_i, attn_mask, scale))
+    return torch.cat(outputs, dim=0)
+
+
+def paged_attention_decode_torch(q, k_cache, v_cache, context: ForwardContext, scale: float):
+    """
+    Pure PyTorch version of the batched decode of `flash_attn_with_kvcache`.
+    q: [batch_size, num_heads, head_dim], one token per sequence.
+    Returns: [batch_size, num_heads, head_dim]
+    """
+    batch_size, num_heads, head_dim = q.shape
+    block_size = k_cache.size(1)
+    block_tables = context.block_tables.long().clamp(min=0)
+    max_len = block_tables.size(1) * block_size
+    # [B, max_len, H, D] -> [B, H, max_len, D]
+    k = k_cache[block_tables].view(batch_size, max_len, num_heads, head_dim).transpose(1, 2)
+    v = v_cache[block_tables].view(batch_size, max_len, num_heads, head_dim).transpose(1, 2)
+    positions = torch.arange(max_len, device=q.device)
+    attn_mask = positions.unsqueeze(0) < context.context_lens.to(q.device).unsqueeze(1)  # [B, max_len]
+    o = F.scaled_dot_product_attention(
+        q.unsqueeze(2).to(k.dtype), k, v, attn_mask=attn_mask[:, None, None, :], scale=scale
+    )
+    return o.squeeze(2).to(q.dtype)
+
+
 class Attention(nn.Module):
     def __init__(
         self,
@@ -126,6 +241,11 @@ class Attention(nn.Module):
         if k_cache.numel() and v_cache.numel() and context.slot_mapping is not None:
             store_kvcache(k, v, k_cache, v_cache, context.slot_mapping)
 
+        if not (HAS_FLASH_ATTN and q.is_cuda):
+            if context.is_prefill:
+                return paged_attention_prefill_torch(q, k, v, k_cache, v_cache, context, self.scale)
+            return paged_attention_decode_torch(q, k_cache, v_cache, context, self.scale)
+
         if context.is_prefill:
             if context.block_tables is not None:
                 k, v = k_cache, v_cache
@@ -29,8 +29,15 @@ class KVCacheBlock:
 
 
 class Seq:
-    def __init__(self, token_ids: List[int], block_size: int = 256):
+    def __init__(self, token_ids: List[int], block_size: int = 256, prefix_hash: Optional[bytes] = None):
+        """
+        Args:
+            token_ids: the prompt token ids, only used as the keys of the prefix cache in the TTS mode
+            prefix_hash: fingerprint of the content which is not covered by ``token_ids``
+                (e.g. the conditioning embeddings), the parent hash of the first block
+        """
         self.token_ids = copy(token_ids)
+        self.prefix_hash = prefix_hash
         self.last_token = token_ids[-1] if token_ids else 0
         self.num_tokens = len(self.token_ids)
         self.num_prompt_tokens = len(token_ids)
@@ -77,6 +84,7 @@ class KVCacheManager:
         block_size: int,
         num_blocks: int,
         dtype: torch.dtype,
+        device=None,
     ):
         self.num_layers = num_layers
         self.num_heads = num_heads
@@ -90,8 +98,10 @@ class KVCacheManager:
         self.free_block_ids: deque = deque(range(num_blocks))
         self.used_block_ids: Set[int] = set()
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        cache_dtype = torch.float16 if device == "cuda" else dtype
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = torch.device(device)
+        cache_dtype = torch.float16 if device.type == "cuda" else dtype
         self.kv_cache = torch.empty(
             2,
             num_layers,
@@ -117,6 +127,9 @@ class KVCacheManager:
     def _allocate_block(self, block_id: int) -> KVCacheBlock:
         block = self.blocks[block_id]
         assert block.ref_cnt == 0
+        if block.block_hash is not None and self.block_hash_to_id.get(block.block_hash) == block_id:
+            # the content is about to be overwritten
+            del self.block_hash_to_id[block.block_hash]
         block.reset()
         self.free_block_ids.remove(block_id)
         self.used_block_ids.add(block_id)
@@ -130,7 +143,7 @@ class KVCacheManager:
     def allocate(self, sequence: Seq):
         assert not sequence.block_table, "Sequence already has allocated blocks"
 
-        parent_hash = None
+        parent_hash = sequence.prefix_hash
         cache_miss = False
 
         for i in range(sequence.num_blocks):
@@ -142,7 +155,7 @@ class KVCacheManager:
             )
             block_id = self.block_hash_to_id.get(block_hash) if block_hash else None
 
-            if block_id is None or self.blocks[block_id].token_ids != token_ids:
+            if block_id is None or self.blocks[block_id].block_hash != block_hash:
                 cache_miss = True
 
             if cache_miss:
@@ -150,12 +163,16 @@ class KVCacheManager:
                 block = self._allocate_block(block_id)
             else:
                 sequence.num_cached_tokens += self.block_size
-                if block_id is not None and block_id in self.used_block_ids:
+                if block_id in self.used_block_ids:
                     block = self.blocks[block_id]
                     block.ref_cnt += 1
                 else:
-                    block_id = self.free_block_ids[0]
-                    block = self._allocate_block(block_id)
+                    # a freed block which still holds the cached content
+                    block = self.blocks[block_id]
+                    assert block.ref_cnt == 0
+                    block.ref_cnt = 1
+                    self.free_block_ids.remove(block_id)
+                    self.used_block_ids.add(block_id)
 
             if block_hash is not None:
                 block.update(block_hash, token_ids)
@@ -164,6 +181,11 @@ class KVCacheManager:
 
             sequence.block_table.append(block_id)
 
+        if sequence.num_tokens > 0 and sequence.num_cached_tokens == sequence.num_tokens:
+            # at least the last token must be computed to get the logits of the next one,
+            # its KV is rewritten with the same values
+            sequence.num_cached_tokens -= self.block_size
+
     def deallocate(self, sequence: Seq):
         for block_id in reversed(sequence.block_table):
             block = self.blocks[block_id]
@@ -189,7 +211,7 @@ class KVCacheManager:
             parent_hash = (
                 self.blocks[block_table[-2]].block_hash
                 if len(block_table) > 1
-                else None
+                else sequence.prefix_hash
             )
             block_hash = self.compute_block_hash(token_ids, parent_hash)
             last_block.update(block_hash, token_ids)
@@ -0,0 +1,377 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import torch
+
+from .accel_engine import AccelInferenceEngine
+from .attention import get_forward_context, reset_forward_context
+from .kv_manager import Seq
+
+
+@dataclass
+class GenerationRequest:
+    tts_embeddings: torch.Tensor  # [prompt_len, hidden_size]: [cond][text] embeddings, NO padding, NO start_mel
+    start_token_id: int
+    max_new_tokens: int
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    typical_mass: float = 1.0
+    repetition_penalty: float = 1.0
+    stop_tokens: List[int] = field(default_factory=list)
+    return_hidden_states: bool = False
+    prompt_token_ids: Optional[List[int]] = None  # prefix cache keys, see `AccelInferenceEngine.generate()`
+    prefix_hash: Optional[bytes] = None
+    stopping_criteria: Optional[Callable] = None  # see `AccelInferenceEngine.generate()`
+    future: Future = field(default_factory=Future)
+    seq: Optional[Seq] = None
+    generated_tokens: List[int] = field(default_factory=list)
+    hidden_states: List[torch.Tensor] = field(default_factory=list)
+    seen_tokens: Optional[torch.Tensor] = None  # [vocab_size] bool, the tokens of the repetition penalty
+
+
+class ContinuousBatchingScheduler:
+    """
+    Step-level (continuous batching) scheduler on top of `AccelInferenceEngine`.
+
+    The requests are submitted from any thread and decoded by a single worker thread. At every step the
+    waiting requests are admitted into the running batch as long as the KV cache has free blocks for their
+    prompts, one decode step is run for the whole batch, and the finished sequences release their blocks at once,
+    so that concurrent TTS requests share the decode steps instead of running one after another.
+
+    The blocks are allocated on demand while the sequences grow. When the KV cache runs out, the latest admitted
+    sequence is preempted: its blocks are released and it goes back to the front of the waiting queue, keeping
+    the tokens generated so far, which are prefilled again (with the prompt) when it is re-admitted.
+    """
+
+    def __init__(
+        self,
+        engine: AccelInferenceEngine,
+        tts_mel_embedding: torch.nn.Module,
+        tts_text_pos_embedding: torch.nn.Module,
+        max_batch_size: int = 8,
+    ):
+        """
+        Args:
+            engine: the engine which owns the model and the KV cache, it must not be used by
+                `AccelInferenceEngine.generate()` concurrently
+            tts_mel_embedding: mel_embedding layer
+            tts_text_pos_embedding: mel position embedding layer
+            max_batch_size: max number of the sequences in the running batch
+        """
+        self.engine = engine
+        self.tts_mel_embedding = tts_mel_embedding
+        self.tts_text_pos_embedding = tts_text_pos_embedding
+        self.max_batch_size = max_batch_size
+        self.waiting: deque = deque()
+        self.running: List[GenerationRequest] = []
+        self._queue: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="accel-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self):
+        self._stopped = True
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(
+        self,
+        tts_embeddings: torch.Tensor,
+        start_token_id: int,
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        stop_tokens: Optional[List[int]] = None,
+        return_hidden_states: bool = False,
+        prompt_token_ids: Optional[List[int]] = None,
+        prefix_hash: Optional[bytes] = None,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        typical_mass: float = 1.0,
+        repetition_penalty: float = 1.0,
+        stopping_criteria: Optional[Callable] = None,
+    ) -> Future:
+        """
+        Submit one sequence, the sampling parameters are the same as `AccelInferenceEngine.generate()`.
+
+        Returns:
+            a Future of ``(generated_tokens, hidden_states)``, ``hidden_states`` is [num_generated, hidden_size]
+            if ``return_hidden_states`` else None
+        """
+        if tts_embeddings.dim() == 3:
+            assert tts_embeddings.size(0) == 1, "submit one sequence at a time"
+            tts_embeddings = tts_embeddings[0]
+        request = GenerationRequest(
+            tts_embeddings=tts_embeddings,
+            start_token_id=int(start_token_id),
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k or 0,
+            top_p=top_p,
+            typical_mass=typical_mass,
+            repetition_penalty=repetition_penalty,
+            stop_tokens=list(stop_tokens or []),
+            return_hidden_states=return_hidden_states,
+            prompt_token_ids=list(prompt_token_ids) if prompt_token_ids is not None else None,
+            prefix_hash=prefix_hash,
+            stopping_criteria=stopping_criteria,
+        )
+        if self._thread is None:
+            self.start()
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, *args, **kwargs):
+        """
+        Blocking version of `submit()`.
+        """
+        return self.submit(*args, **kwargs).result()
+
+    def _loop(self):
+        while not self._stopped:
+            # block while idle
+            block = not self.running and not self.waiting
+            try:
+                request = self._queue.get(block=block)
+                if request is not None:
+                    self.waiting.append(request)
+            except queue.Empty:
+                pass
+            if self._stopped:
+                break
+            try:
+                self.step()
+            except Exception as e:
+                self._fail_all(e)
+        self._fail_all(RuntimeError("scheduler is shut down"))
+
+    def _fail_all(self, error: Exception):
+        for request in self.running:
+            self._release(request)
+            if not request.future.done():
+                request.future.set_exception(error)
+        self.running = []
+        while self.waiting:
+            request = self.waiting.popleft()
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def _num_blocks(self, num_tokens: int) -> int:
+        return (num_tokens + self.engine.block_size - 1) // self.engine.block_size
+
+    def _admit(self) -> List[GenerationRequest]:
+        while True:
+            try:
+                self.waiting.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        admitted = []
+        num_free_blocks = len(self.engine.kv_manager.free_block_ids)
+        while self.waiting and len(self.running) + len(admitted) < self.max_batch_size:
+            request = self.waiting[0]
+            if request is None:
+                self.waiting.popleft()
+                continue
+            # +1 for the start_mel_token
+            num_worst_case = self._num_blocks(request.tts_embeddings.size(0) + 1 + request.max_new_tokens)
+            if num_worst_case > self.engine.num_blocks:
+                self.waiting.popleft()
+                request.future.set_exception(ValueError(
+                    f"request needs {num_worst_case} KV cache blocks, but the engine only has {self.engine.num_blocks}"
+                ))
+                continue
+            # the prompt and the tokens generated before a preemption
+            num_needed = self._num_blocks(request.tts_embeddings.size(0) + 1 + len(request.generated_tokens))
+            # keep one free block per running sequence for its next decode steps, unless the batch is empty
+            num_running = len(self.running) + len(admitted)
+            if num_running > 0 and num_needed + num_running > num_free_blocks:
+                break
+            if num_needed > num_free_blocks:
+                break
+            self.waiting.popleft()
+            num_free_blocks -= num_needed
+            admitted.append(request)
+        return admitted
+
+    def _preempt(self, request: GenerationRequest):
+        """
+        Release the blocks of a running sequence, and requeue it in front of the waiting requests.
+        """
+        self.running.remove(request)
+        self._release(request)
+        request.seq = None
+        self.waiting.appendleft(request)
+
+    def _make_room(self, request: GenerationRequest) -> bool:
+        """
+        Preempt the latest admitted sequences until ``request`` can get the next block of its KV cache.
+        Returns: False if ``request`` itself was preempted
+        """
+        if len(request.seq) % self.engine.block_size != 1:
+            # the last block is not full yet
+            return True
+        while not self.engine.kv_manager.free_block_ids:
+            victim = self.running[-1]
+            self._preempt(victim)
+            if victim is request:
+                return False
+        return True
+
+    def _release(self, request: GenerationRequest):
+        if request.seq is not None and request.seq.block_table:
+            self.engine.kv_manager.remove_seq(request.seq)
+
+    def _finish(self, request: GenerationRequest):
+        self._release(request)
+        hidden_states = None
+        if request.return_hidden_states:
+            if request.hidden_states:
+                hidden_states = torch.stack(request.hidden_states)
+            else:
+                hidden_states = torch.zeros(0, self.engine.hidden_size, device=self.engine.device)
+        request.future.set_result((request.generated_tokens, hidden_states))
+
+    def _sample(self, requests: List[GenerationRequest], hidden_states: torch.Tensor) -> List[int]:
+        lm_head = self.engine.lm_head
+        if hidden_states.dtype != next(lm_head.parameters()).dtype:
+            hidden_states = hidden_states.to(next(lm_head.parameters()).dtype)
+        logits = lm_head(hidden_states)
+        sampling = self.engine._prepare_sample(
+            [r.seq for r in requests],
+            [r.temperature for r in requests],
+            [r.top_k for r in requests],
+            [r.top_p for r in requests],
+            [r.typical_mass for r in requests],
+            [r.repetition_penalty for r in requests],
+        )
+        if sampling["repetition_penalties"] is not None:
+            for request in requests:
+                if request.seen_tokens is None:
+                    request.seen_tokens = torch.zeros(logits.size(-1), dtype=torch.bool, device=logits.device)
+                    # the dummy prompt ids which `inference_speech()` also feeds to HF generate
+                    request.seen_tokens[[1, request.start_token_id]] = True
+            sampling["seen_tokens"] = torch.stack([r.seen_tokens for r in requests])
+        tokens = self.engine.sampler(logits, **sampling).tolist()
+        for request, token_id in zip(requests, tokens):
+            if request.seen_tokens is not None:
+                request.seen_tokens[token_id] = True
+        return tokens
+
+    def _append_tokens(self, requests: List[GenerationRequest], hidden_states: torch.Tensor):
+        """
+        Append the sampled tokens, and retire the finished sequences.
+        """
+        tokens = self._sample(requests, hidden_states)
+        for i, (request, token_id) in enumerate(zip(requests, tokens)):
+            if request not in self.running:
+                # preempted by a sequence before it in this step, the token is sampled again after the resume
+                continue
+            if token_id in request.stop_tokens:
+                finished = True
+            elif request.stopping_criteria is not None and request.stopping_criteria(
+                    torch.tensor([[token_id]], device=hidden_states.device), None).all():
+                # cancelled by the caller, the sampled token is dropped
+                finished = True
+            else:
+                request.generated_tokens.append(token_id)
+                if request.return_hidden_states:
+                    request.hidden_states.append(hidden_states[i].clone())
+                finished = len(request.generated_tokens) >= request.max_new_tokens
+                if not finished:
+                    request.seq.append_token(token_id)
+                    if not self._make_room(request):
+                        continue
+                    self.engine.kv_manager.append_to_seq(request.seq)
+            if finished:
+                self.running.remove(request)
+                self._finish(request)
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        engine = self.engine
+        model_dtype = next(engine.model.parameters()).dtype
+        embeddings = []
+        for request in requests:
+            prompt_len = request.tts_embeddings.size(0)
+            # token ids are only used as the prefix cache keys, the inputs are the embeddings
+            token_ids = request.prompt_token_ids
+            if token_ids is None:
+                token_ids = [1] * prompt_len + [request.start_token_id]
+            assert len(token_ids) == prompt_len + 1, "prompt_token_ids must include the start_mel_token"
+            # a preempted request resumes with the tokens generated so far
+            request.seq = Seq(token_ids + request.generated_tokens, block_size=engine.block_size,
+                              prefix_hash=request.prefix_hash)
+            request.seq.num_prompt_tokens = prompt_len + 1
+            engine.kv_manager.allocate(request.seq)
+            # the start_mel_token at `prompt_len` (as `AccelInferenceEngine.generate()`), then the mel positions
+            # of the decode steps, see `_prepare_decode(per_seq_positions=True)`
+            mel_ids = [request.start_token_id] + request.generated_tokens
+            mel_positions = [prompt_len] + list(range(1, len(mel_ids)))
+            mel_emb = self.tts_mel_embedding(
+                torch.tensor(mel_ids, device=engine.device)
+            ) + self.tts_text_pos_embedding.emb(
+                torch.tensor(mel_positions, device=engine.device, dtype=torch.long)
+            )
+            full_embeddings = torch.cat([request.tts_embeddings.to(mel_emb.dtype), mel_emb], dim=0)
+            embeddings.append(full_embeddings[request.seq.num_cached_tokens:])
+        engine._prepare_prefill([r.seq for r in requests])
+        try:
+            inputs_embeds = torch.cat(embeddings, dim=0).unsqueeze(0).to(model_dtype)
+            hidden_states = engine.model(inputs_embeds=inputs_embeds, return_dict=True).last_hidden_state
+            cu_seqlens = get_forward_context().cu_seqlens_q.tolist()
+            last_hidden = torch.stack(
+                [hidden_states[0, cu_seqlens[i + 1] - 1] for i in range(len(requests))]
+            )
+        finally:
+            reset_forward_context()
+        self.running.extend(requests)
+        self._append_tokens(requests, last_hidden)
+
+    def _decode(self):
+        engine = self.engine
+        requests = list(self.running)
+        decode_ids, decode_pos = engine._prepare_decode([r.seq for r in requests], per_seq_positions=True)
+        try:
+            hidden_states = engine._run_decode_with_graph(
+                decode_ids,
+                decode_pos,
+                get_forward_context(),
+                tts_mel_embedding=self.tts_mel_embedding,
+                tts_text_pos_embedding=self.tts_text_pos_embedding,
+            )
+        finally:
+            reset_forward_context()
+        self._append_tokens(requests, hidden_states)
+
+    @torch.inference_mode()
+    def step(self) -> bool:
+        """
+        Run one scheduling step: admit the waiting requests, then one decode step of the running batch.
+        Returns: whether there is still work to do
+        """
+        engine = self.engine
+        engine._tts_mode = True
+        if engine.use_cuda_graph and not engine.graph_captured:
+            engine._capture_cuda_graphs(
+                tts_mel_embedding=self.tts_mel_embedding,
+                tts_text_pos_embedding=self.tts_text_pos_embedding,
+            )
+            engine.graph_captured = True
+
+        admitted = self._admit()
+        if admitted:
+            self._prefill(admitted)
+        if self.running:
+            self._decode()
+        return bool(self.running or self.waiting)
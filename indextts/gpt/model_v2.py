@@ -1,8 +1,11 @@
 import functools
+import hashlib
+import warnings
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 import transformers
 from transformers import GPT2Config, LogitsProcessorList
@@ -57,6 +60,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        # last hidden state of each generation step, see `UnifiedVoice.inference_speech(return_latent=True)`
+        self.collect_hidden_states = False
+        self.collected_hidden_states = []
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -182,6 +188,10 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
+        if self.collect_hidden_states:
+            # the hidden state of the last input token, which predicts the next mel token
+            self.collected_hidden_states.append(hidden_states[:, -1:])
+
         lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
@@ -411,6 +421,7 @@ class UnifiedVoice(nn.Module):
 
         self.use_accel = use_accel
         self.accel_engine = None  # Will be initialized in post_init_gpt2_config
+        self.accel_scheduler = None  # see enable_continuous_batching()
 
     def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False):
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
@@ -425,12 +436,16 @@ class UnifiedVoice(nn.Module):
             use_cache=True,
         )
 
-        if self.use_accel and torch.cuda.is_available():
-            # Check if flash attention is available
-            try:
-                import flash_attn
-            except ImportError:
-                raise ImportError("flash_attn is required for acceleration but not installed. Please install from https://github.com/Dao-AILab/flash-attention/releases/")
+        if self.use_accel:
+            device = next(self.gpt.parameters()).device
+            if device.type == "cuda":
+                # Check if flash attention is available
+                try:
+                    import flash_attn
+                except ImportError:
+                    raise ImportError("flash_attn is required for acceleration but not installed. Please install from https://github.com/Dao-AILab/flash-attention/releases/")
+            else:
+                print(f">> acceleration engine on {device}: using the PyTorch paged attention backend")
 
             from indextts.accel import GPT2AccelModel, AccelInferenceEngine
 
@@ -439,20 +454,23 @@ class UnifiedVoice(nn.Module):
             accel_gpt.load_state_dict(self.gpt.state_dict(), strict=False)
 
             if half:
-                accel_gpt = accel_gpt.half().cuda()
+                accel_gpt = accel_gpt.half().to(device)
             else:
-                accel_gpt = accel_gpt.cuda()
+                accel_gpt = accel_gpt.to(device)
             accel_gpt.eval()
 
             lm_head_with_norm = nn.Sequential(self.final_norm, self.mel_head)
+            # the paged KV cache of flash-attn requires blocks of 256 tokens, the PyTorch backend uses smaller
+            # blocks so that the conditioning prefix (32 + 2 tokens) fills whole blocks which the prefix cache can reuse
+            block_size = 256 if device.type == "cuda" else 16
             self.accel_engine = AccelInferenceEngine(
                 model=accel_gpt,
                 lm_head=lm_head_with_norm,
                 num_layers=self.layers,
                 num_heads=self.heads,
                 head_dim=self.model_dim // self.heads,
-                block_size=256,
-                num_blocks=16,  # Reduce to save memory (16*256 = 4096 tokens capacity)
+                block_size=block_size,
+                num_blocks=4096 // block_size,  # Reduce to save memory (4096 tokens capacity)
                 use_cuda_graph=True,
             )
             print("acceleration engine initialized")
@@ -485,6 +503,92 @@ class UnifiedVoice(nn.Module):
         # self.inference_model = PrunedGPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
         self.gpt.wte = self.mel_embedding
 
+    def enable_continuous_batching(self, max_batch_size=8):
+        """
+        Run the accel engine behind a `ContinuousBatchingScheduler`: the concurrent `inference_speech()` calls
+        (from different threads) share the decode steps instead of running one after another.
+        The KV cache blocks are allocated as the sequences grow, so the batch is not limited by the worst case
+        of ``max_mel_tokens`` per sequence. The calls with ``input_tokens`` or ``num_return_sequences > 1``
+        use HF generate, the scheduler owns the engine.
+        """
+        if self.accel_engine is None:
+            raise RuntimeError("continuous batching requires the acceleration engine, please set `use_accel=True`")
+        if self.accel_scheduler is None:
+            from indextts.accel.scheduler import ContinuousBatchingScheduler
+            self.accel_scheduler = ContinuousBatchingScheduler(
+                self.accel_engine,
+                tts_mel_embedding=self.inference_model.embeddings,
+                tts_text_pos_embedding=self.inference_model.text_pos_embedding,
+                max_batch_size=max_batch_size,
+            ).start()
+        return self.accel_scheduler
+
+    def _accel_prefix_keys(self, conds_latent, text_inputs):
+        """
+        Keys of the accel engine prefix cache: the fingerprint of the conditioning latents (voice, emotion and speed)
+        as the parent hash of the first block, plus the token ids of each row of `prepare_gpt_inputs()`:
+        [cond placeholders][start_text][text][stop_text][start_mel], without the left padding.
+        """
+        prefix_hash = hashlib.sha256(conds_latent.detach().float().cpu().numpy().tobytes()).digest()
+        prompt_token_ids = []
+        for text_input in text_inputs.tolist():
+            text_ids = [t for t in text_input if t != self.stop_text_token and t != self.start_text_token]
+            prompt_token_ids.append(
+                [-1] * conds_latent.shape[1]
+                + [self.start_text_token] + text_ids + [self.stop_text_token]
+                + [self.start_mel_token]
+            )
+        return prefix_hash, prompt_token_ids
+
+    def _accel_sampling_kwargs(self, hf_generate_kwargs, typical_sampling=False, typical_mass=.9):
+        """
+        The sampling parameters of HF `generate()` for the accel engine, which has no beam search.
+        """
+        num_beams = hf_generate_kwargs.get("num_beams", 1)
+        if num_beams > 1:
+            warnings.warn(f"beam search is not supported by the acceleration engine, num_beams={num_beams} "
+                          f"falls back to sampling", RuntimeWarning)
+        do_sample = hf_generate_kwargs.get("do_sample", True)
+        return dict(
+            temperature=hf_generate_kwargs.get("temperature", 1) if do_sample else 0,
+            top_k=hf_generate_kwargs.get("top_k", 50) or 0,
+            top_p=hf_generate_kwargs.get("top_p", 1.0),
+            typical_mass=typical_mass if typical_sampling else 1.0,
+            repetition_penalty=hf_generate_kwargs.get("repetition_penalty", 1.0),
+        )
+
+    def _generate_with_scheduler(self, inputs, inputs_embeds, attention_mask, max_new_tokens,
+                                 return_hidden_states=False, prefix_hash=None, prompt_token_ids=None,
+                                 stopping_criteria=None, **sampling_kwargs):
+        """
+        Submit each sequence of the batch to the continuous batching scheduler and wait for all of them.
+        Returns: the same outputs as `AccelInferenceEngine.generate()`
+        """
+        futures = []
+        for i in range(inputs_embeds.size(0)):
+            # drop the left padding, the last position of the mask is the start_mel_token
+            valid_mask = attention_mask[i, :inputs_embeds.size(1)].bool()
+            futures.append(self.accel_scheduler.submit(
+                inputs_embeds[i][valid_mask],
+                start_token_id=self.start_mel_token,
+                max_new_tokens=max_new_tokens,
+                stop_tokens=[self.stop_mel_token],
+                return_hidden_states=return_hidden_states,
+                prompt_token_ids=prompt_token_ids[i] if prompt_token_ids is not None else None,
+                prefix_hash=prefix_hash,
+                stopping_criteria=stopping_criteria,
+                **sampling_kwargs,
+            ))
+        results = [future.result() for future in futures]
+        max_generated = max(len(tokens) for tokens, _ in results)
+        generated = torch.full((len(results), max_generated), self.stop_mel_token, dtype=torch.long, device=inputs.device)
+        for i, (tokens, _) in enumerate(results):
+            generated[i, :len(tokens)] = torch.tensor(tokens, dtype=torch.long, device=inputs.device)
+        output = torch.cat([inputs.long(), generated], dim=1)
+        if return_hidden_states:
+            return output, [hidden_states for _, hidden_states in results]
+        return output
+
     def build_aligned_inputs_and_targets(self, input, start_token, stop_token):
         inp = F.pad(input, (1, 0), value=start_token)
         tar = F.pad(input, (0, 1), value=stop_token)
@@ -630,6 +734,50 @@ class UnifiedVoice(nn.Module):
         text_logits, mel_logits = self.get_logits(conds, text_emb, self.text_head, mel_emb, self.mel_head, get_attns=False, return_latent=True)
         return mel_logits[:, :-2]  # Despite the name, these are not logits. Strip off the two tokens added by this forward pass.
 
+    def forward_latent_chunk(self, speech_conditioning_latent, text_inputs, mel_codes, emo_vec, state=None):
+        """
+        `forward()` latent of the next chunk of the mel codes of one sequence, with the KV cache of the
+        earlier chunks, so that streaming the latents costs one forward pass over the codes in total.
+        The GPT is causal: the latents are the same as the slice of `forward()` over all the codes.
+
+        Args:
+            speech_conditioning_latent: (1, 32, dim) conditioning latent
+            text_inputs: (1, t) text tokens, without padding
+            mel_codes: (1, m) the new codes
+            emo_vec: (1, dim) emotion vector
+            state: None for the first chunk, then the state returned by the previous call
+        Returns:
+            (latent (1, m, dim), state)
+        """
+        device = mel_codes.device
+        if state is None:
+            use_speed = torch.zeros(speech_conditioning_latent.size(0), device=device).long()
+            duration_emb = self.speed_emb(torch.zeros_like(use_speed))
+            duration_emb_half = self.speed_emb(torch.ones_like(use_speed))
+            conds = torch.cat((speech_conditioning_latent + emo_vec.unsqueeze(1), duration_emb_half.unsqueeze(1),
+                               duration_emb.unsqueeze(1)), 1)
+            text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+            text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+            text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+            prefix = torch.cat([conds, text_emb], dim=1)
+            # the latent of a code is the output at the previous input: start_mel_token for the first one
+            state = {"past_key_values": None, "last_code": self.start_mel_token, "num_mel_inputs": 0}
+        else:
+            prefix = None
+        mel_inputs = F.pad(mel_codes[:, :-1], (1, 0), value=state["last_code"])
+        positions = torch.arange(state["num_mel_inputs"], state["num_mel_inputs"] + mel_inputs.size(1), device=device)
+        mel_emb = self.mel_embedding(mel_inputs) + self.mel_pos_embedding.emb(positions)
+        emb = mel_emb if prefix is None else torch.cat([prefix, mel_emb], dim=1)
+        gpt_out = self.gpt(inputs_embeds=emb, past_key_values=state["past_key_values"], use_cache=True,
+                           return_dict=True)
+        latent = self.final_norm(gpt_out.last_hidden_state[:, -mel_inputs.size(1):])
+        state = {
+            "past_key_values": gpt_out.past_key_values,
+            "last_code": mel_codes[0, -1].item(),
+            "num_mel_inputs": state["num_mel_inputs"] + mel_inputs.size(1),
+        }
+        return latent, state
+
     def prepare_gpt_inputs(
         self,
         conditional_latents: torch.Tensor,
@@ -696,15 +844,25 @@ class UnifiedVoice(nn.Module):
         return fake_inputs, batched_mel_emb, attention_mask
 
     def inference_speech(self, speech_condition, text_inputs, emo_speech_condition=None, cond_lengths=None, emo_cond_lengths=None, emo_vec=None, use_speed=False, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, speech_conditioning_latent=None,
+                         return_latent=False, **hf_generate_kwargs):
         """
         Args:
             speech_condition: (b, d, frames) or (d, frames)
             text_inputs: (b, L)
             cond_mel_lengths: lengths of the conditioning mel spectrograms in shape (b,) or (1,)
+            emo_vec: precomputed emotion vector in shape (b, dim), see `merge_emovec()`
+            speech_conditioning_latent: precomputed `get_conditioning()` latent of `speech_condition` in shape (b, 32, dim),
+                skips the conditioning encoder when it is given
             input_tokens: additional tokens for generation in shape (b, s) or (s,)
             max_generate_length: limit the number of generated tokens
+            return_latent: also return the final-layer (final_norm) hidden states collected during decoding, in shape
+                (b, steps, dim). The latent at step i is the one of the input mel token which predicted the i-th code,
+                so it can replace the `forward()` latent pass. Note that the generation uses the mel position
+                embeddings shifted by one compared with `forward()`, the latents are close but not identical.
             hf_generate_kwargs: kwargs for `GPT2InferenceModel.generate(**hf_generate_kwargs)`
+        Returns:
+            (codes, speech_conditioning_latent) or (codes, speech_conditioning_latent, latent) if `return_latent`
         """
 
         if speech_condition.ndim == 2:
@@ -716,7 +874,8 @@ class UnifiedVoice(nn.Module):
         if emo_cond_lengths is None:
             emo_cond_lengths = torch.tensor([emo_speech_condition.shape[-1]], device=speech_condition.device) 
 
-        speech_conditioning_latent = self.get_conditioning(speech_condition.transpose(1,2), cond_lengths)
+        if speech_conditioning_latent is None:
+            speech_conditioning_latent = self.get_conditioning(speech_condition.transpose(1,2), cond_lengths)
         if emo_vec is None:
             print('compute emo vec')
             emo_vec = self.get_emo_conditioning(emo_speech_condition.transpose(1,2), emo_cond_lengths)
@@ -725,7 +884,8 @@ class UnifiedVoice(nn.Module):
         else:
             print('Use the specified emotion vector')
 
-        tmp = torch.zeros(text_inputs.size(0)).to(text_inputs.device)
+        # a single conditioning is shared by all the text inputs of the batch, see `prepare_gpt_inputs()`
+        tmp = torch.zeros(speech_conditioning_latent.size(0)).to(text_inputs.device)
         duration_emb =  self.speed_emb(torch.zeros_like(tmp).long())
         duration_emb_half = self.speed_emb(torch.ones_like(tmp).long())
         conds_latent = torch.cat((speech_conditioning_latent + emo_vec.unsqueeze(1), duration_emb_half.unsqueeze(1), duration_emb.unsqueeze(1)), 1)
@@ -757,31 +917,102 @@ class UnifiedVoice(nn.Module):
             logits_processor.append(TypicalLogitsWarper(mass=typical_mass, min_tokens_to_keep=min_tokens_to_keep))
         max_length = (trunc_index + self.max_mel_tokens - 1) if max_generate_length is None else trunc_index + max_generate_length
         
-        # Use accel engine if available (single sequence only)
-        if self.accel_engine is not None and num_return_sequences == 1:
+        latent = None
+        use_accel = self.accel_engine is not None and num_return_sequences == 1
+        if use_accel and input_tokens is None:
+            prefix_hash, prompt_token_ids = self._accel_prefix_keys(conds_latent, text_inputs)
+        else:
+            prefix_hash, prompt_token_ids = None, None
+        if use_accel:
+            sampling_kwargs = self._accel_sampling_kwargs(hf_generate_kwargs, typical_sampling, typical_mass)
+        if self.accel_scheduler is not None and num_return_sequences == 1 and input_tokens is None:
+            output = self._generate_with_scheduler(
+                inputs,
+                inputs_embeds,
+                attention_mask,
+                max_new_tokens=max_length - trunc_index,
+                return_hidden_states=return_latent,
+                prefix_hash=prefix_hash,
+                prompt_token_ids=prompt_token_ids,
+                stopping_criteria=hf_generate_kwargs.get("stopping_criteria"),
+                **sampling_kwargs,
+            )
+            if return_latent:
+                output, hidden_states = output
+                latent = self.final_norm(pad_sequence(hidden_states, batch_first=True))
+        # Use accel engine if available (single sequence only). With the scheduler, the engine (KV cache and
+        # forward context) belongs to the scheduler thread, the other calls fall back to HF generate
+        elif use_accel and self.accel_scheduler is None:
             output = self.accel_engine.generate(
                 inputs,  # fake input_ids (all 1s + start_mel_token)
                 max_new_tokens=max_length - trunc_index,
                 attention_mask=attention_mask,
-                temperature=hf_generate_kwargs.get('temperature', 1),
                 stop_tokens=[self.stop_mel_token],
                 tts_embeddings=inputs_embeds,  # [pad][cond][text] embeddings (87 tokens, NO start_mel_token)
                 tts_mel_embedding=self.inference_model.embeddings,  # mel_embedding layer
                 tts_text_pos_embedding=self.inference_model.text_pos_embedding,  # text_pos_embedding layer
+                return_hidden_states=return_latent,
+                prompt_token_ids=prompt_token_ids,
+                prefix_hash=prefix_hash,
+                stopping_criteria=hf_generate_kwargs.get("stopping_criteria"),
+                **sampling_kwargs,
             )
+            if return_latent:
+                output, hidden_states = output
+                latent = self.final_norm(pad_sequence(hidden_states, batch_first=True))
         else:
-            output = self.inference_model.generate(inputs, 
-                                                bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
-                                                eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
-                                                max_length=max_length, logits_processor=logits_processor,
-                                                num_return_sequences=num_return_sequences,
-                                                **hf_generate_kwargs)
+            # the beam indices are required to pick the hidden states of the returned beams
+            sequences_only = False
+            if return_latent and hf_generate_kwargs.get("num_beams", 1) > 1 \
+                    and not (hf_generate_kwargs.get("return_dict_in_generate") and hf_generate_kwargs.get("output_scores")):
+                sequences_only = not hf_generate_kwargs.get("return_dict_in_generate", False)
+                hf_generate_kwargs["return_dict_in_generate"] = True
+                hf_generate_kwargs["output_scores"] = True
+            self.inference_model.collect_hidden_states = return_latent
+            self.inference_model.collected_hidden_states = []
+            try:
+                output = self.inference_model.generate(inputs, 
+                                                    bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
+                                                    eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
+                                                    max_length=max_length, logits_processor=logits_processor,
+                                                    num_return_sequences=num_return_sequences,
+                                                    **hf_generate_kwargs)
+                if return_latent:
+                    latent = self._gather_generation_latent(self.inference_model.collected_hidden_states,
+                                                            getattr(output, "beam_indices", None))
+            finally:
+                self.inference_model.collect_hidden_states = False
+                self.inference_model.collected_hidden_states = []
+            if sequences_only:
+                output = output.sequences
         if isinstance(output, torch.Tensor):
-            return output[:, trunc_index:], speech_conditioning_latent
-        # GenerateOutput
-        output.sequences = output.sequences[:, trunc_index:]
+            output = output[:, trunc_index:]
+        else:
+            # GenerateOutput
+            output.sequences = output.sequences[:, trunc_index:]
+        if return_latent:
+            return output, speech_conditioning_latent, latent
         return output, speech_conditioning_latent
 
+    def _gather_generation_latent(self, collected_hidden_states, beam_indices=None):
+        """
+        Args:
+            collected_hidden_states: the hidden states of each generation step, [(b * num_beams, 1, dim)]
+            beam_indices: the row of the batch which produced each token of the returned sequences, (n, steps),
+                -1 after the end of the sequence. None if not using beam search.
+        Returns:
+            final_norm latent of the returned sequences, (n, steps, dim)
+        """
+        hidden_states = torch.cat(collected_hidden_states, dim=1)  # (b * num_beams, steps, dim)
+        if beam_indices is not None:
+            steps = min(beam_indices.size(1), hidden_states.size(1))
+            beam_indices = beam_indices[:, :steps].to(hidden_states.device)
+            padding_mask = beam_indices < 0
+            step_indices = torch.arange(steps, device=hidden_states.device).unsqueeze(0).expand_as(beam_indices)
+            hidden_states = hidden_states[beam_indices.clamp(min=0), step_indices]
+            hidden_states = hidden_states.masked_fill(padding_mask.unsqueeze(-1), 0.0)
+        return self.final_norm(hidden_states)
+
     def get_emovec(self, emo_speech_conditioning_latent, emo_cond_lengths):
         emo_vec_syn_ori = self.get_emo_conditioning(emo_speech_conditioning_latent.transpose(1,2), emo_cond_lengths)
         emo_vec_syn = self.emovec_layer(emo_vec_syn_ori)
@@ -97,7 +97,8 @@ class IndexTTS:
 
             self.gpt.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=True, half=True)
         else:
-            self.gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=False, half=False)
+            # the KV cache keeps the decode step cost flat in fp32 as well, instead of re-running the whole prefix
+            self.gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=True, half=False)
 
         if self.use_cuda_kernel:
             # preload the CUDA kernel for BigVGAN
@@ -127,10 +128,21 @@ class IndexTTS:
         # 缓存参考音频mel：
         self.cache_audio_prompt = None
         self.cache_cond_mel = None
+        # BigVGAN speaker embedding of cache_cond_mel
+        self.cache_speaker_embedding = None
         # 进度引用显示（可选）
         self.gr_progress = None
         self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
 
+    def _get_speaker_embedding(self, cond_mel):
+        """
+        BigVGAN (ECAPA-TDNN) speaker embedding of the reference mel, computed once per prompt audio
+        and cached alongside ``cache_cond_mel``.
+        """
+        if self.cache_speaker_embedding is None:
+            self.cache_speaker_embedding = self.bigvgan.speaker_embedding(cond_mel.transpose(1, 2))
+        return self.cache_speaker_embedding
+
     def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30):
         """
         Shrink special tokens (silent_token and stop_mel_token) in codes
@@ -246,6 +258,57 @@ class IndexTTS:
             return out_buckets
         return [outputs]
 
+    def bucket_segments_balanced(self, segments, bucket_max_size=4, row_cost=0.25) -> List[List[Dict]]:
+        """
+        Segment data bucketing that balances the padding waste against the batch size.
+
+        The segments are sorted by length and split into contiguous runs, minimizing the estimated decode cost:
+        a bucket of ``n`` segments runs about ``max_len`` decode steps, and each step costs
+        ``1 + row_cost * (n - 1)`` relative to a single segment. A short segment joins a long bucket when its
+        extra row is cheaper than decoding it on its own.
+        Args:
+            bucket_max_size: max number of segments in one bucket
+            row_cost: relative cost of one more row in a decode step, small on CPU with many threads,
+                      where the GPT step is bound by reading the weights rather than by the batch size
+        """
+        outputs: List[Dict] = []
+        for idx, sent in enumerate(segments):
+            if len(sent) == 0:
+                print(">> skip empty segment")
+                continue
+            outputs.append({"idx": idx, "sent": sent, "len": len(sent)})
+        if len(outputs) <= 1 or bucket_max_size <= 1:
+            return [[o] for o in outputs]
+        outputs.sort(key=lambda x: x["len"])
+        # costs[j]: min cost of the first j segments, splits[j]: start of the last bucket
+        costs = [0.0] + [float("inf")] * len(outputs)
+        splits = [0] * (len(outputs) + 1)
+        for j in range(1, len(outputs) + 1):
+            max_len = outputs[j - 1]["len"]
+            for i in range(max(0, j - bucket_max_size), j):
+                cost = costs[i] + max_len * (1 + row_cost * (j - i - 1))
+                if cost < costs[j]:
+                    costs[j] = cost
+                    splits[j] = i
+        buckets: List[List[Dict]] = []
+        j = len(outputs)
+        while j > 0:
+            buckets.append(outputs[splits[j]:j])
+            j = splits[j]
+        buckets.reverse()
+        return buckets
+
+    def cpu_bucket_params(self, segments_bucket_max_size=4):
+        """
+        Bucket size and row cost of `bucket_segments_balanced` for the current number of CPU threads.
+        Batched GEMMs keep more cores busy, but past ~2 threads per row a decode step gets compute bound,
+        and a bigger batch only adds padding.
+        """
+        num_threads = max(1, torch.get_num_threads())
+        bucket_max_size = max(1, min(segments_bucket_max_size, num_threads // 2))
+        row_cost = min(1.0, 2.0 / num_threads)
+        return bucket_max_size, row_cost
+
     def pad_tokens_cat(self, tokens: List[torch.Tensor]) -> torch.Tensor:
         if self.model_version and self.model_version >= 1.5:
             # 1.5版本以上，直接使用stop_text_token 右侧填充，填充到最大长度
@@ -290,6 +353,7 @@ class IndexTTS:
             ``segments_bucket_max_size``: 分句分桶的最大容量，默认``4``，可以根据GPU内存调整
                 - 越大，bucket数量越少，batch越多，推理速度越*快*，占用内存更多，可能影响质量
                 - 越小，bucket数量越多，batch越少，推理速度越*慢*，占用内存和质量更接近于非快速推理
+                - CPU上同时受限于``torch.get_num_threads() // 2``，并按填充浪费与batch大小的代价分桶
         """
         print(">> starting fast inference...")
 
@@ -321,6 +385,7 @@ class IndexTTS:
 
             self.cache_audio_prompt = audio_prompt
             self.cache_cond_mel = cond_mel
+            self.cache_speaker_embedding = None
         else:
             cond_mel = self.cache_cond_mel
             cond_mel_frame = cond_mel.shape[-1]
@@ -359,8 +424,13 @@ class IndexTTS:
         # text processing
         all_text_tokens: List[List[torch.Tensor]] = []
         self._set_gr_progress(0.1, "text processing...")
-        bucket_max_size = segments_bucket_max_size if self.device != "cpu" else 1
-        all_segments = self.bucket_segments(segments, bucket_max_size=bucket_max_size)
+        if self.device == "cpu":
+            bucket_max_size, row_cost = self.cpu_bucket_params(segments_bucket_max_size)
+            all_segments = self.bucket_segments_balanced(segments, bucket_max_size=bucket_max_size,
+                                                         row_cost=row_cost)
+        else:
+            bucket_max_size = segments_bucket_max_size
+            all_segments = self.bucket_segments(segments, bucket_max_size=bucket_max_size)
         bucket_count = len(all_segments)
         if verbose:
             print(">> segments bucket_count:", bucket_count,
@@ -473,7 +543,7 @@ class IndexTTS:
             with torch.no_grad():
                 with torch.amp.autocast(latent.device.type, enabled=self.dtype is not None, dtype=self.dtype):
                     m_start_time = time.perf_counter()
-                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
+                    wav, _ = self.bigvgan(latent, speaker_embedding=self._get_speaker_embedding(auto_conditioning))
                     bigvgan_time += time.perf_counter() - m_start_time
                     wav = wav.squeeze(1)
                     pass
@@ -538,6 +608,7 @@ class IndexTTS:
 
             self.cache_audio_prompt = audio_prompt
             self.cache_cond_mel = cond_mel
+            self.cache_speaker_embedding = None
         else:
             cond_mel = self.cache_cond_mel
             cond_mel_frame = cond_mel.shape[-1]
@@ -643,7 +714,7 @@ class IndexTTS:
                     gpt_forward_time += time.perf_counter() - m_start_time
 
                     m_start_time = time.perf_counter()
-                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
+                    wav, _ = self.bigvgan(latent, speaker_embedding=self._get_speaker_embedding(auto_conditioning))
                     bigvgan_time += time.perf_counter() - m_start_time
                     wav = wav.squeeze(1)
 
@@ -3,8 +3,14 @@ from subprocess import CalledProcessError
 
 os.environ['HF_HUB_CACHE'] = './checkpoints/hf_cache'
 import json
+import math
+import queue
 import re
+import threading
 import time
+import traceback
+from typing import Dict, List
+
 import librosa
 import torch
 import torchaudio
@@ -21,9 +27,13 @@ from indextts.gpt.model_v2 import UnifiedVoice
 from indextts.utils.maskgct_utils import build_semantic_model, build_semantic_codec
 from indextts.utils.checkpoint import load_checkpoint
 from indextts.utils.front import TextNormalizer, TextTokenizer
+from indextts.utils.cond_cache import ConditioningCache
+from indextts.utils.voice_pack import VoicePack
+from indextts.utils.pipeline import StagePipeline
 
 from indextts.s2mel.modules.commons import load_checkpoint2, MyModel
-from indextts.s2mel.modules.bigvgan import bigvgan
+from indextts.s2mel.modules.bigvgan.chunked import ChunkedVocoder
+from indextts.s2mel.modules.vocoder import build_vocoder
 from indextts.s2mel.modules.campplus.DTDNN import CAMPPlus
 from indextts.s2mel.modules.audio import mel_spectrogram
 
@@ -32,13 +42,16 @@ from modelscope import AutoModelForCausalLM
 from huggingface_hub import hf_hub_download
 import safetensors
 from transformers import SeamlessM4TFeatureExtractor
+from transformers.generation.streamers import BaseStreamer
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
 import random
 import torch.nn.functional as F
 
 class IndexTTS2:
     def __init__(
             self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", use_fp16=False, device=None,
-            use_cuda_kernel=None,use_deepspeed=False, use_accel=False, use_torch_compile=False
+            use_cuda_kernel=None,use_deepspeed=False, use_accel=False, use_torch_compile=False,
+            cond_cache_dir=None, cond_cache_max_mb=512, use_continuous_batching=False
     ):
         """
         Args:
@@ -50,6 +63,11 @@ class IndexTTS2:
             use_deepspeed (bool): whether to use DeepSpeed or not.
             use_accel (bool): whether to use acceleration engine for GPT2 or not.
             use_torch_compile (bool): whether to use torch.compile for optimization or not.
+            cond_cache_dir (None | str): directory of the persistent speaker/emotion conditioning cache (safetensors),
+                shared by the workers. If None, the conditioning is only cached in memory.
+            cond_cache_max_mb (int): memory budget in MB of the in-memory conditioning cache.
+            use_continuous_batching (bool): share the GPT decode steps of the concurrent requests (from different threads),
+                requires ``use_accel``.
         """
         if device is not None:
             self.device = device
@@ -100,6 +118,12 @@ class IndexTTS2:
                 print(f">> Failed to load DeepSpeed. Falling back to normal inference. Error: {e}")
 
         self.gpt.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=True, half=self.use_fp16)
+        if use_continuous_batching:
+            if self.gpt.accel_engine is not None:
+                self.gpt.enable_continuous_batching()
+                print(">> GPT continuous batching enabled")
+            else:
+                print(">> Continuous batching requires `use_accel=True`, disabled.")
 
         if self.use_cuda_kernel:
             # preload the CUDA kernel for BigVGAN
@@ -159,12 +183,16 @@ class IndexTTS2:
         self.campplus_model.eval()
         print(">> campplus_model weights restored from:", campplus_ckpt_path)
 
-        bigvgan_name = self.cfg.vocoder.name
-        self.bigvgan = bigvgan.BigVGAN.from_pretrained(bigvgan_name, use_cuda_kernel=self.use_cuda_kernel)
-        self.bigvgan = self.bigvgan.to(self.device)
-        self.bigvgan.remove_weight_norm()
-        self.bigvgan.eval()
-        print(">> bigvgan weights restored from:", bigvgan_name)
+        # mel -> wav, by `cfg.vocoder.type`: bigvgan (default), vocos or hifigan
+        self.vocoder = build_vocoder(self.cfg.vocoder, self.model_dir, use_cuda_kernel=self.use_cuda_kernel,
+                                     use_cpu_kernel=self.device == "cpu")
+        self.vocoder = self.vocoder.to(self.device)
+        self.bigvgan = self.vocoder  # backward compatibility
+        # incremental vocoding of long mels, see `_vocode_stream()`
+        self.chunked_vocoder = ChunkedVocoder(
+            self.vocoder, hop_length=self.cfg.s2mel['preprocess_params']['spect_params']['hop_length'])
+        # latency of the last `infer_stream()`
+        self.stream_metrics = {}
 
         self.bpe_path = os.path.join(self.model_dir, self.cfg.dataset["bpe_model"])
         self.normalizer = TextNormalizer(enable_glossary=True)
@@ -201,19 +229,19 @@ class IndexTTS2:
         }
         self.mel_fn = lambda x: mel_spectrogram(x, **mel_fn_args)
 
-        # 缓存参考音频：
-        self.cache_spk_cond = None
-        self.cache_s2mel_style = None
-        self.cache_s2mel_prompt = None
-        self.cache_spk_audio_prompt = None
-        self.cache_emo_cond = None
-        self.cache_emo_audio_prompt = None
-        self.cache_mel = None
-
         # 进度引用显示（可选）
         self.gr_progress = None
         self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
 
+        # 缓存参考音频：按音频内容哈希缓存条件特征(内存LRU + 可选的磁盘safetensors)
+        self.cond_cache = ConditioningCache(cache_dir=cond_cache_dir,
+                                            max_bytes=int(cond_cache_max_mb * 1024 * 1024),
+                                            device=self.device)
+        self.voice_packs = []
+        if cond_cache_dir:
+            loaded = self.cond_cache.preload(prefix=self._cond_cache_prefix())
+            print(f">> conditioning cache loaded from {cond_cache_dir}: {loaded} entries")
+
     @torch.no_grad()
     def get_emb(self, input_features, attention_mask):
         vq_emb = self.semantic_model(
@@ -353,19 +381,1169 @@ class IndexTTS2:
 
         return emo_vector
 
+    def _resolve_emo_inputs(self, spk_audio_prompt, text, emo_audio_prompt=None, emo_alpha=1.0,
+                            emo_vector=None, use_emo_text=False, emo_text=None):
+        """
+        Decide which emotion source is used for the current request.
+        Returns: (emo_audio_prompt, emo_alpha, emo_vector)
+        """
+        if use_emo_text or emo_vector is not None:
+            # we're using a text or emotion vector guidance; so we must remove
+            # "emotion reference voice", to ensure we use correct emotion mixing!
+            emo_audio_prompt = None
+
+        if use_emo_text:
+            # automatically generate emotion vectors from text prompt
+            if emo_text is None:
+                emo_text = text  # use main text prompt
+            emo_dict = self.qwen_emo.inference(emo_text)
+            print(f"detected emotion vectors from text: {emo_dict}")
+            # convert ordered dict to list of vectors; the order is VERY important!
+            emo_vector = list(emo_dict.values())
+
+        if emo_vector is not None:
+            # we have emotion vectors; they can't be blended via alpha mixing
+            # in the main inference process later, so we must pre-calculate
+            # their new strengths here based on the alpha instead!
+            emo_vector_scale = max(0.0, min(1.0, emo_alpha))
+            if emo_vector_scale != 1.0:
+                # scale each vector and truncate to 4 decimals (for nicer printing)
+                emo_vector = [int(x * emo_vector_scale * 10000) / 10000 for x in emo_vector]
+                print(f"scaled emotion vectors to {emo_vector_scale}x: {emo_vector}")
+
+        if emo_audio_prompt is None:
+            # we are not using any external "emotion reference voice"; use
+            # speaker's voice as the main emotion reference audio.
+            emo_audio_prompt = spk_audio_prompt
+            # must always use alpha=1.0 when we don't have an external reference voice
+            emo_alpha = 1.0
+        return emo_audio_prompt, emo_alpha, emo_vector
+
+    def _cond_cache_prefix(self):
+        return f"v{self.model_version or 2}_"
+
+    def _lookup_conditioning(self, kind, audio_path):
+        """
+        Look up the conditioning of the audio in the conditioning cache, then in the loaded voice packs.
+        Returns: (cache_key, tensors or None)
+        """
+        digest = self.cond_cache.hash_audio(audio_path)
+        cache_key = f"{self._cond_cache_prefix()}{kind}_{digest}"
+        cached = self.cond_cache.get(cache_key)
+        if cached is None:
+            for pack in self.voice_packs:
+                cached = pack.get(digest, kind)
+                if cached is not None:
+                    # already persisted in the pack
+                    self.cond_cache.put(cache_key, cached, persist=False)
+                    break
+        return cache_key, cached
+
+    def load_voice_pack(self, pack_path):
+        """
+        Load a voice pack built by ``indextts/voicepack_cli.py``, the voices in the pack skip the audio encoders.
+        """
+        pack = VoicePack(pack_path, device=self.device)
+        if pack.model_version != str(self.model_version):
+            warnings.warn(f"voice pack {pack_path} was built with model version {pack.model_version}, "
+                          f"but the current model version is {self.model_version}", category=RuntimeWarning)
+        self.voice_packs.append(pack)
+        print(f">> voice pack loaded from {pack_path}: {len(pack)} voices")
+        return pack
+
+    @torch.no_grad()
+    def _compute_spk_conditioning(self, spk_audio_prompt, verbose=False) -> Dict[str, torch.Tensor]:
+        """
+        Run the audio encoders on the speaker prompt audio.
+        Returns: {"spk_cond_emb", "S_ref", "ref_mel", "style", "prompt_condition"}
+        """
+        audio,sr = self._load_and_cut_audio(spk_audio_prompt,15,verbose)
+        audio_22k = torchaudio.transforms.Resample(sr, 22050)(audio)
+        audio_16k = torchaudio.transforms.Resample(sr, 16000)(audio)
+
+        inputs = self.extract_features(audio_16k, sampling_rate=16000, return_tensors="pt")
+        input_features = inputs["input_features"]
+        attention_mask = inputs["attention_mask"]
+        input_features = input_features.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        spk_cond_emb = self.get_emb(input_features, attention_mask)
+
+        _, S_ref = self.semantic_codec.quantize(spk_cond_emb)
+        ref_mel = self.mel_fn(audio_22k.to(spk_cond_emb.device).float())
+        ref_target_lengths = torch.LongTensor([ref_mel.size(2)]).to(ref_mel.device)
+        feat = torchaudio.compliance.kaldi.fbank(audio_16k.to(ref_mel.device),
+                                                 num_mel_bins=80,
+                                                 dither=0,
+                                                 sample_frequency=16000)
+        feat = feat - feat.mean(dim=0, keepdim=True)  # feat2另外一个滤波器能量组特征[922, 80]
+        style = self.campplus_model(feat.unsqueeze(0))  # 参考音频的全局style2[1,192]
+
+        prompt_condition = self.s2mel.models['length_regulator'](S_ref,
+                                                                 ylens=ref_target_lengths,
+                                                                 n_quantizers=3,
+                                                                 f0=None)[0]
+        return {
+            "spk_cond_emb": spk_cond_emb,
+            "S_ref": S_ref,
+            "ref_mel": ref_mel,
+            "style": style,
+            "prompt_condition": prompt_condition,
+        }
+
+    @torch.no_grad()
+    def _compute_emo_conditioning(self, emo_audio_prompt, verbose=False) -> torch.Tensor:
+        """
+        Run the w2v-BERT encoder on the emotion reference audio.
+        """
+        emo_audio, _ = self._load_and_cut_audio(emo_audio_prompt,15,verbose,sr=16000)
+        emo_inputs = self.extract_features(emo_audio, sampling_rate=16000, return_tensors="pt")
+        emo_input_features = emo_inputs["input_features"]
+        emo_attention_mask = emo_inputs["attention_mask"]
+        emo_input_features = emo_input_features.to(self.device)
+        emo_attention_mask = emo_attention_mask.to(self.device)
+        return self.get_emb(emo_input_features, emo_attention_mask)
+
+    @torch.no_grad()
+    def _compute_gpt_conditioning(self, spk_cond_emb) -> torch.Tensor:
+        """
+        GPT speaker conditioning latent (conformer + perceiver) of ``spk_cond_emb``, in shape [1, 32, dim]
+        """
+        with torch.amp.autocast(spk_cond_emb.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+            return self.gpt.get_conditioning(spk_cond_emb.transpose(1, 2),
+                                             torch.tensor([spk_cond_emb.shape[-1]], device=spk_cond_emb.device))
+
+    def _get_spk_conditioning(self, spk_audio_prompt, verbose=False):
+        """
+        Speaker conditioning of the prompt audio, reuses the cache if the prompt audio content is already known.
+        Returns: (spk_cond_emb, style, prompt_condition, ref_mel)
+        """
+        # 如果参考音频改变了，才需要重新生成, 提升速度
+        cache_key, cached = self._lookup_conditioning("spk", spk_audio_prompt)
+        if cached is not None:
+            if verbose:
+                print(f">> speaker conditioning cache hit: {spk_audio_prompt}")
+        else:
+            cached = self._compute_spk_conditioning(spk_audio_prompt, verbose)
+            self.cond_cache.put(cache_key, cached)
+        return cached["spk_cond_emb"], cached["style"], cached["prompt_condition"], cached["ref_mel"]
+
+    def _get_emo_conditioning(self, emo_audio_prompt, verbose=False):
+        """
+        Emotion conditioning of the emotion reference audio, reuses the cache if the audio content is already known.
+        """
+        cache_key, cached = self._lookup_conditioning("emo", emo_audio_prompt)
+        if cached is None:
+            cached = {"emo_cond_emb": self._compute_emo_conditioning(emo_audio_prompt, verbose)}
+            self.cond_cache.put(cache_key, cached)
+        return cached["emo_cond_emb"]
+
+    def _get_gpt_conditioning(self, spk_audio_prompt, spk_cond_emb):
+        """
+        GPT speaker conditioning latent, cached per voice like the speaker conditioning.
+        """
+        cache_key, cached = self._lookup_conditioning("gpt", spk_audio_prompt)
+        if cached is None:
+            cached = {"gpt_cond_latent": self._compute_gpt_conditioning(spk_cond_emb)}
+            self.cond_cache.put(cache_key, cached)
+        return cached["gpt_cond_latent"]
+
+    @torch.no_grad()
+    def _get_prompt_cond(self, spk_audio_prompt, prompt_condition, ref_mel, style):
+        """
+        DiT condition of the speaker prompt frames (``DiT.precompute_condition``), cached per voice in memory,
+        so that the CFM of each segment only projects the frames of the segment.
+        Returns: [1, prompt frames, dim], or None if the CFM can't reuse it
+        """
+        cfm = self.s2mel.models['cfm']
+        precompute_condition = getattr(cfm.estimator, "precompute_condition", None)
+        if precompute_condition is None or cfm.zero_prompt_speech_token:
+            return None
+        cache_key = f"{self._cond_cache_prefix()}dit_{self.cond_cache.hash_audio(spk_audio_prompt)}"
+        cached = self.cond_cache.get(cache_key)
+        if cached is None:
+            cached = {"prompt_cond": precompute_condition(ref_mel, style, prompt_condition)}
+            # depends on the s2mel weights, not persisted with the audio encoder outputs
+            self.cond_cache.put(cache_key, cached, persist=False)
+        return cached["prompt_cond"]
+
+    @torch.no_grad()
+    def _merge_emovec(self, spk_cond_emb, emo_cond_emb, emo_alpha=1.0, emo_vector=None, style=None, use_random=False):
+        """
+        The emotion vector of the request, shared by all the segments.
+        """
+        if emo_vector is not None:
+            weight_vector, emovec_mat = self._get_emovec_mat(emo_vector, style, use_random)
+        with torch.amp.autocast(spk_cond_emb.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+            emovec = self.gpt.merge_emovec(
+                spk_cond_emb,
+                emo_cond_emb,
+                torch.tensor([spk_cond_emb.shape[-1]], device=spk_cond_emb.device),
+                torch.tensor([emo_cond_emb.shape[-1]], device=spk_cond_emb.device),
+                alpha=emo_alpha
+            )
+            if emo_vector is not None:
+                emovec = emovec_mat + (1 - torch.sum(weight_vector)) * emovec
+                # emovec = emovec_mat
+        return emovec
+
+    def _get_emovec_mat(self, emo_vector, style, use_random=False):
+        """
+        Mix the emotion matrix by the emotion vector.
+        Returns: (weight_vector, emovec_mat)
+        """
+        weight_vector = torch.tensor(emo_vector, device=self.device)
+        if use_random:
+            random_index = [random.randint(0, x - 1) for x in self.emo_num]
+        else:
+            random_index = [find_most_similar_cosine(style, tmp) for tmp in self.spk_matrix]
+
+        emo_matrix = [tmp[index].unsqueeze(0) for index, tmp in zip(random_index, self.emo_matrix)]
+        emo_matrix = torch.cat(emo_matrix, 0)
+        emovec_mat = weight_vector.unsqueeze(1) * emo_matrix
+        emovec_mat = torch.sum(emovec_mat, 0)
+        emovec_mat = emovec_mat.unsqueeze(0)
+        return weight_vector, emovec_mat
+
+    def _trim_codes(self, codes: torch.Tensor):
+        """
+        Cut off the codes after the first stop_mel_token.
+        codes: [B, T]
+        Returns: (codes, code_lens)
+        """
+        code_lens = []
+        max_code_len = 0
+        for code in codes:
+            if self.stop_mel_token not in code:
+                code_len = len(code)
+            else:
+                len_ = (code == self.stop_mel_token).nonzero(as_tuple=False)[0]
+                code_len = len_[0].item() if len_.numel() > 0 else len(code)
+            code_lens.append(code_len)
+            max_code_len = max(max_code_len, code_len)
+        codes = codes[:, :max_code_len]
+        code_lens = torch.LongTensor(code_lens)
+        code_lens = code_lens.to(self.device)
+        return codes, code_lens
+
+    def _gpt_latent(self, speech_conditioning_latent, text_tokens, codes, spk_cond_emb, emo_cond_emb, emovec):
+        """
+        GPT latent of the generated codes, used as input of the s2mel `gpt_layer`.
+        """
+        use_speed = torch.zeros(spk_cond_emb.size(0)).to(spk_cond_emb.device).long()
+        with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+            latent = self.gpt(
+                speech_conditioning_latent,
+                text_tokens,
+                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device),
+                codes,
+                torch.tensor([codes.shape[-1]], device=text_tokens.device),
+                emo_cond_emb,
+                cond_mel_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
+                emo_cond_mel_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
+                emo_vec=emovec,
+                use_speed=use_speed,
+            )
+        return latent
+
+    @staticmethod
+    def _pop_s2mel_kwargs(generation_kwargs):
+        """
+        Pop the s2mel (CFM) options from the ``infer()`` kwargs:
+            diffusion_steps: number of the ODE steps, default 25
+            inference_cfg_rate: classifier-free guidance rate, default 0.7, 0 to disable
+            ode_solver: "euler" (default), "midpoint", "heun" or "rk4"
+            sway_coefficient: sway sampling of the time steps, e.g. -1.0, default None (uniform steps)
+            cfg_interval: (t_start, t_end) of the classifier-free guidance, e.g. (0.0, 0.5), default None (all steps)
+        e.g. ``diffusion_steps=10, ode_solver="heun", sway_coefficient=-1.0`` is 20 DiT evaluations instead of 25.
+        """
+        return dict(
+            diffusion_steps=int(generation_kwargs.pop("diffusion_steps", 25)),
+            inference_cfg_rate=float(generation_kwargs.pop("inference_cfg_rate", 0.7)),
+            solver=generation_kwargs.pop("ode_solver", "euler"),
+            sway_coefficient=generation_kwargs.pop("sway_coefficient", None),
+            cfg_interval=generation_kwargs.pop("cfg_interval", None),
+        )
+
+    def _length_regulate(self, latent, codes, code_lens):
+        """
+        Semantic codes + GPT latent -> the s2mel condition at the mel frame rate, in shape [1, frames, dim]
+        """
+        latent = self.s2mel.models['gpt_layer'](latent)
+        S_infer = self.semantic_codec.quantizer.vq2emb(codes.unsqueeze(1))
+        S_infer = S_infer.transpose(1, 2)
+        S_infer = S_infer + latent
+        target_lengths = (code_lens * 1.72).long()
+        return self.s2mel.models['length_regulator'](S_infer,
+                                                     ylens=target_lengths,
+                                                     n_quantizers=3,
+                                                     f0=None)[0]
+
+    def _s2mel(self, latent, codes, code_lens, prompt_condition, ref_mel, style,
+               diffusion_steps=25, inference_cfg_rate=0.7, **cfm_kwargs):
+        """
+        Semantic codes + GPT latent -> mel spectrogram of the target speech (without the prompt).
+        cfm_kwargs: ``solver``, ``sway_coefficient`` and ``prompt_cond`` (see ``_get_prompt_cond()``) of the CFM inference
+        """
+        cond = self._length_regulate(latent, codes, code_lens)
+        cat_condition = torch.cat([prompt_condition, cond], dim=1)
+        vc_target = self.s2mel.models['cfm'].inference(cat_condition,
+                                                       torch.LongTensor([cat_condition.size(1)]).to(
+                                                           cond.device),
+                                                       ref_mel, style, None, diffusion_steps,
+                                                       inference_cfg_rate=inference_cfg_rate,
+                                                       **cfm_kwargs)
+        vc_target = vc_target[:, :, ref_mel.size(-1):]
+        return vc_target
+
+    def _vocode(self, vc_target):
+        """
+        Mel spectrogram -> waveform, in shape [1, T]
+        """
+        wav = self.vocoder(vc_target.float()).squeeze().unsqueeze(0)
+        wav = wav.squeeze(1)
+        return wav
+
+    def _vocode_stream(self, vc_target, chunk_frames=None):
+        """
+        Chunked ``_vocode()``: yields the waveform in pieces of about ``chunk_frames`` mel frames, in shape [1, T_i].
+        The concatenation of the pieces is the same as ``_vocode()`` up to float rounding.
+        """
+        for wav in self.chunked_vocoder.stream(vc_target.float(), chunk_frames):
+            yield wav.squeeze(1)
+
+    def _vocode_stream_pieces(self, mel_pieces, chunk_frames=None):
+        """
+        ``_vocode_stream()`` of a mel spectrogram which arrives in pieces, e.g. from ``_s2mel_stream()``:
+        the waveform is yielded as soon as the right context of a chunk is available.
+        """
+        mel_pieces = (mel.float() for mel in mel_pieces)
+        for wav in self.chunked_vocoder.stream_pieces(mel_pieces, chunk_frames):
+            yield wav.squeeze(1)
+
+    def _s2mel_continue(self, latent, codes, code_lens, prompt_condition, ref_mel, style, context_cond=None,
+                        context_mel=None, diffusion_steps=25, inference_cfg_rate=0.7, **cfm_kwargs):
+        """
+        ``_s2mel()`` of the next chunk of codes of a segment. The condition ``context_cond`` [1, T, dim] and the mel
+        ``context_mel`` [1, 80, T] of the previous chunks are appended to the speaker prompt, so that the CFM
+        continues the speech generated so far instead of starting over.
+        Returns: (mel of the chunk [1, 80, frames], condition of the chunk [1, frames, dim])
+        """
+        cond = self._length_regulate(latent, codes, code_lens)
+        if context_cond is not None:
+            prompt_condition = torch.cat([prompt_condition, context_cond], dim=1)
+            ref_mel = torch.cat([ref_mel, context_mel], dim=-1)
+        cat_condition = torch.cat([prompt_condition, cond], dim=1)
+        vc_target = self.s2mel.models['cfm'].inference(cat_condition,
+                                                       torch.LongTensor([cat_condition.size(1)]).to(cond.device),
+                                                       ref_mel, style, None, diffusion_steps,
+                                                       inference_cfg_rate=inference_cfg_rate,
+                                                       **cfm_kwargs)
+        return vc_target[:, :, ref_mel.size(-1):], cond
+
+    def _stream_codes(self, text_tokens, spk_cond_emb, emo_cond_emb, emovec, speech_conditioning_latent,
+                      chunk_tokens=40, **gpt_kwargs):
+        """
+        Run the GPT generation on a background thread, and yield the codes [1, n_i] as soon as ``chunk_tokens``
+        new codes are generated, up to the stop_mel_token.
+        The accel engine and the beam search can't stream: their codes are yielded at once after the generation.
+        When the generator is closed early (e.g. the client disconnects), the generation is cancelled and the thread
+        is joined before returning, so that it doesn't keep running on the GPT.
+        gpt_kwargs: the kwargs of ``inference_speech()``
+        """
+        streamer = CodeStreamer()
+        use_streamer = self.gpt.accel_engine is None and gpt_kwargs.get("num_beams", 1) == 1
+        result = {}
+        cancel = threading.Event()
+        stopping_criteria = StoppingCriteriaList(gpt_kwargs.pop("stopping_criteria", None) or [])
+        stopping_criteria.append(CancelCriteria(cancel))
+
+        def generate():
+            try:
+                with torch.no_grad():
+                    with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        result["outputs"] = self.gpt.inference_speech(
+                            spk_cond_emb,
+                            text_tokens,
+                            emo_cond_emb,
+                            cond_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
+                            emo_cond_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
+                            emo_vec=emovec,
+                            speech_conditioning_latent=speech_conditioning_latent,
+                            streamer=streamer if use_streamer else None,
+                            stopping_criteria=stopping_criteria,
+                            **gpt_kwargs
+                        )
+            except BaseException as e:
+                result["error"] = e
+            finally:
+                streamer.end()
+
+        thread = threading.Thread(target=generate, name="gpt-stream", daemon=True)
+        thread.start()
+        emitted = 0
+        pending = []
+        completed = False
+        try:
+            for token in streamer:
+                if token == self.stop_mel_token:
+                    break
+                pending.append(token)
+                if len(pending) >= chunk_tokens:
+                    yield torch.tensor([pending], dtype=torch.long, device=text_tokens.device)
+                    emitted += len(pending)
+                    pending = []
+            completed = True
+        finally:
+            if not completed:
+                # GeneratorExit or an error of the consumer: stop the generation at the next step
+                cancel.set()
+            thread.join()
+        if "error" in result:
+            raise result["error"]
+        codes = result["outputs"][0]
+        if (codes[:, -1] != self.stop_mel_token).any():
+            warnings.warn(
+                f"WARN: generation stopped due to exceeding `max_mel_tokens` ({gpt_kwargs.get('max_generate_length')}). "
+                f"Input text tokens: {text_tokens.shape[1]}.",
+                category=RuntimeWarning
+            )
+        codes, _ = self._trim_codes(codes)
+        # the codes which are not yielded yet: the last chunk, or all of them without the streamer
+        codes = codes[:, emitted:]
+        if codes.size(-1) > 0:
+            yield codes
+
+    def _s2mel_stream(self, code_chunks, text_tokens, speech_conditioning_latent, emovec,
+                      prompt_condition, ref_mel, style, context_frames=100, **s2mel_kwargs):
+        """
+        Streaming ``_s2mel()`` of one segment: yields the mel spectrogram [1, 80, T_i] of each chunk of codes.
+        Each chunk continues the last ``context_frames`` frames of the previous chunks, see ``_s2mel_continue()``.
+        """
+        latent_state = None
+        context_cond = context_mel = None
+        for chunk in code_chunks:
+            with torch.no_grad():
+                # the GPT is causal: the latent of the earlier codes doesn't depend on the new ones,
+                # only the new codes are forwarded, with the KV cache of the earlier chunks
+                with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                    latent, latent_state = self.gpt.forward_latent_chunk(speech_conditioning_latent, text_tokens,
+                                                                         chunk, emovec, latent_state)
+                code_lens = torch.LongTensor([chunk.size(-1)]).to(chunk.device)
+                mel, cond = self._s2mel_continue(latent, chunk, code_lens, prompt_condition, ref_mel, style,
+                                                 context_cond, context_mel, **s2mel_kwargs)
+            yield mel
+            if context_frames > 0:
+                context_cond = cond if context_cond is None else torch.cat([context_cond, cond], dim=1)
+                context_mel = mel if context_mel is None else torch.cat([context_mel, mel], dim=-1)
+                context_cond = context_cond[:, -context_frames:]
+                context_mel = context_mel[:, :, -context_frames:]
+
+    def _s2mel_batch(self, latents: List[torch.Tensor], codes_list: List[torch.Tensor],
+                     code_lens_list: List[torch.Tensor], prompt_condition, ref_mel, style,
+                     diffusion_steps=25, inference_cfg_rate=0.7, **cfm_kwargs) -> List[torch.Tensor]:
+        """
+        Batched ``_s2mel()`` of several segments sharing the same speaker prompt.
+        The conditions are right padded and masked by ``x_lens``, so that a single CFM
+        pass is run for the whole batch instead of one pass per segment.
+        Returns: the mel spectrogram of each segment, in shape [1, 80, T_i]
+        """
+        if len(latents) == 1:
+            return [self._s2mel(latents[0], codes_list[0], code_lens_list[0], prompt_condition, ref_mel, style,
+                                diffusion_steps, inference_cfg_rate, **cfm_kwargs)]
+        conds = []
+        for latent, codes, code_lens in zip(latents, codes_list, code_lens_list):
+            # the length regulator interpolates to the max of ``ylens``, so it runs per segment
+            cond = self._length_regulate(latent, codes, code_lens)
+            conds.append(torch.cat([prompt_condition, cond], dim=1).squeeze(0))
+
+        batch_size = len(conds)
+        x_lens = torch.LongTensor([c.size(0) for c in conds]).to(prompt_condition.device)
+        cat_condition = pad_sequence(conds, batch_first=True, padding_value=0.0)
+        vc_target = self.s2mel.models['cfm'].inference(cat_condition,
+                                                       x_lens,
+                                                       ref_mel.expand(batch_size, -1, -1),
+                                                       style.expand(batch_size, -1),
+                                                       None, diffusion_steps,
+                                                       inference_cfg_rate=inference_cfg_rate,
+                                                       **cfm_kwargs)
+        prompt_len = ref_mel.size(-1)
+        return [vc_target[i:i + 1, :, prompt_len:x_lens[i]] for i in range(batch_size)]
+
+    def _vocode_batch(self, vc_targets: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        Batched ``_vocode()``, the mels are right padded with silence and the padded
+        samples are cut off from the waveforms.
+        Returns: the waveform of each mel, in shape [1, T_i]
+        """
+        if len(vc_targets) == 1:
+            return [self._vocode(vc_targets[0])]
+        hop_length = self.cfg.s2mel['preprocess_params']['spect_params']['hop_length']
+        mel_lens = [mel.size(-1) for mel in vc_targets]
+        # log(1e-5), the floor of the mel spectrogram
+        mels = pad_sequence([mel.squeeze(0).transpose(0, 1) for mel in vc_targets],
+                            batch_first=True, padding_value=math.log(1e-5)).transpose(1, 2)
+        wavs = self.vocoder(mels.float()).squeeze(1)
+        return [wavs[i:i + 1, :mel_len * hop_length] for i, mel_len in enumerate(mel_lens)]
+
+    def bucket_segments(self, segments, bucket_max_size=4) -> List[List[Dict]]:
+        """
+        Segment data bucketing.
+        if ``bucket_max_size=1``, return all segments in one bucket.
+        """
+        outputs: List[Dict] = []
+        for idx, sent in enumerate(segments):
+            outputs.append({"idx": idx, "sent": sent, "len": len(sent)})
+
+        if len(outputs) > bucket_max_size:
+            # split segments into buckets by segment length
+            buckets: List[List[Dict]] = []
+            factor = 1.5
+            last_bucket = None
+            last_bucket_sent_len_median = 0
+
+            for sent in sorted(outputs, key=lambda x: x["len"]):
+                current_sent_len = sent["len"]
+                if current_sent_len == 0:
+                    print(">> skip empty segment")
+                    continue
+                if last_bucket is None \
+                        or current_sent_len >= int(last_bucket_sent_len_median * factor) \
+                        or len(last_bucket) >= bucket_max_size:
+                    # new bucket
+                    buckets.append([sent])
+                    last_bucket = buckets[-1]
+                    last_bucket_sent_len_median = current_sent_len
+                else:
+                    # current bucket can hold more segments
+                    last_bucket.append(sent)  # sorted
+                    mid = len(last_bucket) // 2
+                    last_bucket_sent_len_median = last_bucket[mid]["len"]
+            last_bucket = None
+            # merge all buckets with size 1
+            out_buckets: List[List[Dict]] = []
+            only_ones: List[Dict] = []
+            for b in buckets:
+                if len(b) == 1:
+                    only_ones.append(b[0])
+                else:
+                    out_buckets.append(b)
+            if len(only_ones) > 0:
+                # merge into previous buckets if possible
+                for i in range(len(out_buckets)):
+                    b = out_buckets[i]
+                    if len(b) < bucket_max_size:
+                        b.append(only_ones.pop(0))
+                        if len(only_ones) == 0:
+                            break
+                # combined all remaining sized 1 buckets
+                if len(only_ones) > 0:
+                    out_buckets.extend(
+                        [only_ones[i:i + bucket_max_size] for i in range(0, len(only_ones), bucket_max_size)])
+            return out_buckets
+        return [outputs]
+
+    def bucket_segments_balanced(self, segments, bucket_max_size=4, row_cost=0.25) -> List[List[Dict]]:
+        """
+        Segment data bucketing that balances the padding waste against the batch size.
+
+        The segments are sorted by length and split into contiguous runs, minimizing the estimated decode cost:
+        a bucket of ``n`` segments runs about ``max_len`` decode steps, and each step costs
+        ``1 + row_cost * (n - 1)`` relative to a single segment. A short segment joins a long bucket when its
+        extra row is cheaper than decoding it on its own.
+        Args:
+            bucket_max_size: max number of segments in one bucket
+            row_cost: relative cost of one more row in a decode step, small on CPU with many threads,
+                      where the GPT step is bound by reading the weights rather than by the batch size
+        """
+        outputs: List[Dict] = []
+        for idx, sent in enumerate(segments):
+            if len(sent) == 0:
+                print(">> skip empty segment")
+                continue
+            outputs.append({"idx": idx, "sent": sent, "len": len(sent)})
+        if len(outputs) <= 1 or bucket_max_size <= 1:
+            return [[o] for o in outputs]
+        outputs.sort(key=lambda x: x["len"])
+        # costs[j]: min cost of the first j segments, splits[j]: start of the last bucket
+        costs = [0.0] + [float("inf")] * len(outputs)
+        splits = [0] * (len(outputs) + 1)
+        for j in range(1, len(outputs) + 1):
+            max_len = outputs[j - 1]["len"]
+            for i in range(max(0, j - bucket_max_size), j):
+                cost = costs[i] + max_len * (1 + row_cost * (j - i - 1))
+                if cost < costs[j]:
+                    costs[j] = cost
+                    splits[j] = i
+        buckets: List[List[Dict]] = []
+        j = len(outputs)
+        while j > 0:
+            buckets.append(outputs[splits[j]:j])
+            j = splits[j]
+        buckets.reverse()
+        return buckets
+
+    def cpu_bucket_params(self, segments_bucket_max_size=4):
+        """
+        Bucket size and row cost of `bucket_segments_balanced` for the current number of CPU threads.
+        Batched GEMMs keep more cores busy, but past ~2 threads per row a decode step gets compute bound,
+        and a bigger batch only adds padding.
+        """
+        num_threads = max(1, torch.get_num_threads())
+        bucket_max_size = max(1, min(segments_bucket_max_size, num_threads // 2))
+        row_cost = min(1.0, 2.0 / num_threads)
+        return bucket_max_size, row_cost
+
+    def pad_tokens_cat(self, tokens: List[torch.Tensor]) -> torch.Tensor:
+        """
+        Right pad the text tokens with stop_text_token to the max length, [1, N] -> [B, N]
+        """
+        tokens = [t.squeeze(0) for t in tokens]
+        return pad_sequence(tokens, batch_first=True, padding_value=self.cfg.gpt.stop_text_token,
+                            padding_side="right")
+
+    def _save_or_return(self, wav, output_path, sampling_rate):
+        wav = wav.cpu()  # to cpu
+        if output_path:
+            # 直接保存音频到指定路径中
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+                print(">> remove old wav file:", output_path)
+            if os.path.dirname(output_path) != "":
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
+            print(">> wav file saved to:", output_path)
+            return output_path
+        # 返回以符合Gradio的格式要求
+        wav_data = wav.type(torch.int16)
+        wav_data = wav_data.numpy().T
+        return (sampling_rate, wav_data)
+
+    # 快速推理：将长度相近的分句分桶，批量生成 GPT mel codes
+    def infer_fast(self, spk_audio_prompt, text, output_path,
+                   emo_audio_prompt=None, emo_alpha=1.0,
+                   emo_vector=None,
+                   use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
+                   verbose=False, max_text_tokens_per_segment=120, segments_bucket_max_size=4,
+                   s2mel_batch_size=4, **generation_kwargs):
+        """
+        Args:
+            ``segments_bucket_max_size``: 分句分桶的最大容量，默认``4``，可以根据GPU内存调整
+                - 越大，一次批量生成的分句越多，推理速度越*快*，占用内存更多
+                - 为``1``时与``infer``的逐句生成相同
+            ``s2mel_batch_size``: s2mel(CFM)与BigVGAN批量解码的最大分句数，默认``4``，CPU上按线程数限制，见``cpu_bucket_params``
+            ``reuse_gpt_latent`` (generation kwarg): 复用GPT生成时的隐状态作为latent，省去一次GPT前向，默认``False``
+            other args are the same as ``infer``.
+        """
+        print(">> starting fast inference...")
+        self._set_gr_progress(0, "starting fast inference...")
+        if verbose:
+            print(f"origin text:{text}, spk_audio_prompt:{spk_audio_prompt}, "
+                  f"emo_audio_prompt:{emo_audio_prompt}, emo_alpha:{emo_alpha}, "
+                  f"emo_vector:{emo_vector}, use_emo_text:{use_emo_text}, "
+                  f"emo_text:{emo_text}")
+        start_time = time.perf_counter()
+
+        emo_audio_prompt, emo_alpha, emo_vector = self._resolve_emo_inputs(
+            spk_audio_prompt, text, emo_audio_prompt, emo_alpha, emo_vector, use_emo_text, emo_text)
+        spk_cond_emb, style, prompt_condition, ref_mel = self._get_spk_conditioning(spk_audio_prompt, verbose)
+        emo_cond_emb = self._get_emo_conditioning(emo_audio_prompt, verbose)
+        speech_conditioning_latent = self._get_gpt_conditioning(spk_audio_prompt, spk_cond_emb)
+        emovec = self._merge_emovec(spk_cond_emb, emo_cond_emb, emo_alpha, emo_vector, style, use_random)
+
+        self._set_gr_progress(0.1, "text processing...")
+        text_tokens_list = self.tokenizer.tokenize(text)
+        segments = self.tokenizer.split_segments(text_tokens_list, max_text_tokens_per_segment)
+        if verbose:
+            print(">> text token count:", len(text_tokens_list))
+            print("   segments count:", len(segments))
+            print("   max_text_tokens_per_segment:", max_text_tokens_per_segment)
+            print(*segments, sep="\n")
+        generation_kwargs.pop("do_sample", True)
+        top_p = generation_kwargs.pop("top_p", 0.8)
+        top_k = generation_kwargs.pop("top_k", 30)
+        temperature = generation_kwargs.pop("temperature", 0.8)
+        autoregressive_batch_size = 1
+        length_penalty = generation_kwargs.pop("length_penalty", 0.0)
+        num_beams = generation_kwargs.pop("num_beams", 3)
+        repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
+        max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 1500)
+        # reuse the hidden states of the generation as the gpt latent, skipping the latent forward pass
+        reuse_gpt_latent = generation_kwargs.pop("reuse_gpt_latent", False)
+        s2mel_kwargs = self._pop_s2mel_kwargs(generation_kwargs)
+        s2mel_kwargs["prompt_cond"] = self._get_prompt_cond(spk_audio_prompt, prompt_condition, ref_mel, style)
+        sampling_rate = 22050
+
+        gpt_gen_time = 0
+        gpt_forward_time = 0
+        s2mel_time = 0
+        bigvgan_time = 0
+
+        if self.device == "cpu":
+            bucket_max_size, row_cost = self.cpu_bucket_params(segments_bucket_max_size)
+            all_segments = self.bucket_segments_balanced(segments, bucket_max_size=bucket_max_size,
+                                                         row_cost=row_cost)
+        else:
+            bucket_max_size = segments_bucket_max_size
+            all_segments = self.bucket_segments(segments, bucket_max_size=bucket_max_size)
+        bucket_count = len(all_segments)
+        all_batch_num = sum(len(s) for s in all_segments)
+        if verbose:
+            print(">> segments bucket_count:", bucket_count,
+                  "bucket sizes:", [(len(s), [t["idx"] for t in s]) for s in all_segments],
+                  "bucket_max_size:", bucket_max_size)
+
+        # gpt speech: generate the codes of each bucket in one batch
+        all_codes = [None] * len(segments)
+        all_text_tokens = [None] * len(segments)
+        all_latents = [None] * len(segments)
+        has_warned = False
+        processed_num = 0
+        for bucket in all_segments:
+            batch_tokens: List[torch.Tensor] = []
+            for item in bucket:
+                text_tokens = self.tokenizer.convert_tokens_to_ids(item["sent"])
+                text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+                all_text_tokens[item["idx"]] = text_tokens
+                batch_tokens.append(text_tokens)
+            if len(batch_tokens) > 1:
+                batch_text_tokens = self.pad_tokens_cat(batch_tokens)
+            else:
+                batch_text_tokens = batch_tokens[0]
+            processed_num += len(bucket)
+            self._set_gr_progress(0.2 + 0.3 * processed_num / all_batch_num,
+                                  f"gpt speech inference {processed_num}/{all_batch_num}...")
+            m_start_time = time.perf_counter()
+            with torch.no_grad():
+                with torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                    gpt_outputs = self.gpt.inference_speech(
+                        spk_cond_emb,
+                        batch_text_tokens,
+                        emo_cond_emb,
+                        cond_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=batch_text_tokens.device),
+                        emo_cond_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=batch_text_tokens.device),
+                        emo_vec=emovec,
+                        speech_conditioning_latent=speech_conditioning_latent,
+                        do_sample=True,
+                        top_p=top_p,
+                        top_k=top_k,
+                        temperature=temperature,
+                        num_return_sequences=autoregressive_batch_size,
+                        length_penalty=length_penalty,
+                        num_beams=num_beams,
+                        repetition_penalty=repetition_penalty,
+                        max_generate_length=max_mel_tokens,
+                        return_latent=reuse_gpt_latent,
+                        **generation_kwargs
+                    )
+            batch_codes = gpt_outputs[0]
+            gpt_gen_time += time.perf_counter() - m_start_time
+            # fan out the batch back to the segments
+            for i, item in enumerate(bucket):
+                codes = batch_codes[i:i + 1]
+                if reuse_gpt_latent:
+                    all_latents[item["idx"]] = gpt_outputs[2][i:i + 1]
+                if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
+                    warnings.warn(
+                        f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
+                        f"Consider reducing `max_text_tokens_per_segment`({max_text_tokens_per_segment}) or increasing `max_mel_tokens`.",
+                        category=RuntimeWarning
+                    )
+                    has_warned = True
+                all_codes[item["idx"]] = codes
+
+        # gpt latent of each segment
+        all_code_lens = [None] * len(segments)
+        for seg_idx, (codes, text_tokens) in enumerate(zip(all_codes, all_text_tokens)):
+            if codes is None:
+                # skipped empty segment
+                continue
+            with torch.no_grad():
+                codes, code_lens = self._trim_codes(codes)
+                if verbose:
+                    print(f"fix codes shape: {codes.shape}, code len: {code_lens}")
+                if all_latents[seg_idx] is not None:
+                    all_latents[seg_idx] = all_latents[seg_idx][:, :codes.shape[-1]]
+                else:
+                    m_start_time = time.perf_counter()
+                    all_latents[seg_idx] = self._gpt_latent(speech_conditioning_latent, text_tokens, codes,
+                                                            spk_cond_emb, emo_cond_emb, emovec)
+                    gpt_forward_time += time.perf_counter() - m_start_time
+            all_codes[seg_idx] = codes
+            all_code_lens[seg_idx] = code_lens
+
+        # s2mel and bigvgan: the segments of similar code length are decoded in one batch
+        if self.device == "cpu":
+            # the same thread-bound batch limit as the gpt buckets
+            s2mel_batch_size, _ = self.cpu_bucket_params(s2mel_batch_size)
+        else:
+            s2mel_batch_size = max(1, s2mel_batch_size)
+        valid_indices = sorted([i for i, codes in enumerate(all_codes) if codes is not None],
+                               key=lambda i: all_code_lens[i].item())
+        all_wavs = [None] * len(segments)
+        processed_num = 0
+        for batch_start in range(0, len(valid_indices), s2mel_batch_size):
+            batch_indices = valid_indices[batch_start:batch_start + s2mel_batch_size]
+            processed_num += len(batch_indices)
+            self._set_gr_progress(0.5 + 0.4 * processed_num / all_batch_num,
+                                  f"speech synthesis {processed_num}/{all_batch_num}...")
+            with torch.no_grad():
+                m_start_time = time.perf_counter()
+                vc_targets = self._s2mel_batch([all_latents[i] for i in batch_indices],
+                                               [all_codes[i] for i in batch_indices],
+                                               [all_code_lens[i] for i in batch_indices],
+                                               prompt_condition, ref_mel, style, **s2mel_kwargs)
+                s2mel_time += time.perf_counter() - m_start_time
+
+                m_start_time = time.perf_counter()
+                batch_wavs = self._vocode_batch(vc_targets)
+                bigvgan_time += time.perf_counter() - m_start_time
+
+            for i, wav in zip(batch_indices, batch_wavs):
+                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
+                all_wavs[i] = wav.cpu()  # to cpu before saving
+        # in the original segment order
+        wavs = [wav for wav in all_wavs if wav is not None]
+        end_time = time.perf_counter()
+
+        self._set_gr_progress(0.9, "saving audio...")
+        wavs = self.insert_interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
+        wav = torch.cat(wavs, dim=1)
+        wav_length = wav.shape[-1] / sampling_rate
+        print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
+        print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
+        print(f">> s2mel_time: {s2mel_time:.2f} seconds")
+        print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
+        print(f">> Total fast inference time: {end_time - start_time:.2f} seconds")
+        print(f">> Generated audio length: {wav_length:.2f} seconds")
+        print(f">> [fast] batch_num: {all_batch_num} bucket_max_size: {bucket_max_size}",
+              f"bucket_count: {bucket_count}" if bucket_max_size > 1 else "")
+        print(f">> [fast] RTF: {(end_time - start_time) / wav_length:.4f}")
+
+        return self._save_or_return(wav, output_path, sampling_rate)
+
+    # 批量推理：多个独立的 (音色, 文本, 情感) 任务一起生成
+    def infer_batch(self, jobs: List[Dict], output_dir=None, interval_silence=200, verbose=False,
+                    max_text_tokens_per_segment=120, segments_bucket_max_size=4, s2mel_batch_size=4,
+                    batch_window_size=16, **generation_kwargs):
+        """
+        Synthesize a list of independent jobs together, instead of one ``infer()`` call per job.
+
+        The jobs are processed in consecutive windows of ``batch_window_size`` jobs, and each window is saved
+        (or returned) before the next one starts, so the memory does not grow with the number of jobs and the
+        finished jobs survive a crash. In a window, the segments are grouped by voice and emotion, and bucketed
+        by length for the batched GPT generation; the s2mel (CFM) and BigVGAN batches are formed by voice across
+        the jobs. The conditioning is computed once per voice and emotion, and reuses the conditioning cache and
+        the voice packs.
+
+        When a window fails, its jobs are run again one by one, so that a bad job only fails itself.
+
+        Args:
+            jobs: list of dicts with the arguments of ``infer()``: ``spk_audio_prompt`` and ``text`` are required,
+                ``output_path``, ``emo_audio_prompt``, ``emo_alpha``, ``emo_vector``, ``use_emo_text``,
+                ``emo_text`` and ``use_random`` are optional
+            output_dir: the jobs without ``output_path`` are saved as ``{output_dir}/{job index}.wav``,
+                if None they are returned as ``(sampling_rate, wav_data)``, which keeps all the audio in memory:
+                prefer ``output_path`` or ``output_dir`` for long job lists
+            batch_window_size: max number of the jobs generated together
+            other args are the same as ``infer_fast``, the generation kwargs are shared by all the jobs.
+        Returns:
+            the result of each job in the order of ``jobs``: the output path or ``(sampling_rate, wav_data)``,
+            None if the job has no text or failed
+        """
+        print(f">> starting batch inference of {len(jobs)} jobs...")
+        self._set_gr_progress(0, "starting batch inference...")
+        start_time = time.perf_counter()
+
+        generation_kwargs.pop("do_sample", True)
+        options = dict(
+            interval_silence=interval_silence,
+            verbose=verbose,
+            max_text_tokens_per_segment=max_text_tokens_per_segment,
+            segments_bucket_max_size=segments_bucket_max_size,
+            s2mel_batch_size=s2mel_batch_size,
+            top_p=generation_kwargs.pop("top_p", 0.8),
+            top_k=generation_kwargs.pop("top_k", 30),
+            temperature=generation_kwargs.pop("temperature", 0.8),
+            length_penalty=generation_kwargs.pop("length_penalty", 0.0),
+            num_beams=generation_kwargs.pop("num_beams", 3),
+            repetition_penalty=generation_kwargs.pop("repetition_penalty", 10.0),
+            max_mel_tokens=generation_kwargs.pop("max_mel_tokens", 1500),
+            reuse_gpt_latent=generation_kwargs.pop("reuse_gpt_latent", False),
+            s2mel_kwargs=self._pop_s2mel_kwargs(generation_kwargs),
+            generation_kwargs=generation_kwargs,
+        )
+        stats = {"gpt_gen_time": 0, "gpt_forward_time": 0, "s2mel_time": 0, "bigvgan_time": 0,
+                 "wav_length": 0, "segments": 0}
+
+        results = [None] * len(jobs)
+        batch_window_size = max(1, batch_window_size)
+        for window_start in range(0, len(jobs), batch_window_size):
+            job_indices = list(range(window_start, min(len(jobs), window_start + batch_window_size)))
+            try:
+                window_results = self._infer_batch_window(jobs, job_indices, output_dir, stats, **options)
+            except Exception:
+                if len(job_indices) == 1:
+                    print(f">> job {job_indices[0]} failed")
+                    traceback.print_exc()
+                    window_results = [None]
+                else:
+                    print(f">> batch of jobs {job_indices[0]}-{job_indices[-1]} failed, retrying one by one")
+                    traceback.print_exc()
+                    window_results = []
+                    for job_idx in job_indices:
+                        try:
+                            window_results.extend(self._infer_batch_window(jobs, [job_idx], output_dir, stats,
+                                                                           **options))
+                        except Exception:
+                            print(f">> job {job_idx} failed")
+                            traceback.print_exc()
+                            window_results.append(None)
+            for job_idx, result in zip(job_indices, window_results):
+                results[job_idx] = result
+            self._set_gr_progress(0.1 + 0.8 * (job_indices[-1] + 1) / len(jobs),
+                                  f"batch inference {job_indices[-1] + 1}/{len(jobs)} jobs...")
+        end_time = time.perf_counter()
+
+        wav_length = stats["wav_length"]
+        print(f">> gpt_gen_time: {stats['gpt_gen_time']:.2f} seconds")
+        print(f">> gpt_forward_time: {stats['gpt_forward_time']:.2f} seconds")
+        print(f">> s2mel_time: {stats['s2mel_time']:.2f} seconds")
+        print(f">> bigvgan_time: {stats['bigvgan_time']:.2f} seconds")
+        print(f">> Total batch inference time: {end_time - start_time:.2f} seconds")
+        print(f">> Generated audio length: {wav_length:.2f} seconds")
+        print(f">> [batch] jobs: {len(jobs)} failed or empty: {sum(r is None for r in results)} "
+              f"segments: {stats['segments']}")
+        if wav_length > 0:
+            print(f">> [batch] RTF: {(end_time - start_time) / wav_length:.4f}")
+        return results
+
+    def _infer_batch_window(self, jobs: List[Dict], job_indices: List[int], output_dir, stats: Dict,
+                            interval_silence, verbose, max_text_tokens_per_segment, segments_bucket_max_size,
+                            s2mel_batch_size, top_p, top_k, temperature, length_penalty, num_beams,
+                            repetition_penalty, max_mel_tokens, reuse_gpt_latent, s2mel_kwargs, generation_kwargs):
+        """
+        One window of `infer_batch()`: generate and save the jobs of ``job_indices``.
+        Returns: the results of ``job_indices``, the times and the audio length are added to ``stats``
+        """
+        autoregressive_batch_size = 1
+        sampling_rate = 22050
+
+        # conditioning of each voice and emotion, shared by the jobs
+        conds: Dict[tuple, Dict] = {}
+        job_cond_keys = {}
+        for job_idx in job_indices:
+            job = jobs[job_idx]
+            spk_audio_prompt = job["spk_audio_prompt"]
+            emo_audio_prompt, emo_alpha, emo_vector = self._resolve_emo_inputs(
+                spk_audio_prompt, job["text"], job.get("emo_audio_prompt"), job.get("emo_alpha", 1.0),
+                job.get("emo_vector"), job.get("use_emo_text", False), job.get("emo_text"))
+            use_random = job.get("use_random", False)
+            cond_key = (spk_audio_prompt, emo_audio_prompt, emo_alpha,
+                        tuple(emo_vector) if emo_vector is not None else None,
+                        job_idx if use_random else None)  # a random emotion matrix per job
+            if cond_key not in conds:
+                spk_cond_emb, style, prompt_condition, ref_mel = self._get_spk_conditioning(spk_audio_prompt, verbose)
+                emo_cond_emb = self._get_emo_conditioning(emo_audio_prompt, verbose)
+                conds[cond_key] = {
+                    "spk_cond_emb": spk_cond_emb,
+                    "style": style,
+                    "prompt_condition": prompt_condition,
+                    "ref_mel": ref_mel,
+                    "prompt_cond": self._get_prompt_cond(spk_audio_prompt, prompt_condition, ref_mel, style),
+                    "emo_cond_emb": emo_cond_emb,
+                    "speech_conditioning_latent": self._get_gpt_conditioning(spk_audio_prompt, spk_cond_emb),
+                    "emovec": self._merge_emovec(spk_cond_emb, emo_cond_emb, emo_alpha, emo_vector, style, use_random),
+                }
+            job_cond_keys[job_idx] = cond_key
+
+        # the segments of the jobs, indexed by their position in `all_segments`
+        all_segments = []
+        segment_jobs = []
+        cond_groups: Dict[tuple, List[int]] = {}
+        for job_idx in job_indices:
+            text_tokens_list = self.tokenizer.tokenize(jobs[job_idx]["text"])
+            segments = self.tokenizer.split_segments(text_tokens_list, max_text_tokens_per_segment)
+            for sent in segments:
+                cond_groups.setdefault(job_cond_keys[job_idx], []).append(len(all_segments))
+                all_segments.append(sent)
+                segment_jobs.append(job_idx)
+        if verbose:
+            print(">> jobs:", job_indices, "segments:", len(all_segments), "voice/emotion groups:", len(cond_groups))
+
+        # gpt speech: the segments of the same voice and emotion are bucketed by length
+        if self.device == "cpu":
+            bucket_max_size, row_cost = self.cpu_bucket_params(segments_bucket_max_size)
+        else:
+            bucket_max_size, row_cost = segments_bucket_max_size, None
+        all_codes = [None] * len(all_segments)
+        all_text_tokens = [None] * len(all_segments)
+        all_latents = [None] * len(all_segments)
+        has_warned = False
+        for cond_key, group in cond_groups.items():
+            cond = conds[cond_key]
+            spk_cond_emb, emo_cond_emb = cond["spk_cond_emb"], cond["emo_cond_emb"]
+            group_segments = [all_segments[i] for i in group]
+            if row_cost is not None:
+                buckets = self.bucket_segments_balanced(group_segments, bucket_max_size=bucket_max_size,
+                                                        row_cost=row_cost)
+            else:
+                buckets = self.bucket_segments(group_segments, bucket_max_size=bucket_max_size)
+            for bucket in buckets:
+                batch_tokens: List[torch.Tensor] = []
+                for item in bucket:
+                    text_tokens = self.tokenizer.convert_tokens_to_ids(item["sent"])
+                    text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+                    all_text_tokens[group[item["idx"]]] = text_tokens
+                    batch_tokens.append(text_tokens)
+                if len(batch_tokens) > 1:
+                    batch_text_tokens = self.pad_tokens_cat(batch_tokens)
+                else:
+                    batch_text_tokens = batch_tokens[0]
+                m_start_time = time.perf_counter()
+                with torch.no_grad():
+                    with torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        gpt_outputs = self.gpt.inference_speech(
+                            spk_cond_emb,
+                            batch_text_tokens,
+                            emo_cond_emb,
+                            cond_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=batch_text_tokens.device),
+                            emo_cond_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=batch_text_tokens.device),
+                            emo_vec=cond["emovec"],
+                            speech_conditioning_latent=cond["speech_conditioning_latent"],
+                            do_sample=True,
+                            top_p=top_p,
+                            top_k=top_k,
+                            temperature=temperature,
+                            num_return_sequences=autoregressive_batch_size,
+                            length_penalty=length_penalty,
+                            num_beams=num_beams,
+                            repetition_penalty=repetition_penalty,
+                            max_generate_length=max_mel_tokens,
+                            return_latent=reuse_gpt_latent,
+                            **generation_kwargs
+                        )
+                batch_codes = gpt_outputs[0]
+                stats["gpt_gen_time"] += time.perf_counter() - m_start_time
+                for i, item in enumerate(bucket):
+                    seg_idx = group[item["idx"]]
+                    codes = batch_codes[i:i + 1]
+                    if reuse_gpt_latent:
+                        all_latents[seg_idx] = gpt_outputs[2][i:i + 1]
+                    if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
+                        warnings.warn(
+                            f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
+                            f"Consider reducing `max_text_tokens_per_segment`({max_text_tokens_per_segment}) or increasing `max_mel_tokens`.",
+                            category=RuntimeWarning
+                        )
+                        has_warned = True
+                    all_codes[seg_idx] = codes
+
+        # gpt latent of each segment
+        all_code_lens = [None] * len(all_segments)
+        for seg_idx, (codes, text_tokens) in enumerate(zip(all_codes, all_text_tokens)):
+            if codes is None:
+                # skipped empty segment
+                continue
+            cond = conds[job_cond_keys[segment_jobs[seg_idx]]]
+            with torch.no_grad():
+                codes, code_lens = self._trim_codes(codes)
+                if all_latents[seg_idx] is not None:
+                    all_latents[seg_idx] = all_latents[seg_idx][:, :codes.shape[-1]]
+                else:
+                    m_start_time = time.perf_counter()
+                    all_latents[seg_idx] = self._gpt_latent(cond["speech_conditioning_latent"], text_tokens, codes,
+                                                            cond["spk_cond_emb"], cond["emo_cond_emb"], cond["emovec"])
+                    stats["gpt_forward_time"] += time.perf_counter() - m_start_time
+            all_codes[seg_idx] = codes
+            all_code_lens[seg_idx] = code_lens
+
+        # s2mel and bigvgan: the segments of the same voice, from any job, are decoded in batches of similar length
+        if self.device == "cpu":
+            # the same thread-bound batch limit as the gpt buckets
+            s2mel_batch_size, _ = self.cpu_bucket_params(s2mel_batch_size)
+        else:
+            s2mel_batch_size = max(1, s2mel_batch_size)
+        voice_groups: Dict[str, List[int]] = {}
+        for seg_idx, codes in enumerate(all_codes):
+            if codes is not None:
+                voice_groups.setdefault(jobs[segment_jobs[seg_idx]]["spk_audio_prompt"], []).append(seg_idx)
+        all_wavs = [None] * len(all_segments)
+        for voice_indices in voice_groups.values():
+            voice_indices.sort(key=lambda i: all_code_lens[i].item())
+            cond = conds[job_cond_keys[segment_jobs[voice_indices[0]]]]
+            for batch_start in range(0, len(voice_indices), s2mel_batch_size):
+                batch_indices = voice_indices[batch_start:batch_start + s2mel_batch_size]
+                with torch.no_grad():
+                    m_start_time = time.perf_counter()
+                    vc_targets = self._s2mel_batch([all_latents[i] for i in batch_indices],
+                                                   [all_codes[i] for i in batch_indices],
+                                                   [all_code_lens[i] for i in batch_indices],
+                                                   cond["prompt_condition"], cond["ref_mel"], cond["style"],
+                                                   prompt_cond=cond["prompt_cond"], **s2mel_kwargs)
+                    stats["s2mel_time"] += time.perf_counter() - m_start_time
+
+                    m_start_time = time.perf_counter()
+                    batch_wavs = self._vocode_batch(vc_targets)
+                    stats["bigvgan_time"] += time.perf_counter() - m_start_time
+
+                for i, wav in zip(batch_indices, batch_wavs):
+                    wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
+                    all_wavs[i] = wav.cpu()  # to cpu before saving
+                    # the segment is done, free its device memory before the next batch
+                    all_latents[i] = all_codes[i] = None
+        stats["segments"] += len(all_segments)
+
+        # the segments of each job, in their original order
+        job_wavs = {job_idx: [] for job_idx in job_indices}
+        for seg_idx, wav in enumerate(all_wavs):
+            if wav is not None:
+                job_wavs[segment_jobs[seg_idx]].append(wav)
+        results = []
+        for job_idx in job_indices:
+            wavs = job_wavs[job_idx]
+            if len(wavs) == 0:
+                print(f">> job {job_idx} has no audio, skipped")
+                results.append(None)
+                continue
+            wavs = self.insert_interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
+            wav = torch.cat(wavs, dim=1)
+            output_path = jobs[job_idx].get("output_path")
+            if output_path is None and output_dir is not None:
+                output_path = os.path.join(output_dir, f"{job_idx}.wav")
+            try:
+                results.append(self._save_or_return(wav, output_path, sampling_rate))
+                stats["wav_length"] += wav.shape[-1] / sampling_rate
+            except Exception:
+                print(f">> job {job_idx} failed to save to {output_path}")
+                traceback.print_exc()
+                results.append(None)
+        return results
+
     # 原始推理模式
     def infer(self, spk_audio_prompt, text, output_path,
               emo_audio_prompt=None, emo_alpha=1.0,
               emo_vector=None,
               use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
-              verbose=False, max_text_tokens_per_segment=120, stream_return=False, more_segment_before=0, **generation_kwargs):
+              verbose=False, max_text_tokens_per_segment=120, stream_return=False, more_segment_before=0,
+              quick_streaming_tokens=0, **generation_kwargs):
+        """
+        Args:
+            ``quick_streaming_tokens``: the segments are not merged until this many text tokens, so that the first
+                segments of ``stream_return`` stay short. See ``infer_stream()`` for the low latency streaming.
+            ``more_segment_before``: deprecated, it was passed to ``infer_generator`` as ``quick_streaming_tokens``.
+        """
+        if more_segment_before and not quick_streaming_tokens:
+            warnings.warn("`more_segment_before` is deprecated, use `quick_streaming_tokens` instead",
+                          category=DeprecationWarning)
+            quick_streaming_tokens = more_segment_before
         if stream_return:
             return self.infer_generator(
                 spk_audio_prompt, text, output_path,
                 emo_audio_prompt, emo_alpha,
                 emo_vector,
                 use_emo_text, emo_text, use_random, interval_silence,
-                verbose, max_text_tokens_per_segment, stream_return, more_segment_before, **generation_kwargs
+                verbose, max_text_tokens_per_segment, stream_return,
+                quick_streaming_tokens=quick_streaming_tokens, **generation_kwargs
             )
         else:
             try:
@@ -374,7 +1552,8 @@ class IndexTTS2:
                     emo_audio_prompt, emo_alpha,
                     emo_vector,
                     use_emo_text, emo_text, use_random, interval_silence,
-                    verbose, max_text_tokens_per_segment, stream_return, more_segment_before, **generation_kwargs
+                    verbose, max_text_tokens_per_segment, stream_return,
+                    quick_streaming_tokens=quick_streaming_tokens, **generation_kwargs
                 ))[0]
             except IndexError:
                 return None
@@ -393,111 +1572,14 @@ class IndexTTS2:
                   f"emo_text:{emo_text}")
         start_time = time.perf_counter()
 
-        if use_emo_text or emo_vector is not None:
-            # we're using a text or emotion vector guidance; so we must remove
-            # "emotion reference voice", to ensure we use correct emotion mixing!
-            emo_audio_prompt = None
+        emo_audio_prompt, emo_alpha, emo_vector = self._resolve_emo_inputs(
+            spk_audio_prompt, text, emo_audio_prompt, emo_alpha, emo_vector, use_emo_text, emo_text)
 
-        if use_emo_text:
-            # automatically generate emotion vectors from text prompt
-            if emo_text is None:
-                emo_text = text  # use main text prompt
-            emo_dict = self.qwen_emo.inference(emo_text)
-            print(f"detected emotion vectors from text: {emo_dict}")
-            # convert ordered dict to list of vectors; the order is VERY important!
-            emo_vector = list(emo_dict.values())
-
-        if emo_vector is not None:
-            # we have emotion vectors; they can't be blended via alpha mixing
-            # in the main inference process later, so we must pre-calculate
-            # their new strengths here based on the alpha instead!
-            emo_vector_scale = max(0.0, min(1.0, emo_alpha))
-            if emo_vector_scale != 1.0:
-                # scale each vector and truncate to 4 decimals (for nicer printing)
-                emo_vector = [int(x * emo_vector_scale * 10000) / 10000 for x in emo_vector]
-                print(f"scaled emotion vectors to {emo_vector_scale}x: {emo_vector}")
-
-        if emo_audio_prompt is None:
-            # we are not using any external "emotion reference voice"; use
-            # speaker's voice as the main emotion reference audio.
-            emo_audio_prompt = spk_audio_prompt
-            # must always use alpha=1.0 when we don't have an external reference voice
-            emo_alpha = 1.0
-
-        # 如果参考音频改变了，才需要重新生成, 提升速度
-        if self.cache_spk_cond is None or self.cache_spk_audio_prompt != spk_audio_prompt:
-            if self.cache_spk_cond is not None:
-                self.cache_spk_cond = None
-                self.cache_s2mel_style = None
-                self.cache_s2mel_prompt = None
-                self.cache_mel = None
-                torch.cuda.empty_cache()
-            audio,sr = self._load_and_cut_audio(spk_audio_prompt,15,verbose)
-            audio_22k = torchaudio.transforms.Resample(sr, 22050)(audio)
-            audio_16k = torchaudio.transforms.Resample(sr, 16000)(audio)
-
-            inputs = self.extract_features(audio_16k, sampling_rate=16000, return_tensors="pt")
-            input_features = inputs["input_features"]
-            attention_mask = inputs["attention_mask"]
-            input_features = input_features.to(self.device)
-            attention_mask = attention_mask.to(self.device)
-            spk_cond_emb = self.get_emb(input_features, attention_mask)
-
-            _, S_ref = self.semantic_codec.quantize(spk_cond_emb)
-            ref_mel = self.mel_fn(audio_22k.to(spk_cond_emb.device).float())
-            ref_target_lengths = torch.LongTensor([ref_mel.size(2)]).to(ref_mel.device)
-            feat = torchaudio.compliance.kaldi.fbank(audio_16k.to(ref_mel.device),
-                                                     num_mel_bins=80,
-                                                     dither=0,
-                                                     sample_frequency=16000)
-            feat = feat - feat.mean(dim=0, keepdim=True)  # feat2另外一个滤波器能量组特征[922, 80]
-            style = self.campplus_model(feat.unsqueeze(0))  # 参考音频的全局style2[1,192]
-
-            prompt_condition = self.s2mel.models['length_regulator'](S_ref,
-                                                                     ylens=ref_target_lengths,
-                                                                     n_quantizers=3,
-                                                                     f0=None)[0]
-
-            self.cache_spk_cond = spk_cond_emb
-            self.cache_s2mel_style = style
-            self.cache_s2mel_prompt = prompt_condition
-            self.cache_spk_audio_prompt = spk_audio_prompt
-            self.cache_mel = ref_mel
-        else:
-            style = self.cache_s2mel_style
-            prompt_condition = self.cache_s2mel_prompt
-            spk_cond_emb = self.cache_spk_cond
-            ref_mel = self.cache_mel
-
-        if emo_vector is not None:
-            weight_vector = torch.tensor(emo_vector, device=self.device)
-            if use_random:
-                random_index = [random.randint(0, x - 1) for x in self.emo_num]
-            else:
-                random_index = [find_most_similar_cosine(style, tmp) for tmp in self.spk_matrix]
-
-            emo_matrix = [tmp[index].unsqueeze(0) for index, tmp in zip(random_index, self.emo_matrix)]
-            emo_matrix = torch.cat(emo_matrix, 0)
-            emovec_mat = weight_vector.unsqueeze(1) * emo_matrix
-            emovec_mat = torch.sum(emovec_mat, 0)
-            emovec_mat = emovec_mat.unsqueeze(0)
-
-        if self.cache_emo_cond is None or self.cache_emo_audio_prompt != emo_audio_prompt:
-            if self.cache_emo_cond is not None:
-                self.cache_emo_cond = None
-                torch.cuda.empty_cache()
-            emo_audio, _ = self._load_and_cut_audio(emo_audio_prompt,15,verbose,sr=16000)
-            emo_inputs = self.extract_features(emo_audio, sampling_rate=16000, return_tensors="pt")
-            emo_input_features = emo_inputs["input_features"]
-            emo_attention_mask = emo_inputs["attention_mask"]
-            emo_input_features = emo_input_features.to(self.device)
-            emo_attention_mask = emo_attention_mask.to(self.device)
-            emo_cond_emb = self.get_emb(emo_input_features, emo_attention_mask)
-
-            self.cache_emo_cond = emo_cond_emb
-            self.cache_emo_audio_prompt = emo_audio_prompt
-        else:
-            emo_cond_emb = self.cache_emo_cond
+        spk_cond_emb, style, prompt_condition, ref_mel = self._get_spk_conditioning(spk_audio_prompt, verbose)
+        emo_cond_emb = self._get_emo_conditioning(emo_audio_prompt, verbose)
+        # computed once per request (or once per voice for the conditioning latent), shared by all the segments
+        speech_conditioning_latent = self._get_gpt_conditioning(spk_audio_prompt, spk_cond_emb)
+        emovec = self._merge_emovec(spk_cond_emb, emo_cond_emb, emo_alpha, emo_vector, style, use_random)
 
         self._set_gr_progress(0.1, "text processing...")
         text_tokens_list = self.tokenizer.tokenize(text)
@@ -524,6 +1606,12 @@ class IndexTTS2:
         num_beams = generation_kwargs.pop("num_beams", 3)
         repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
         max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 1500)
+        # reuse the hidden states of the generation as the gpt latent, skipping the latent forward pass
+        reuse_gpt_latent = generation_kwargs.pop("reuse_gpt_latent", False)
+        # overlap the GPT, s2mel and vocoder stages of consecutive segments on separate threads
+        use_pipeline = generation_kwargs.pop("use_pipeline", False)
+        s2mel_kwargs = self._pop_s2mel_kwargs(generation_kwargs)
+        s2mel_kwargs["prompt_cond"] = self._get_prompt_cond(spk_audio_prompt, prompt_condition, ref_mel, style)
         sampling_rate = 22050
 
         wavs = []
@@ -533,10 +1621,10 @@ class IndexTTS2:
         bigvgan_time = 0
         has_warned = False
         silence = None # for stream_return
-        for seg_idx, sent in enumerate(segments):
-            self._set_gr_progress(0.2 + 0.7 * seg_idx / segments_count,
-                                  f"speech synthesis {seg_idx + 1}/{segments_count}...")
 
+        def gpt_stage(segment):
+            nonlocal gpt_gen_time, gpt_forward_time, has_warned
+            seg_idx, sent = segment
             text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
             text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
             if verbose:
@@ -549,25 +1637,14 @@ class IndexTTS2:
             m_start_time = time.perf_counter()
             with torch.no_grad():
                 with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    emovec = self.gpt.merge_emovec(
-                        spk_cond_emb,
-                        emo_cond_emb,
-                        torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
-                        torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
-                        alpha=emo_alpha
-                    )
-
-                    if emo_vector is not None:
-                        emovec = emovec_mat + (1 - torch.sum(weight_vector)) * emovec
-                        # emovec = emovec_mat
-
-                    codes, speech_conditioning_latent = self.gpt.inference_speech(
+                    gpt_outputs = self.gpt.inference_speech(
                         spk_cond_emb,
                         text_tokens,
                         emo_cond_emb,
                         cond_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
                         emo_cond_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
                         emo_vec=emovec,
+                        speech_conditioning_latent=speech_conditioning_latent,
                         do_sample=True,
                         top_p=top_p,
                         top_k=top_k,
@@ -577,8 +1654,10 @@ class IndexTTS2:
                         num_beams=num_beams,
                         repetition_penalty=repetition_penalty,
                         max_generate_length=max_mel_tokens,
+                        return_latent=reuse_gpt_latent,
                         **generation_kwargs
                     )
+                codes = gpt_outputs[0]
 
                 gpt_gen_time += time.perf_counter() - m_start_time
                 if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
@@ -590,87 +1669,60 @@ class IndexTTS2:
                     )
                     has_warned = True
 
-                code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
-                #                 if verbose:
-                #                     print(codes, type(codes))
-                #                     print(f"codes shape: {codes.shape}, codes type: {codes.dtype}")
-                #                     print(f"code len: {code_lens}")
-
-                code_lens = []
-                max_code_len = 0
-                for code in codes:
-                    if self.stop_mel_token not in code:
-                        code_len = len(code)
-                    else:
-                        len_ = (code == self.stop_mel_token).nonzero(as_tuple=False)[0]
-                        code_len = len_[0].item() if len_.numel() > 0 else len(code)
-                    code_lens.append(code_len)
-                    max_code_len = max(max_code_len, code_len)
-                codes = codes[:, :max_code_len]
-                code_lens = torch.LongTensor(code_lens)
-                code_lens = code_lens.to(self.device)
+                codes, code_lens = self._trim_codes(codes)
                 if verbose:
                     print(codes, type(codes))
                     print(f"fix codes shape: {codes.shape}, codes type: {codes.dtype}")
                     print(f"code len: {code_lens}")
 
-                m_start_time = time.perf_counter()
-                use_speed = torch.zeros(spk_cond_emb.size(0)).to(spk_cond_emb.device).long()
-                with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    latent = self.gpt(
-                        speech_conditioning_latent,
-                        text_tokens,
-                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device),
-                        codes,
-                        torch.tensor([codes.shape[-1]], device=text_tokens.device),
-                        emo_cond_emb,
-                        cond_mel_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
-                        emo_cond_mel_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
-                        emo_vec=emovec,
-                        use_speed=use_speed,
-                    )
-                    gpt_forward_time += time.perf_counter() - m_start_time
-
-                dtype = None
-                with torch.amp.autocast(text_tokens.device.type, enabled=dtype is not None, dtype=dtype):
+                if reuse_gpt_latent:
+                    latent = gpt_outputs[2][:, :codes.shape[-1]]
+                else:
                     m_start_time = time.perf_counter()
-                    diffusion_steps = 25
-                    inference_cfg_rate = 0.7
-                    latent = self.s2mel.models['gpt_layer'](latent)
-                    S_infer = self.semantic_codec.quantizer.vq2emb(codes.unsqueeze(1))
-                    S_infer = S_infer.transpose(1, 2)
-                    S_infer = S_infer + latent
-                    target_lengths = (code_lens * 1.72).long()
-
-                    cond = self.s2mel.models['length_regulator'](S_infer,
-                                                                 ylens=target_lengths,
-                                                                 n_quantizers=3,
-                                                                 f0=None)[0]
-                    cat_condition = torch.cat([prompt_condition, cond], dim=1)
-                    vc_target = self.s2mel.models['cfm'].inference(cat_condition,
-                                                                   torch.LongTensor([cat_condition.size(1)]).to(
-                                                                       cond.device),
-                                                                   ref_mel, style, None, diffusion_steps,
-                                                                   inference_cfg_rate=inference_cfg_rate)
-                    vc_target = vc_target[:, :, ref_mel.size(-1):]
-                    s2mel_time += time.perf_counter() - m_start_time
-
-                    m_start_time = time.perf_counter()
-                    wav = self.bigvgan(vc_target.float()).squeeze().unsqueeze(0)
-                    print(wav.shape)
-                    bigvgan_time += time.perf_counter() - m_start_time
-                    wav = wav.squeeze(1)
+                    latent = self._gpt_latent(speech_conditioning_latent, text_tokens, codes,
+                                              spk_cond_emb, emo_cond_emb, emovec)
+                    gpt_forward_time += time.perf_counter() - m_start_time
+            return latent, codes, code_lens
 
-                wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-                if verbose:
-                    print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
-                # wavs.append(wav[:, :-512])
-                wavs.append(wav.cpu())  # to cpu before saving
-                if stream_return:
-                    yield wav.cpu()
-                    if silence == None:
-                        silence = self.interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
-                    yield silence
+        def s2mel_stage(gpt_result):
+            nonlocal s2mel_time
+            latent, codes, code_lens = gpt_result
+            dtype = None
+            with torch.no_grad(), torch.amp.autocast(latent.device.type, enabled=dtype is not None, dtype=dtype):
+                m_start_time = time.perf_counter()
+                vc_target = self._s2mel(latent, codes, code_lens, prompt_condition, ref_mel, style, **s2mel_kwargs)
+                s2mel_time += time.perf_counter() - m_start_time
+            return vc_target
+
+        def vocode_stage(vc_target):
+            nonlocal bigvgan_time
+            dtype = None
+            with torch.no_grad(), torch.amp.autocast(vc_target.device.type, enabled=dtype is not None, dtype=dtype):
+                m_start_time = time.perf_counter()
+                wav = self._vocode(vc_target)
+                bigvgan_time += time.perf_counter() - m_start_time
+            wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
+            return wav.cpu()  # to cpu before saving
+
+        if use_pipeline and segments_count > 1:
+            # GPT | s2mel | vocoder of consecutive segments overlap, see `StagePipeline`
+            pipeline = StagePipeline([gpt_stage, s2mel_stage, vocode_stage], queue_size=1, device=self.device,
+                                     names=["gpt", "s2mel", "vocoder"])
+            results = pipeline.run(enumerate(segments))
+        else:
+            results = (vocode_stage(s2mel_stage(gpt_stage(segment))) for segment in enumerate(segments))
+        for seg_idx, wav in enumerate(results):
+            self._set_gr_progress(0.2 + 0.7 * (seg_idx + 1) / segments_count,
+                                  f"speech synthesis {seg_idx + 1}/{segments_count}...")
+            if verbose:
+                print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
+            # wavs.append(wav[:, :-512])
+            wavs.append(wav)
+            if stream_return:
+                yield wav
+                if silence == None:
+                    silence = self.interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
+                yield silence
         end_time = time.perf_counter()
 
         self._set_gr_progress(0.9, "saving audio...")
@@ -686,26 +1738,197 @@ class IndexTTS2:
         print(f">> RTF: {(end_time - start_time) / wav_length:.4f}")
 
         # save audio
-        wav = wav.cpu()  # to cpu
-        if output_path:
-            # 直接保存音频到指定路径中
-            if os.path.isfile(output_path):
-                os.remove(output_path)
-                print(">> remove old wav file:", output_path)
-            if os.path.dirname(output_path) != "":
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
-            print(">> wav file saved to:", output_path)
-            if stream_return:
-                return None
-            yield output_path
-        else:
-            if stream_return:
-                return None
-            # 返回以符合Gradio的格式要求
-            wav_data = wav.type(torch.int16)
-            wav_data = wav_data.numpy().T
-            yield (sampling_rate, wav_data)
+        if stream_return:
+            if output_path:
+                self._save_or_return(wav, output_path, sampling_rate)
+            return None
+        yield self._save_or_return(wav, output_path, sampling_rate)
+
+    def _split_first_segment(self, segments, first_segment_tokens=20):
+        """
+        Cut the first segment to at most ``first_segment_tokens`` tokens, after a punctuation or before a word
+        if possible, so that the first audio of the stream is ready early. The rest becomes the second segment.
+        """
+        if len(segments) == 0 or first_segment_tokens <= 0 or len(segments[0]) <= first_segment_tokens:
+            return segments
+        first = segments[0]
+        split_tokens = set(self.tokenizer.punctuation_marks_tokens) | {",", "▁,", "-", "▁-"}
+        cut = 0
+        for i in range(2, first_segment_tokens + 1):
+            if first[i - 1] in split_tokens:
+                cut = i
+        if cut == 0:
+            # the start of the last word which fits
+            cut = next((i for i in range(first_segment_tokens, 1, -1) if first[i].startswith("▁")),
+                       first_segment_tokens)
+        return [first[:cut], first[cut:]] + segments[1:]
+
+    @staticmethod
+    def _stream_metrics(start_time, chunks, sampling_rate=22050):
+        """
+        Latency of a stream, from the arrival time and the number of samples of each yielded chunk.
+        Returns: {"time_to_first_audio", "mean_chunk_gap", "max_chunk_gap", "stall_time", "audio_length", "total_time"}
+            ``stall_time`` is the total time that a player starting at the first chunk waits for the next audio.
+        """
+        if len(chunks) == 0:
+            return {}
+        arrivals = [t for t, _ in chunks]
+        gaps = [b - a for a, b in zip(arrivals, arrivals[1:])]
+        stall_time = 0.0
+        play_time = arrivals[0]  # the end of the audio received so far, on the player clock
+        for arrival, num_samples in chunks:
+            if arrival > play_time:
+                stall_time += arrival - play_time
+                play_time = arrival
+            play_time += num_samples / sampling_rate
+        return {
+            "time_to_first_audio": arrivals[0] - start_time,
+            "mean_chunk_gap": sum(gaps) / len(gaps) if gaps else 0.0,
+            "max_chunk_gap": max(gaps) if gaps else 0.0,
+            "stall_time": stall_time,
+            "audio_length": sum(n for _, n in chunks) / sampling_rate,
+            "total_time": arrivals[-1] - start_time,
+        }
+
+    # 低延迟流式推理：GPT codes 分块送入 s2mel 与 BigVGAN，音频块生成后立即返回
+    def infer_stream(self, spk_audio_prompt, text,
+                     emo_audio_prompt=None, emo_alpha=1.0,
+                     emo_vector=None,
+                     use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
+                     verbose=False, max_text_tokens_per_segment=120, first_segment_tokens=20,
+                     stream_chunk_tokens=40, vocoder_chunk_frames=32, s2mel_context_frames=100,
+                     **generation_kwargs):
+        """
+        Low latency streaming synthesis.
+
+        The first segment is cut to ``first_segment_tokens`` text tokens. In each segment the GPT codes are
+        generated on a background thread and passed on every ``stream_chunk_tokens`` codes to the s2mel, which
+        continues the mel of the previous chunks, and the mel is vocoded in chunks of ``vocoder_chunk_frames``
+        frames as soon as their right context is available.
+
+        Args:
+            first_segment_tokens: max text tokens of the first segment, 0 to keep the segments of ``infer()``
+            stream_chunk_tokens: number of the GPT codes per s2mel chunk
+            vocoder_chunk_frames: number of the mel frames per vocoder chunk
+            s2mel_context_frames: mel frames of the previous chunks continued by the s2mel of the next chunk
+            ``num_beams`` (generation kwarg): default ``1``, the beam search and the accel engine generate the codes
+                of a segment at once (no GPT streaming)
+            other args are the same as ``infer``.
+        Yields:
+            the waveform pieces [1, T] (int16 range, on cpu), and the interval silence between the segments.
+            The latency of the stream (time to first audio, chunk gaps, stall time) is printed at the end,
+            and kept in ``self.stream_metrics``.
+        """
+        print(">> starting streaming inference...")
+        if verbose:
+            print(f"origin text:{text}, spk_audio_prompt:{spk_audio_prompt}, "
+                  f"emo_audio_prompt:{emo_audio_prompt}, emo_alpha:{emo_alpha}, "
+                  f"emo_vector:{emo_vector}, use_emo_text:{use_emo_text}, "
+                  f"emo_text:{emo_text}")
+        start_time = time.perf_counter()
+
+        emo_audio_prompt, emo_alpha, emo_vector = self._resolve_emo_inputs(
+            spk_audio_prompt, text, emo_audio_prompt, emo_alpha, emo_vector, use_emo_text, emo_text)
+        spk_cond_emb, style, prompt_condition, ref_mel = self._get_spk_conditioning(spk_audio_prompt, verbose)
+        emo_cond_emb = self._get_emo_conditioning(emo_audio_prompt, verbose)
+        speech_conditioning_latent = self._get_gpt_conditioning(spk_audio_prompt, spk_cond_emb)
+        emovec = self._merge_emovec(spk_cond_emb, emo_cond_emb, emo_alpha, emo_vector, style, use_random)
+
+        text_tokens_list = self.tokenizer.tokenize(text)
+        segments = self.tokenizer.split_segments(text_tokens_list, max_text_tokens_per_segment,
+                                                 quick_streaming_tokens=first_segment_tokens)
+        segments = self._split_first_segment(segments, first_segment_tokens)
+        if verbose:
+            print("segments count:", len(segments))
+            print(*segments, sep="\n")
+        generation_kwargs.pop("do_sample", True)
+        generation_kwargs.pop("reuse_gpt_latent", None)
+        gpt_kwargs = dict(
+            do_sample=True,
+            top_p=generation_kwargs.pop("top_p", 0.8),
+            top_k=generation_kwargs.pop("top_k", 30),
+            temperature=generation_kwargs.pop("temperature", 0.8),
+            num_return_sequences=1,
+            length_penalty=generation_kwargs.pop("length_penalty", 0.0),
+            num_beams=generation_kwargs.pop("num_beams", 1),
+            repetition_penalty=generation_kwargs.pop("repetition_penalty", 10.0),
+            max_generate_length=generation_kwargs.pop("max_mel_tokens", 1500),
+        )
+        s2mel_kwargs = self._pop_s2mel_kwargs(generation_kwargs)
+        s2mel_kwargs["prompt_cond"] = self._get_prompt_cond(spk_audio_prompt, prompt_condition, ref_mel, style)
+        gpt_kwargs.update(generation_kwargs)
+        sampling_rate = 22050
+
+        chunks = []  # (arrival time, number of samples)
+        silence = torch.zeros(1, int(sampling_rate * interval_silence / 1000.0))
+        for seg_idx, sent in enumerate(segments):
+            text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
+            text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+            code_chunks = self._stream_codes(text_tokens, spk_cond_emb, emo_cond_emb, emovec,
+                                             speech_conditioning_latent, stream_chunk_tokens, **gpt_kwargs)
+            mel_pieces = self._s2mel_stream(code_chunks, text_tokens, speech_conditioning_latent,
+                                            emovec, prompt_condition, ref_mel, style,
+                                            context_frames=s2mel_context_frames, **s2mel_kwargs)
+            for wav in self._vocode_stream_pieces(mel_pieces, vocoder_chunk_frames):
+                wav = torch.clamp(32767 * wav, -32767.0, 32767.0).cpu()
+                chunks.append((time.perf_counter(), wav.shape[-1]))
+                if verbose:
+                    print(f">> segment {seg_idx + 1}/{len(segments)} chunk: {wav.shape[-1]} samples, "
+                          f"at {chunks[-1][0] - start_time:.3f} seconds")
+                yield wav
+            if seg_idx < len(segments) - 1 and silence.shape[-1] > 0:
+                chunks.append((time.perf_counter(), silence.shape[-1]))
+                yield silence
+
+        self.stream_metrics = self._stream_metrics(start_time, chunks, sampling_rate)
+        if self.stream_metrics:
+            metrics = self.stream_metrics
+            print(f">> time to first audio: {metrics['time_to_first_audio']:.3f} seconds")
+            print(f">> chunk gap: mean {metrics['mean_chunk_gap']:.3f} seconds, max {metrics['max_chunk_gap']:.3f} seconds")
+            print(f">> playback stall time: {metrics['stall_time']:.3f} seconds")
+            print(f">> Total streaming inference time: {metrics['total_time']:.2f} seconds")
+            print(f">> Generated audio length: {metrics['audio_length']:.2f} seconds")
+            print(f">> [stream] RTF: {metrics['total_time'] / metrics['audio_length']:.4f}")
+
+
+class CancelCriteria(StoppingCriteria):
+    """
+    Stops the generation of all the sequences once ``event`` is set by another thread.
+    """
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class CodeStreamer(BaseStreamer):
+    """
+    Sink of the HF ``generate(streamer=...)`` mel codes, iterated by another thread until ``end()``.
+    """
+
+    def __init__(self):
+        self.tokens = queue.Queue()
+        self.prompt_skipped = False
+
+    def put(self, value):
+        if not self.prompt_skipped:
+            # the first call is the prompt input_ids
+            self.prompt_skipped = True
+            return
+        for token in value.view(-1).tolist():
+            self.tokens.put(token)
+
+    def end(self):
+        self.tokens.put(None)
+
+    def __iter__(self):
+        while True:
+            token = self.tokens.get()
+            if token is None:
+                return
+            yield token
 
 
 def find_most_similar_cosine(query_vector, matrix):
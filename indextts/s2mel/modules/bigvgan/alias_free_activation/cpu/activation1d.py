@@ -0,0 +1,73 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from ..torch.resample import UpSample1d, DownSample1d
+
+
+class Activation1d(nn.Module):
+    """
+    Activation1d for CPU, the same output as the torch version up to float rounding:
+    - the 2x upsampling is a polyphase filter: one grouped conv1d producing both phases from the
+      replicate padded input, instead of conv_transpose1d over the zero-stuffed signal
+    - the Snake/SnakeBeta activation is one sin and one addcmul, alpha and 1/beta are computed once and cached
+    - the downsampling is the same strided low-pass conv1d
+    Assumes 2x upsampling with a filter size of 4k (12 in BigVGAN), for inference only like the fused CUDA kernel.
+    The state dict is the same as the torch version.
+    """
+
+    def __init__(
+        self,
+        activation,
+        up_ratio: int = 2,
+        down_ratio: int = 2,
+        up_kernel_size: int = 12,
+        down_kernel_size: int = 12,
+    ):
+        super().__init__()
+        assert up_ratio == 2 and up_kernel_size % 4 == 0, "only 2x upsampling with a filter size of 4k is supported"
+        self.up_ratio = up_ratio
+        self.down_ratio = down_ratio
+        self.act = activation
+        self.upsample = UpSample1d(up_ratio, up_kernel_size)
+        self.downsample = DownSample1d(down_ratio, down_kernel_size)
+        self._cache = None
+
+    def _polyphase_filter(self):
+        """
+        The zero-stuffed conv_transpose1d of `UpSample1d` only hits every other filter tap:
+        the even output samples use the odd taps and the odd output samples use the even taps, over the same
+        K/2 + 1 input samples. Returns both phases as one [2, K/2 + 1] kernel: [phase 0, 0] and [0, phase 1].
+        """
+        f = self.upsample.filter.view(-1) * self.up_ratio
+        phase0 = torch.cat([f[1::2].flip(0), f.new_zeros(1)])
+        phase1 = torch.cat([f.new_zeros(1), f[0::2].flip(0)])
+        return torch.stack([phase0, phase1])
+
+    def _params(self, x: torch.Tensor):
+        act = self.act
+        beta = getattr(act, "beta", act.alpha)  # Snake uses the same params for alpha and beta
+        # the version counters change on load_state_dict() and optimizer steps
+        key = (x.dtype, x.device, x.size(1), act.alpha._version, beta._version, self.upsample.filter._version)
+        if self._cache is None or self._cache[0] != key:
+            alpha, beta = act.alpha.detach(), beta.detach()
+            if act.alpha_logscale:
+                alpha = torch.exp(alpha)
+                beta = torch.exp(beta)
+            inv_beta = 1.0 / (beta + act.no_div_by_zero)
+            weight = self._polyphase_filter().repeat(x.size(1), 1).unsqueeze(1)  # [2C, 1, K/2 + 1]
+            self._cache = (key, weight.to(x), alpha.to(x)[:, None], inv_beta.to(x)[:, None])
+        return self._cache[1:]
+
+    # x: [B,C,T]
+    def forward(self, x):
+        B, C, T = x.shape
+        weight, alpha, inv_beta = self._params(x)
+        taps = weight.size(-1) - 1
+        # the first padded input sample used by the output sample 0 of `UpSample1d`, after its crop of pad_left
+        offset = (self.upsample.pad_left - self.upsample.kernel_size + 1) // 2
+        x = F.pad(x, (self.upsample.pad, self.upsample.pad), mode="replicate")[..., offset:offset + T + taps]
+        x = F.conv1d(x, weight, groups=C)  # [B, 2C, T]: the even and odd output samples of each channel
+        x = x.view(B, C, 2, T).transpose(2, 3).reshape(B, C, 2 * T)
+        # Snake(Beta): x + 1/beta * sin(alpha * x)^2
+        x = torch.addcmul(x, torch.sin(x * alpha).pow_(2), inv_beta)
+        return self.downsample(x)
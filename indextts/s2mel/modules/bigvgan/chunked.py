@@ -0,0 +1,145 @@
+import math
+import warnings
+from typing import Iterable, Iterator, Optional
+
+import torch
+
+from .env import AttrDict
+
+
+def receptive_field_frames(h: AttrDict, activation_radius: int = 6) -> int:
+    """
+    Upper bound of the one-sided receptive field of BigVGAN, in mel frames.
+    An output sample only depends on the mel frames within this distance, so a chunk vocoded with this much
+    context on each side is the same as the full-pass output.
+
+    Args:
+        activation_radius: one-sided reach of an `Activation1d` (2x up/down sampling with 12-tap filters),
+            in samples at the rate of its input
+    """
+    radius = 3.0  # conv_pre, kernel 7
+    scale = 1
+    for u, k in zip(h.upsample_rates, h.upsample_kernel_sizes):
+        scale *= u
+        radius += k / scale
+        # the resblocks of a stage run in parallel, the widest one bounds the stage
+        stage_radius = 0
+        for kernel_size, dilations in zip(h.resblock_kernel_sizes, h.resblock_dilation_sizes):
+            block_radius = 0
+            for d in dilations:
+                block_radius += (kernel_size - 1) * d // 2 + activation_radius
+                if h.resblock == "1":
+                    # convs2 with dilation 1 and its activation
+                    block_radius += (kernel_size - 1) // 2 + activation_radius
+            stage_radius = max(stage_radius, block_radius)
+        radius += stage_radius / scale
+    radius += (3 + activation_radius) / scale  # activation_post + conv_post, kernel 7
+    return int(math.ceil(radius))
+
+
+class ChunkedVocoder:
+    """
+    Vocode a mel spectrogram in windows and yield the waveform incrementally.
+
+    Each chunk of ``chunk_frames`` mel frames is vocoded with ``context_frames`` of real mel on both sides,
+    which covers the receptive field of the vocoder, and the neighbouring chunks are crossfaded over
+    ``2 * crossfade_frames`` frames. So the output is the same as the full pass up to float rounding,
+    while the peak memory only depends on the chunk size and the first audio is ready after the first chunk.
+
+    This only holds for the vocoders which are local in time (BigVGAN, Vocos). The vocoders with
+    ``exact_chunks = False`` (HiFT, whose sine source is accumulated over the whole signal) are chunked
+    approximately: the crossfades hide the seams, but the output differs from the full pass.
+    """
+
+    def __init__(self, vocoder: torch.nn.Module, hop_length: int, chunk_frames: int = 64,
+                 context_frames: Optional[int] = None, crossfade_frames: int = 2):
+        """
+        Args:
+            vocoder: mel [B, num_mels, frames] -> wav [B, 1, frames * hop_length], e.g. `BigVGAN`
+            hop_length: number of the samples per mel frame
+            chunk_frames: number of the mel frames yielded per chunk
+            context_frames: mel frames of context on each side, defaults to ``vocoder.context_frames``
+                or `receptive_field_frames(vocoder.h)` for BigVGAN
+            crossfade_frames: the chunks overlap by 2 * crossfade_frames frames
+        """
+        if context_frames is None:
+            context_frames = getattr(vocoder, "context_frames", None)
+        if context_frames is None:
+            context_frames = receptive_field_frames(vocoder.h)
+        assert chunk_frames >= 2 * crossfade_frames, "chunk_frames must cover the crossfade"
+        if not getattr(vocoder, "exact_chunks", True):
+            warnings.warn(f"{type(vocoder).__name__} has a global state, the chunked output is an approximation "
+                          f"of the full pass", RuntimeWarning)
+        self.vocoder = vocoder
+        self.hop_length = hop_length
+        self.chunk_frames = chunk_frames
+        self.context_frames = context_frames
+        self.crossfade_frames = crossfade_frames
+
+    def stream(self, mel: torch.Tensor, chunk_frames: Optional[int] = None) -> Iterator[torch.Tensor]:
+        """
+        Args:
+            mel: [B, num_mels, frames]
+        Yields:
+            consecutive pieces of the waveform [B, 1, samples], about ``chunk_frames * hop_length`` samples each
+        """
+        return self.stream_pieces([mel], chunk_frames)
+
+    @torch.inference_mode()
+    def stream_pieces(self, mel_pieces: Iterable[torch.Tensor],
+                      chunk_frames: Optional[int] = None) -> Iterator[torch.Tensor]:
+        """
+        Incremental `stream()`: the mel spectrogram arrives in consecutive pieces, e.g. from a streaming s2mel.
+        A chunk is vocoded as soon as its right context has arrived, so the output is the same as
+        ``stream(torch.cat(mel_pieces, dim=-1))``.
+
+        Args:
+            mel_pieces: consecutive pieces of the mel spectrogram [B, num_mels, frames_i]
+        Yields:
+            consecutive pieces of the waveform [B, 1, samples]
+        """
+        chunk_frames = chunk_frames or self.chunk_frames
+        mel = None
+        start = 0
+        prev_tail = None
+        for piece in mel_pieces:
+            mel = piece if mel is None else torch.cat([mel, piece], dim=-1)
+            # the right context of the chunk is complete
+            while start + chunk_frames + self.crossfade_frames + self.context_frames <= mel.size(-1):
+                wav, prev_tail = self._vocode_chunk(mel, start, start + chunk_frames, prev_tail, final=False)
+                start += chunk_frames
+                yield wav
+        while mel is not None and start < mel.size(-1):
+            end = min(mel.size(-1), start + chunk_frames)
+            wav, prev_tail = self._vocode_chunk(mel, start, end, prev_tail, final=end == mel.size(-1))
+            start = end
+            yield wav
+
+    def _vocode_chunk(self, mel: torch.Tensor, start: int, end: int, prev_tail: Optional[torch.Tensor],
+                      final: bool):
+        """
+        Vocode the frames [start, end) of ``mel`` with context, crossfaded with ``prev_tail``.
+        Returns: (waveform, the tail to crossfade with the next chunk or None if ``final``)
+        """
+        hop = self.hop_length
+        context, fade = self.context_frames, self.crossfade_frames
+        num_frames = mel.size(-1)
+        # the output of this chunk overlaps the neighbours by `fade` frames on each side
+        out_start, out_end = max(0, start - fade), min(num_frames, end + fade)
+        win_start, win_end = max(0, out_start - context), min(num_frames, out_end + context)
+        wav = self.vocoder(mel[..., win_start:win_end])
+        wav = wav[..., (out_start - win_start) * hop:(out_end - win_start) * hop]
+        if prev_tail is not None:
+            n = prev_tail.size(-1)
+            fade_in = torch.linspace(0, 1, n + 2, device=wav.device, dtype=wav.dtype)[1:-1]
+            wav = torch.cat([prev_tail * (1 - fade_in) + wav[..., :n] * fade_in, wav[..., n:]], dim=-1)
+        tail = None
+        # keep [end - fade, out_end) for the crossfade with the next chunk
+        keep = (out_end - (end - fade)) * hop
+        if not final and keep > 0:
+            tail = wav[..., -keep:]
+            wav = wav[..., :-keep]
+        return wav, tail
+
+    def __call__(self, mel: torch.Tensor, chunk_frames: Optional[int] = None) -> torch.Tensor:
+        return torch.cat(list(self.stream(mel, chunk_frames)), dim=-1)
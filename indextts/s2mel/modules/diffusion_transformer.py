@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 import math
 
 from indextts.s2mel.modules.gpt_fast.model import ModelArgs, Transformer
@@ -182,20 +183,40 @@ class DiT(torch.nn.Module):
 
     def setup_caches(self, max_batch_size, max_seq_length):
         self.transformer.setup_caches(max_batch_size, max_seq_length, use_kv_cache=False)
-        
-    def forward(self, x, prompt_x, x_lens, t, style, cond, mask_content=False):
+
+    def precompute_condition(self, prompt_x, style, cond, class_dropout=False):
+        """
+        The part of `cond_x_merge_linear` which does not depend on x: the projection of
+        [prompt_x, cond_projection(cond), style], it is the same at every diffusion step.
+            prompt_x: (batch_size, 80, T), style: (batch_size, 192), cond: (batch_size, T, 512)
+        Returns: (batch_size, T, D), the `static_cond` of `forward()`
+        """
+        weight = self.cond_x_merge_linear.weight[:, self.in_channels:]
+        bias = self.cond_x_merge_linear.bias
+        if class_dropout:
+            return bias.expand(prompt_x.size(0), prompt_x.size(-1), -1)
+        T = prompt_x.size(-1)
+        cond_in = torch.cat([prompt_x.transpose(1, 2), self.cond_projection(cond)], dim=-1)
+        if self.transformer_style_condition and not self.style_as_token:
+            cond_in = torch.cat([cond_in, style[:, None, :].repeat(1, T, 1)], dim=-1)
+        return F.linear(cond_in, weight, bias)
+
+    def forward(self, x, prompt_x, x_lens, t, style, cond, mask_content=False, static_cond=None):
         """
             x (torch.Tensor): random noise
             prompt_x (torch.Tensor): reference mel + zero mel
                 shape: (batch_size, 80, 795+1068)
-            x_lens (torch.Tensor): mel frames output
-                shape: (batch_size, mel_timesteps)
+            x_lens (torch.Tensor): mel frames output, None if there is no padding in the batch
+                shape: (batch_size,)
             t (torch.Tensor): radshape: 
                 shape: (batch_size)    
             style (torch.Tensor): reference global style
                 shape: (batch_size, 192)
             cond (torch.Tensor): semantic info of reference audio and altered audio
                 shape: (batch_size, mel_timesteps(795+1069), 512)
+            static_cond (torch.Tensor, optional): `precompute_condition(prompt_x, style, cond)`, reused by
+                all the diffusion steps instead of projecting prompt_x, cond and style again
+                shape: (batch_size, mel_timesteps, hidden_dim)
         
         """
         class_dropout = False
@@ -204,26 +225,20 @@ class DiT(torch.nn.Module):
         if not self.training and mask_content:
             class_dropout = True
         # cond_in_module = self.cond_embedder if self.content_type == 'discrete' else self.cond_projection
-        cond_in_module = self.cond_projection
 
         B, _, T = x.size()
 
 
         t1 = self.t_embedder(t)  # (N, D) # t1 [2, 512]
-        cond = cond_in_module(cond) # cond [2,1863,512]->[2,1863,512]
+
+        # cond_x_merge_linear([x, prompt_x, cond_projection(cond), style]) is split into the x part and
+        # the static part, 80+80+512+192=864 -> 512
+        if static_cond is None or class_dropout:
+            static_cond = self.precompute_condition(prompt_x, style, cond, class_dropout) # [2, 1863, 512]
 
         x = x.transpose(1, 2) # [2,1863,80]
-        prompt_x = prompt_x.transpose(1, 2) # [2,1863,80]
 
-        x_in = torch.cat([x, prompt_x, cond], dim=-1) # 80+80+512=672 [2, 1863, 672]
-        
-        if self.transformer_style_condition and not self.style_as_token: # True and True
-            x_in = torch.cat([x_in, style[:, None, :].repeat(1, T, 1)], dim=-1) #[2, 1863, 864]
-            
-        if class_dropout: #False
-            x_in[..., self.in_channels:] = x_in[..., self.in_channels:] * 0 # 80维后全置为0
-            
-        x_in = self.cond_x_merge_linear(x_in)  # (N, T, D) [2, 1863, 512]
+        x_in = F.linear(x, self.cond_x_merge_linear.weight[:, :self.in_channels]) + static_cond  # (N, T, D) [2, 1863, 512]
         
         if self.style_as_token: # False
             style = self.style_in(style)
@@ -233,10 +248,20 @@ class DiT(torch.nn.Module):
         if self.time_as_token: # False
             x_in = torch.cat([t1.unsqueeze(1), x_in], dim=1)
             
-        x_mask = sequence_mask(x_lens + self.style_as_token + self.time_as_token, max_length=x_in.size(1)).to(x.device).unsqueeze(1) #torch.Size([1, 1, 1863])True
+        if x_lens is None:
+            # no padding: no attention mask at all
+            x_mask = torch.ones(B, 1, x_in.size(1), dtype=torch.bool, device=x.device)
+            attn_mask = None
+        else:
+            x_mask = sequence_mask(x_lens + self.style_as_token + self.time_as_token, max_length=x_in.size(1)).to(x.device).unsqueeze(1) #torch.Size([1, 1, 1863])True
+            # key padding mask broadcast over the queries instead of a dense (T, T) mask
+            attn_mask = x_mask[:, None, :, :] # torch.Size([1, 1, 1, 1863])
         input_pos = self.input_pos[:x_in.size(1)]  # (T,) range（0，1863）
-        x_mask_expanded = x_mask[:, None, :].repeat(1, 1, x_in.size(1), 1) if not self.is_causal else None # torch.Size([1, 1, 1863, 1863]
-        x_res = self.transformer(x_in, t1.unsqueeze(1), input_pos, x_mask_expanded) # [2, 1863, 512]
+        if self.is_causal:
+            x_res = self.transformer(x_in, t1.unsqueeze(1), input_pos) # causal mask
+        else:
+            x_res = self.transformer(x_in, t1.unsqueeze(1), input_pos, attn_mask,
+                                     full_attention=attn_mask is None) # [2, 1863, 512]
         x_res = x_res[:, 1:] if self.time_as_token else x_res
         x_res = x_res[:, 1:] if self.style_as_token else x_res
         
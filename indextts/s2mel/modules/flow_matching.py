@@ -1,3 +1,4 @@
+import functools
 from abc import ABC
 
 import torch
@@ -8,6 +9,49 @@ from indextts.s2mel.modules.commons import sequence_mask
 
 from tqdm import tqdm
 
+
+def euler_step(f, x, t, dt):
+    return x + dt * f(x, t)
+
+
+def midpoint_step(f, x, t, dt):
+    k1 = f(x, t)
+    k2 = f(x + 0.5 * dt * k1, t + 0.5 * dt)
+    return x + dt * k2
+
+
+def heun_step(f, x, t, dt):
+    k1 = f(x, t)
+    k2 = f(x + dt * k1, t + dt)
+    return x + 0.5 * dt * (k1 + k2)
+
+
+def rk4_step(f, x, t, dt):
+    k1 = f(x, t)
+    k2 = f(x + 0.5 * dt * k1, t + 0.5 * dt)
+    k3 = f(x + 0.5 * dt * k2, t + 0.5 * dt)
+    k4 = f(x + dt * k3, t + dt)
+    return x + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+# name -> (step function, number of estimator evaluations per step)
+# a step function maps (velocity function f(x, t), x, t, dt) to x at t + dt
+ODE_SOLVERS = {
+    "euler": (euler_step, 1),
+    "midpoint": (midpoint_step, 2),
+    "heun": (heun_step, 2),
+    "rk4": (rk4_step, 4),
+}
+
+
+def sway_sampling(t_span, sway_coefficient):
+    """
+    Sway sampling time schedule (F5-TTS): a negative coefficient puts more steps near t = 0,
+    where the flow is the hardest to follow. ``sway_coefficient=-1`` is ``1 - cos(pi / 2 * t)``.
+    """
+    return t_span + sway_coefficient * (torch.cos(torch.pi / 2 * t_span) - 1 + t_span)
+
+
 class BASECFM(torch.nn.Module, ABC):
     def __init__(
         self,
@@ -28,14 +72,15 @@ class BASECFM(torch.nn.Module, ABC):
             self.zero_prompt_speech_token = False
 
     @torch.inference_mode()
-    def inference(self, mu, x_lens, prompt, style, f0, n_timesteps, temperature=1.0, inference_cfg_rate=0.5):
+    def inference(self, mu, x_lens, prompt, style, f0, n_timesteps, temperature=1.0, inference_cfg_rate=0.5,
+                  solver="euler", sway_coefficient=None, cfg_interval=None, prompt_cond=None):
         """Forward diffusion
 
         Args:
             mu (torch.Tensor): semantic info of reference audio and altered audio
                 shape: (batch_size, mel_timesteps(795+1069), 512)
-            x_lens (torch.Tensor): mel frames output
-                shape: (batch_size, mel_timesteps)
+            x_lens (torch.Tensor): valid mel frames of each item, the frames beyond are padding
+                shape: (batch_size,)
             prompt (torch.Tensor): reference mel
                 shape: (batch_size, 80, 795)
             style (torch.Tensor): reference global style
@@ -43,6 +88,13 @@ class BASECFM(torch.nn.Module, ABC):
             f0: None
             n_timesteps (int): number of diffusion steps
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
+            solver (str, optional): ODE solver in ``ODE_SOLVERS``, the estimator is evaluated
+                n_timesteps * (1 for euler, 2 for midpoint/heun, 4 for rk4) times. Defaults to "euler".
+            sway_coefficient (float, optional): sway sampling of the time steps, e.g. -1.0, None for uniform steps.
+            cfg_interval (tuple, optional): (t_start, t_end) of the classifier-free guidance, e.g. (0.0, 0.5)
+                skips the doubled batch on the late steps. None to guide all the steps.
+            prompt_cond (torch.Tensor, optional): ``estimator.precompute_condition(prompt, style, prompt mu)`` of the
+                speaker prompt, cached per voice, see ``solve_ode``.
 
         Returns:
             sample: generated mel-spectrogram
@@ -51,26 +103,44 @@ class BASECFM(torch.nn.Module, ABC):
         B, T = mu.size(0), mu.size(1)
         z = torch.randn([B, self.in_channels, T], device=mu.device) * temperature
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device)
-        # t_span = t_span + (-1) * (torch.cos(torch.pi / 2 * t_span) - 1 + t_span)
-        return self.solve_euler(z, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate)
+        if sway_coefficient is not None:
+            t_span = sway_sampling(t_span, sway_coefficient)
+        return self.solve_ode(z, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate, solver=solver,
+                              cfg_interval=cfg_interval, prompt_cond=prompt_cond)
 
     def solve_euler(self, x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate=0.5):
         """
-        Fixed euler solver for ODEs.
+        Fixed euler solver for ODEs, see ``solve_ode``.
+        """
+        return self.solve_ode(x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate, solver="euler")
+
+    def solve_ode(self, x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate=0.5, solver="euler",
+                  cfg_interval=None, prompt_cond=None):
+        """
+        Fixed step solver for ODEs.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
                 shape: (n_timesteps + 1,)
             mu (torch.Tensor): semantic info of reference audio and altered audio
                 shape: (batch_size, mel_timesteps(795+1069), 512)
-            x_lens (torch.Tensor): mel frames output
-                shape: (batch_size, mel_timesteps)
+            x_lens (torch.Tensor): valid mel frames of each item, the frames beyond are padding
+                shape: (batch_size,)
             prompt (torch.Tensor): reference mel
                 shape: (batch_size, 80, 795)
             style (torch.Tensor): reference global style
                 shape: (batch_size, 192)
+            solver (str): name of the solver in ``ODE_SOLVERS``
+            cfg_interval (tuple, optional): (t_start, t_end), the classifier-free guidance is only applied to the
+                steps starting in [t_start, t_end), the other steps run the conditional half only. None for all steps.
+            prompt_cond (torch.Tensor, optional): the conditional ``static_cond`` of the first frames of the prompt,
+                shape: (1 or batch_size, P, hidden_dim), P <= prompt length. The estimator condition is projected
+                frame by frame, so only the frames after them (the rest of the prompt and the target) are projected.
         """
-        t, _, _ = t_span[0], t_span[-1], t_span[1] - t_span[0]
+        if solver not in ODE_SOLVERS:
+            raise ValueError(f"Unknown ODE solver {solver}, supported: {list(ODE_SOLVERS.keys())}")
+        step_fn, _ = ODE_SOLVERS[solver]
+        t = t_span[0]
 
         # I am storing this because I can later plot it by putting a debugger here and saving it to a file
         # Or in future might add like a return_all_steps flag
@@ -82,19 +152,52 @@ class BASECFM(torch.nn.Module, ABC):
         x[..., :prompt_len] = 0
         if self.zero_prompt_speech_token:
             mu[..., :prompt_len] = 0
-        for step in tqdm(range(1, len(t_span))):
-            dt = t_span[step] - t_span[step - 1]
-            if inference_cfg_rate > 0:
-                # Stack original and CFG (null) inputs for batched processing
-                stacked_prompt_x = torch.cat([prompt_x, torch.zeros_like(prompt_x)], dim=0)
-                stacked_style = torch.cat([style, torch.zeros_like(style)], dim=0)
-                stacked_mu = torch.cat([mu, torch.zeros_like(mu)], dim=0)
-                stacked_x = torch.cat([x, x], dim=0)
-                stacked_t = torch.cat([t.unsqueeze(0), t.unsqueeze(0)], dim=0)
+
+        if x_lens is not None and bool((x_lens == x.size(-1)).all()):
+            # no padding, the estimator can skip the attention mask
+            x_lens = None
+        # the projection of prompt_x, mu and style is the same at every step, computed once by the estimator
+        precompute_condition = getattr(self.estimator, "precompute_condition", None)
+        if self.zero_prompt_speech_token:
+            # mu is changed above, the cached condition of the prompt doesn't apply
+            prompt_cond = None
+        cond_kwargs = {}
+        if precompute_condition is not None:
+            if prompt_cond is not None:
+                cached_len = prompt_cond.size(1)
+                cond_kwargs["static_cond"] = torch.cat([
+                    prompt_cond.to(mu.dtype).expand(x.size(0), -1, -1),
+                    precompute_condition(prompt_x[..., cached_len:], style, mu[:, cached_len:]),
+                ], dim=1)
+            else:
+                cond_kwargs["static_cond"] = precompute_condition(prompt_x, style, mu)
+        if inference_cfg_rate > 0:
+            # Stack original and CFG (null) inputs for batched processing,
+            # the conditions do not change between the steps, only x is copied in at each step
+            batch_size = x.size(0)
+            stacked_prompt_x = torch.cat([prompt_x, torch.zeros_like(prompt_x)], dim=0)
+            stacked_style = torch.cat([style, torch.zeros_like(style)], dim=0)
+            stacked_mu = torch.cat([mu, torch.zeros_like(mu)], dim=0)
+            stacked_x_lens = torch.cat([x_lens, x_lens], dim=0) if x_lens is not None else None
+            stacked_x = torch.empty_like(stacked_prompt_x)
+            stacked_cond_kwargs = {}
+            if precompute_condition is not None:
+                # the null half has all-zero inputs: the same condition at every frame
+                null_cond = precompute_condition(stacked_prompt_x[batch_size:, :, :1], stacked_style[batch_size:],
+                                                 stacked_mu[batch_size:, :1])
+                stacked_cond_kwargs["static_cond"] = torch.cat(
+                    [cond_kwargs["static_cond"], null_cond.expand(-1, x.size(-1), -1)], dim=0)
+
+        def velocity(x, t, guided):
+            if guided:
+                stacked_x[:batch_size].copy_(x)
+                stacked_x[batch_size:].copy_(x)
+                stacked_t = t.unsqueeze(0).repeat(stacked_x.size(0))
 
                 # Perform a single forward pass for both original and CFG inputs
                 stacked_dphi_dt = self.estimator(
-                    stacked_x, stacked_prompt_x, x_lens, stacked_t, stacked_style, stacked_mu,
+                    stacked_x, stacked_prompt_x, stacked_x_lens, stacked_t, stacked_style, stacked_mu,
+                    **stacked_cond_kwargs,
                 )
 
                 # Split the output back into the original and CFG components
@@ -103,14 +206,21 @@ class BASECFM(torch.nn.Module, ABC):
                 # Apply CFG formula
                 dphi_dt = (1.0 + inference_cfg_rate) * dphi_dt - inference_cfg_rate * cfg_dphi_dt
             else:
-                dphi_dt = self.estimator(x, prompt_x, x_lens, t.unsqueeze(0), style, mu)
+                dphi_dt = self.estimator(x, prompt_x, x_lens, t.unsqueeze(0).repeat(x.size(0)), style, mu,
+                                         **cond_kwargs)
+            # the range covered by the prompt stays 0, also in the intermediate states of the solver
+            dphi_dt[:, :, :prompt_len] = 0
+            return dphi_dt
 
-            x = x + dt * dphi_dt
-            t = t + dt
+        t_list = t_span.tolist()
+        for step in tqdm(range(1, len(t_span))):
+            dt = t_span[step] - t_span[step - 1]
+            guided = inference_cfg_rate > 0 and (
+                cfg_interval is None or cfg_interval[0] <= t_list[step - 1] < cfg_interval[1]
+            )
+            x = step_fn(functools.partial(velocity, guided=guided), x, t, dt)
+            t = t_span[step]
             sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-            x[:, :, :prompt_len] = 0
 
         return sol[-1]
     def forward(self, x1, x_lens, prompt_lens, mu, style):
@@ -120,8 +230,8 @@ class BASECFM(torch.nn.Module, ABC):
             mu (torch.Tensor): semantic info of reference audio and altered audio
                 shape: (batch_size, mel_timesteps(795+1069), 512)
             x1: mel
-            x_lens (torch.Tensor): mel frames output
-                shape: (batch_size, mel_timesteps)
+            x_lens (torch.Tensor): valid mel frames of each item, the frames beyond are padding
+                shape: (batch_size,)
             prompt (torch.Tensor): reference mel
                 shape: (batch_size, 80, 795)
             style (torch.Tensor): reference global style
@@ -165,9 +165,16 @@ class Transformer(nn.Module):
                 context: Optional[Tensor] = None,
                 context_input_pos: Optional[Tensor] = None,
                 cross_attention_mask: Optional[Tensor] = None,
+                full_attention: bool = False,
                 ) -> Tensor:
+        """
+        mask: attention mask broadcastable to (bsz, n_head, seqlen, seqlen), e.g. a (bsz, 1, 1, seqlen) key padding mask,
+            None for the causal mask
+        full_attention: attend to all the positions without any mask (non-causal and no padding),
+            so that scaled_dot_product_attention can use the flash kernel
+        """
         assert self.freqs_cis is not None, "Caches must be initialized first"
-        if mask is None: # in case of non-causal model
+        if mask is None and not full_attention: # in case of non-causal model
             if not self.training and self.use_kv_cache:
                 mask = self.causal_mask[None, None, input_pos]
             else:
@@ -0,0 +1,170 @@
+import inspect
+import math
+import os
+from typing import Callable, Dict
+
+import torch
+from omegaconf import OmegaConf
+from torch import nn
+
+# cfg.vocoder.type -> builder(vocoder_cfg, model_dir, use_cuda_kernel, use_cpu_kernel) -> mel vocoder
+VOCODER_REGISTRY: Dict[str, Callable[..., nn.Module]] = {}
+
+
+def register_vocoder(name: str):
+    def decorator(builder):
+        VOCODER_REGISTRY[name] = builder
+        return builder
+
+    return decorator
+
+
+def build_vocoder(vocoder_cfg, model_dir: str = "checkpoints", use_cuda_kernel: bool = False,
+                  use_cpu_kernel: bool = False) -> nn.Module:
+    """
+    Build the vocoder of ``cfg.vocoder.type``, "bigvgan" by default.
+
+    Every vocoder has the same interface as BigVGAN: ``forward(mel [B, num_mels, frames]) -> wav [B, 1, samples]``,
+    in eval mode and ready for inference. The other vocoders must be trained on the same mel spectrogram
+    as the s2mel output (80 bands, 22050Hz, hop 256), and have a ``context_frames`` attribute, the receptive field
+    used by `ChunkedVocoder`, and ``exact_chunks = False`` if they have a global state that the chunks cannot see.
+    """
+    vocoder_type = vocoder_cfg.get("type", "bigvgan")
+    if vocoder_type not in VOCODER_REGISTRY:
+        raise ValueError(f"Unknown vocoder type {vocoder_type}, supported: {list(VOCODER_REGISTRY.keys())}")
+    return VOCODER_REGISTRY[vocoder_type](vocoder_cfg, model_dir, use_cuda_kernel, use_cpu_kernel)
+
+
+def _load_state_dict(model: nn.Module, vocoder_cfg, model_dir: str):
+    checkpoint = vocoder_cfg.checkpoint
+    if not os.path.isfile(checkpoint):
+        checkpoint = os.path.join(model_dir, checkpoint)
+    state_dict = torch.load(checkpoint, map_location="cpu")
+    if "state_dict" in state_dict:
+        state_dict = state_dict["state_dict"]
+    model.load_state_dict(state_dict)
+    return checkpoint
+
+
+@register_vocoder("bigvgan")
+def build_bigvgan(vocoder_cfg, model_dir, use_cuda_kernel=False, use_cpu_kernel=False):
+    from indextts.s2mel.modules.bigvgan import bigvgan
+
+    model = bigvgan.BigVGAN.from_pretrained(vocoder_cfg.name, use_cuda_kernel=use_cuda_kernel,
+                                             use_cpu_kernel=use_cpu_kernel)
+    model.remove_weight_norm()
+    model.eval()
+    print(">> bigvgan weights restored from:", vocoder_cfg.name)
+    return model
+
+
+class VocosVocoder(nn.Module):
+    """
+    Vocos (ConvNeXt backbone + iSTFT head) with the BigVGAN interface, much cheaper than BigVGAN on CPU.
+    config:
+        vocoder:
+            type: "vocos"
+            checkpoint: "vocos.pth"
+            vocos: {backbone: {input_channels, dim, intermediate_dim, num_layers}, head: {dim, n_fft, hop_length, padding}}
+    """
+
+    def __init__(self, vocoder_cfg):
+        super().__init__()
+        from indextts.s2mel.modules.vocos import Vocos
+
+        self.vocos = Vocos(vocoder_cfg)
+        backbone, head = vocoder_cfg.vocos.backbone, vocoder_cfg.vocos.head
+        # embed conv + the depthwise convs (kernel 7) of the ConvNeXt blocks + the iSTFT window
+        self.context_frames = 3 * (backbone.num_layers + 1) + head.n_fft // head.hop_length
+
+    def forward(self, mel: torch.Tensor) -> torch.Tensor:
+        return self.vocos(mel).unsqueeze(1)
+
+
+@register_vocoder("vocos")
+def build_vocos(vocoder_cfg, model_dir, use_cuda_kernel=False, use_cpu_kernel=False):
+    model = VocosVocoder(vocoder_cfg)
+    checkpoint = _load_state_dict(model.vocos, vocoder_cfg, model_dir)
+    model.eval()
+    print(">> vocos weights restored from:", checkpoint)
+    return model
+
+
+def hift_receptive_field_frames(hift_kwargs: Dict) -> int:
+    """
+    Upper bound of the one-sided receptive field of the HiFT convolutions and STFTs, in mel frames.
+    It does not cover the NSF source, whose phase is accumulated over the whole signal, see `HiFTVocoder`.
+
+    Args:
+        hift_kwargs: kwargs of `HiFTGenerator`, the missing ones take its defaults
+    """
+    from indextts.s2mel.modules.hifigan.generator import HiFTGenerator
+
+    params = {name: p.default for name, p in inspect.signature(HiFTGenerator.__init__).parameters.items()
+              if p.default is not inspect.Parameter.empty}
+    params.update(hift_kwargs)
+    n_fft, hop_len = params["istft_params"]["n_fft"], params["istft_params"]["hop_len"]
+
+    def resblock_radius(kernel_size, dilations):
+        # convs1 with dilation d + convs2 with dilation 1, per dilation
+        return sum((kernel_size - 1) * d // 2 + (kernel_size - 1) // 2 for d in dilations)
+
+    radius = 5.0  # ConvRNNF0Predictor, 5 convs with kernel 3
+    radius += 3.0  # conv_pre, kernel 7
+    scale = 1
+    upsample_rates = params["upsample_rates"]
+    total_scale = math.prod(upsample_rates)
+    for i, (u, k) in enumerate(zip(upsample_rates, params["upsample_kernel_sizes"])):
+        scale *= u
+        radius += k / scale
+        # the resblocks of a stage run in parallel, the widest one bounds the stage
+        radius += max(resblock_radius(kernel_size, dilations) for kernel_size, dilations in
+                      zip(params["resblock_kernel_sizes"], params["resblock_dilation_sizes"])) / scale
+        # source fusion: STFT of the source, the strided downsampling conv and the source resblock
+        if i < len(params["source_resblock_kernel_sizes"]):
+            down = total_scale // scale
+            radius += (n_fft / hop_len + 2 * down) / total_scale
+            radius += resblock_radius(params["source_resblock_kernel_sizes"][i],
+                                      params["source_resblock_dilation_sizes"][i]) / scale
+    radius += 3 / total_scale  # conv_post, kernel 7
+    radius += n_fft / hop_len / total_scale  # iSTFT overlap-add
+    return int(math.ceil(radius))
+
+
+class HiFTVocoder(nn.Module):
+    """
+    HiFT (neural source filter + iSTFTNet) with the BigVGAN interface.
+    config:
+        vocoder:
+            type: "hifigan"
+            checkpoint: "hift.pt"
+            hift: kwargs of `HiFTGenerator` (without f0_predictor)
+
+    Chunking is approximate for this vocoder: the sine source takes its phase from the cumulative sum of F0 over
+    the whole input, with a random initial phase and additive noise, so `ChunkedVocoder` can only match the
+    full pass in the receptive field of the convolutions (``context_frames``), not sample for sample.
+    """
+
+    # the output of a chunk with context is not the same as the full pass, see `ChunkedVocoder`
+    exact_chunks = False
+
+    def __init__(self, vocoder_cfg):
+        super().__init__()
+        from indextts.s2mel.modules.hifigan.generator import HiFTGenerator
+        from indextts.s2mel.modules.hifigan.f0_predictor import ConvRNNF0Predictor
+
+        hift_kwargs = OmegaConf.to_container(vocoder_cfg.hift) if "hift" in vocoder_cfg else {}
+        self.generator = HiFTGenerator(**hift_kwargs, f0_predictor=ConvRNNF0Predictor())
+        self.context_frames = hift_receptive_field_frames(hift_kwargs)
+
+    def forward(self, mel: torch.Tensor) -> torch.Tensor:
+        return self.generator(mel).unsqueeze(1)
+
+
+@register_vocoder("hifigan")
+def build_hift(vocoder_cfg, model_dir, use_cuda_kernel=False, use_cpu_kernel=False):
+    model = HiFTVocoder(vocoder_cfg)
+    checkpoint = _load_state_dict(model.generator, vocoder_cfg, model_dir)
+    model.eval()
+    print(">> hifigan weights restored from:", checkpoint)
+    return model
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import torch
+from safetensors.torch import load_file, save_file
+
+
+def audio_content_hash(audio_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    sha256 of the audio file content, so that a renamed or copied prompt hits the same cache entry.
+    """
+    h = hashlib.sha256()
+    with open(audio_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tensors_nbytes(tensors: Dict[str, torch.Tensor]) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+class ConditioningCache:
+    """
+    Content-hash keyed store of the speaker/emotion conditioning tensors.
+
+    - in memory: a LRU limited by ``max_bytes``
+    - on disk (optional): one ``<key>.safetensors`` file per entry in ``cache_dir``,
+      so that other workers and later runs can reuse the precomputed conditioning.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = 512 * 1024 * 1024, device=None,
+                 max_paths: int = 4096):
+        """
+        Args:
+            cache_dir (str): directory of the safetensors files, ``None`` to keep the cache in memory only.
+            max_bytes (int): byte budget of the in-memory LRU, ``0`` to disable the in-memory cache.
+            device: the device which the cached tensors are loaded to.
+            max_paths (int): max number of the audio paths whose content hash is remembered (LRU).
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.device = device
+        self._entries: "OrderedDict[str, Dict[str, torch.Tensor]]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.max_paths = max_paths
+        # path -> (mtime, size, content hash), avoids re-reading an unchanged file
+        self._path_hashes: "OrderedDict[str, tuple]" = OrderedDict()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        if key in self._entries:
+            return True
+        disk_path = self._disk_path(key)
+        return disk_path is not None and os.path.isfile(disk_path)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def hash_audio(self, audio_path: str) -> str:
+        stat = os.stat(audio_path)
+        path = os.path.abspath(audio_path)
+        with self._lock:
+            entry = self._path_hashes.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._path_hashes.move_to_end(path)
+                return entry[2]
+        digest = audio_content_hash(audio_path)
+        with self._lock:
+            # a modified file replaces its old entry
+            self._path_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+            self._path_hashes.move_to_end(path)
+            while len(self._path_hashes) > max(1, self.max_paths):
+                self._path_hashes.popitem(last=False)
+        return digest
+
+    def _disk_path(self, key: str) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def _put_memory(self, key: str, tensors: Dict[str, torch.Tensor]):
+        nbytes = tensors_nbytes(tensors)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= tensors_nbytes(old)
+            self._entries[key] = tensors
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= tensors_nbytes(evicted)
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        with self._lock:
+            tensors = self._entries.get(key)
+            if tensors is not None:
+                self._entries.move_to_end(key)
+                return tensors
+        disk_path = self._disk_path(key)
+        if disk_path is None or not os.path.isfile(disk_path):
+            return None
+        try:
+            tensors = load_file(disk_path, device=str(self.device) if self.device is not None else "cpu")
+        except Exception as e:
+            print(f">> failed to load the conditioning cache {disk_path}: {e}")
+            return None
+        self._put_memory(key, tensors)
+        return tensors
+
+    def put(self, key: str, tensors: Dict[str, torch.Tensor], persist: bool = True):
+        """
+        Args:
+            persist (bool): whether to write the entry to ``cache_dir`` too.
+        """
+        self._put_memory(key, tensors)
+        disk_path = self._disk_path(key)
+        if persist and disk_path is not None and not os.path.isfile(disk_path):
+            # write to a temp file first, the other workers may be reading the cache dir
+            tmp_path = f"{disk_path}.{os.getpid()}.tmp"
+            save_file({k: v.detach().contiguous().cpu() for k, v in tensors.items()}, tmp_path)
+            os.replace(tmp_path, disk_path)
+
+    def preload(self, prefix: str = "") -> int:
+        """
+        Load the entries in ``cache_dir`` whose key starts with ``prefix`` into memory, until the byte budget is full.
+        Returns: the number of the loaded entries
+        """
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return 0
+        count = 0
+        for name in sorted(os.listdir(self.cache_dir)):
+            if not name.endswith(".safetensors") or not name.startswith(prefix):
+                continue
+            disk_path = os.path.join(self.cache_dir, name)
+            if self._nbytes + os.path.getsize(disk_path) > self.max_bytes:
+                break
+            if self.get(name[:-len(".safetensors")]) is not None:
+                count += 1
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._path_hashes.clear()
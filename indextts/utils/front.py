@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-from functools import lru_cache
+from collections import OrderedDict
 import os
+import threading
 import traceback
 import re
 from typing import List, Union, overload
@@ -10,7 +11,12 @@ from sentencepiece import SentencePieceProcessor
 
 
 class TextNormalizer:
-    def __init__(self, enable_glossary=False):
+    def __init__(self, enable_glossary=False, cache_size=1024):
+        """
+        Args:
+            enable_glossary: 是否应用术语词汇表
+            cache_size: 句子级 normalize 结果的 LRU 缓存容量，0 表示不缓存
+        """
         self.zh_normalizer = None
         self.en_normalizer = None
         self.char_rep_map = {
@@ -54,6 +60,8 @@ class TextNormalizer:
             "$": ".",
             **self.char_rep_map,
         }
+        self.char_rep_pattern = re.compile("|".join(re.escape(p) for p in self.char_rep_map.keys()))
+        self.zh_char_rep_pattern = re.compile("|".join(re.escape(p) for p in self.zh_char_rep_map.keys()))
         self.enable_glossary = enable_glossary
         # 术语词汇表：用户可自定义专业术语的读法
         # 格式: {"原始术语": {"en": "英文读法", "zh": "中文读法"}}
@@ -72,11 +80,21 @@ class TextNormalizer:
         #     "CMake": "C Make",
         # }
         self.term_glossary = dict()
+        # 编译后的术语匹配器，仅在词汇表变化时重建
+        self._glossary_matcher = None
+        self.glossary_version = 0
+        # (sentence, lang, glossary_version) -> normalized sentence
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _invalidate_glossary(self):
+        self._glossary_matcher = None
+        self.glossary_version += 1
 
     def match_email(self, email):
         # 正则表达式匹配邮箱格式：数字英文@数字英文.英文
-        pattern = r"^[a-zA-Z0-9]+@[a-zA-Z0-9]+\.[a-zA-Z]+$"
-        return re.match(pattern, email) is not None
+        return TextNormalizer._EMAIL_RE.match(email) is not None
 
     PINYIN_TONE_PATTERN = r"(?<![a-z])((?:[bpmfdtnlgkhjqxzcsryw]|[zcs]h)?(?:[aeiouüv]|[ae]i|u[aio]|ao|ou|i[aue]|[uüv]e|[uvü]ang?|uai|[aeiuv]n|[aeio]ng|ia[no]|i[ao]ng)|ng|er)([1-5])"
     """
@@ -101,15 +119,34 @@ class TextNormalizer:
     # 匹配常见英语缩写 's，仅用于替换为 is，不匹配所有 's
     ENGLISH_CONTRACTION_PATTERN = r"(what|where|who|which|how|t?here|it|s?he|that|this)'s"
 
+    # 预编译的正则
+    _PINYIN_TONE_RE = re.compile(PINYIN_TONE_PATTERN, re.IGNORECASE)
+    _NAME_RE = re.compile(NAME_PATTERN, re.IGNORECASE)
+    _TECH_TERM_RE = re.compile(TECH_TERM_PATTERN)
+    _ENGLISH_CONTRACTION_RE = re.compile(ENGLISH_CONTRACTION_PATTERN, re.IGNORECASE)
+    _EMAIL_RE = re.compile(r"^[a-zA-Z0-9]+@[a-zA-Z0-9]+\.[a-zA-Z]+$")
+    _CHINESE_RE = re.compile(r"[\u4e00-\u9fff]")
+    _ALPHA_RE = re.compile(r"[a-zA-Z]")
+    _JQX_PINYIN_RE = re.compile(r"([jqx])[uü](n|e|an)*(\d)", re.IGNORECASE)
+    _TECH_HYPHEN_RE = re.compile(r"\s*<H>\s*")
+    # 按句缓存时的句末：中文句末标点，或后接空白及大写字母/非 ASCII 字符的 .!?
+    # （连同紧随的右引号、右括号），避免切开小数、M.2 这类术语以及 "e.g. this"
+    _SENTENCE_END_RE = re.compile(r"[。！？；][”’」』）)]*|[.!?][\"'”’)]*(?=\s+(?:[A-Z]|[^\x00-\x7f]))")
+    # 句点后不切分的常见英文缩写（小写比较），如 "Dr. Smith"、"No. 5"
+    _ABBREVIATIONS = frozenset([
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "no", "vs", "etc", "fig", "inc", "ltd", "co",
+        "corp", "dept", "est", "approx", "gen", "gov", "rev", "sgt", "capt", "col", "lt", "jan", "feb", "mar",
+        "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+    ])
 
     def use_chinese(self, s):
-        has_chinese = bool(re.search(r"[\u4e00-\u9fff]", s))
-        has_alpha = bool(re.search(r"[a-zA-Z]", s))
+        has_chinese = bool(TextNormalizer._CHINESE_RE.search(s))
+        has_alpha = bool(TextNormalizer._ALPHA_RE.search(s))
         is_email = self.match_email(s)
         if has_chinese or not has_alpha or is_email:
             return True
 
-        has_pinyin = bool(re.search(TextNormalizer.PINYIN_TONE_PATTERN, s, re.IGNORECASE))
+        has_pinyin = bool(TextNormalizer._PINYIN_TONE_RE.search(s))
         return has_pinyin
 
     def load(self):
@@ -141,8 +178,67 @@ class TextNormalizer:
         if not self.zh_normalizer or not self.en_normalizer:
             print("Error, text normalizer is not initialized !!!")
             return ""
-        if self.use_chinese(text):
-            text = re.sub(TextNormalizer.ENGLISH_CONTRACTION_PATTERN, r"\1 is", text, flags=re.IGNORECASE)
+        # 语言按整段文本判断，与不缓存时保持一致
+        lang = "zh" if self.use_chinese(text) else "en"
+        if self.cache_size <= 0:
+            return self._normalize(text, lang)
+        # 按句缓存：重复的句子（开场白、章节标题等）即使出现在不同的文本中也直接复用结果，
+        # 词汇表变化后自动失效
+        glossary_version = self.glossary_version if self.enable_glossary else None
+        result = []
+        for sentence, separator in self.split_sentences(text):
+            result.append(self._normalize_cached(sentence, lang, glossary_version))
+            # 句间空白不经过 normalizer，按 char_rep_map 处理（换行 -> 空格）
+            result.append(self.char_rep_pattern.sub(lambda x: self.char_rep_map[x.group()], separator))
+        return "".join(result)
+
+    def split_sentences(self, text: str):
+        """
+        按句末标点切分文本，用于按句缓存 normalize 结果
+
+        Returns:
+            [(句子, 句后空白), ...]，拼接后与原文本一致；最后一句保留末尾的空白
+        """
+        sentences = []
+        start = 0
+        for match in TextNormalizer._SENTENCE_END_RE.finditer(text):
+            end = match.end()
+            if end <= start:
+                continue
+            if match.group()[0] == ".":
+                words = text[start:match.start()].split()
+                word = words[-1].lstrip("\"'“‘(（") if words else ""
+                # 缩写、首字母（J. K. Rowling）和 U.S. 这类带点的词
+                if (len(word) == 1 and word.isalpha()) or "." in word \
+                        or word.lower() in TextNormalizer._ABBREVIATIONS:
+                    continue
+            sep_end = end
+            while sep_end < len(text) and text[sep_end].isspace():
+                sep_end += 1
+            if sep_end == len(text):
+                break
+            sentences.append((text[start:end], text[end:sep_end]))
+            start = sep_end
+        sentences.append((text[start:], ""))
+        return sentences
+
+    def _normalize_cached(self, sentence: str, lang: str, glossary_version) -> str:
+        key = (sentence, lang, glossary_version)
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                return result
+        result = self._normalize(sentence, lang)
+        with self._cache_lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _normalize(self, text: str, lang: str) -> str:
+        if lang == "zh":
+            text = TextNormalizer._ENGLISH_CONTRACTION_RE.sub(r"\1 is", text)
             # 应用术语词汇表（优先级最高，在所有保护之前）
             if self.enable_glossary:
                 text = self.apply_glossary_terms(text, lang="zh")
@@ -162,11 +258,10 @@ class TextNormalizer:
             result = self.restore_pinyin_tones(result, pinyin_list)
             # 恢复技术术语
             result = self.restore_tech_terms(result, tech_list)
-            pattern = re.compile("|".join(re.escape(p) for p in self.zh_char_rep_map.keys()))
-            result = pattern.sub(lambda x: self.zh_char_rep_map[x.group()], result)
+            result = self.zh_char_rep_pattern.sub(lambda x: self.zh_char_rep_map[x.group()], result)
         else:
             try:
-                text = re.sub(TextNormalizer.ENGLISH_CONTRACTION_PATTERN, r"\1 is", text, flags=re.IGNORECASE)
+                text = TextNormalizer._ENGLISH_CONTRACTION_RE.sub(r"\1 is", text)
                 # 应用术语词汇表（优先级最高，在所有保护之前）
                 if self.enable_glossary:
                     text = self.apply_glossary_terms(text, lang="en")
@@ -178,8 +273,7 @@ class TextNormalizer:
             except Exception:
                 result = text
                 print(traceback.format_exc())
-            pattern = re.compile("|".join(re.escape(p) for p in self.char_rep_map.keys()))
-            result = pattern.sub(lambda x: self.char_rep_map[x.group()], result)
+            result = self.char_rep_pattern.sub(lambda x: self.char_rep_map[x.group()], result)
         return result
 
     def correct_pinyin(self, pinyin: str):
@@ -190,9 +284,8 @@ class TextNormalizer:
         if pinyin[0] not in "jqxJQX":
             return pinyin
         # 匹配 jqx 的韵母为 u/ü 的拼音
-        pattern = r"([jqx])[uü](n|e|an)*(\d)"
         repl = r"\g<1>v\g<2>\g<3>"
-        pinyin = re.sub(pattern, repl, pinyin, flags=re.IGNORECASE)
+        pinyin = TextNormalizer._JQX_PINYIN_RE.sub(repl, pinyin)
         return pinyin.upper()
 
     def save_names(self, original_text):
@@ -201,8 +294,7 @@ class TextNormalizer:
         例如：克里斯托弗·诺兰 -> <n_a>
         """
         # 人名
-        name_pattern = re.compile(TextNormalizer.NAME_PATTERN, re.IGNORECASE)
-        original_name_list = re.findall(name_pattern, original_text)
+        original_name_list = TextNormalizer._NAME_RE.findall(original_text)
         if len(original_name_list) == 0:
             return (original_text, None)
         original_name_list = list(set("".join(n) for n in original_name_list))
@@ -236,8 +328,7 @@ class TextNormalizer:
         例如：GPT-5-nano -> GPT<H>5<H>nano，然后 5 被转换为 五
         最终恢复为：GPT-五-nano
         """
-        tech_pattern = re.compile(TextNormalizer.TECH_TERM_PATTERN)
-        original_tech_list = tech_pattern.findall(original_text)
+        original_tech_list = TextNormalizer._TECH_TERM_RE.findall(original_text)
         if len(original_tech_list) == 0:
             return (original_text, None)
 
@@ -264,7 +355,7 @@ class TextNormalizer:
 
         # 清理 <H> 周围可能的空格，然后恢复为连字符
         # 处理模式: " <H> " -> "-", " <H>" -> "-", "<H> " -> "-", "<H>" -> "-"
-        transformed_text = re.sub(r'\s*<H>\s*', '-', normalized_text)
+        transformed_text = TextNormalizer._TECH_HYPHEN_RE.sub('-', normalized_text)
         return transformed_text
 
     def apply_glossary_terms(self, text, lang="zh"):
@@ -284,25 +375,63 @@ class TextNormalizer:
         """
         if not self.term_glossary:
             return text
-
-        # 按术语长度降序排列，避免短术语先匹配导致长术语无法匹配
-        # 例如："PCIe 5.0" 应该在 "PCIe" 之前匹配
-        sorted_terms = sorted(self.term_glossary.keys(), key=len, reverse=True)
-        @lru_cache(maxsize=42)
-        def get_term_pattern(term: str):
-            return re.compile(re.escape(term), re.IGNORECASE)
-        transformed_text = text
-        for term in sorted_terms:
+        if self._glossary_matcher is None:
+            self._glossary_matcher = self._build_glossary_matcher()
+        pattern, lookup = self._glossary_matcher
+
+        def replace(match):
+            matched = match.group()
+            term = lookup.get(matched.casefold())
+            if term is None:
+                # 与术语写法不同的大小写变体（如 "İ" 匹配到 "i"），逐个比较
+                term = next((t for t in self.term_glossary if re.fullmatch(re.escape(t), matched, re.IGNORECASE)),
+                            None)
+                if term is None:
+                    return matched
             term_value = self.term_glossary[term]
             if isinstance(term_value, dict):
-                replacement = term_value.get(lang, term_value.get(lang, term))
-            else:
-                replacement = term_value
-            # 使用正则进行大小写不敏感的替换
-            pattern = get_term_pattern(term)
-            transformed_text = pattern.sub(replacement, transformed_text)
+                return term_value.get(lang, term)
+            return term_value
 
-        return transformed_text
+        # 单次扫描，每个位置取最长的术语
+        # 例如："PCIe 5.0" 优先于 "PCIe"
+        # 注意：从左到右扫描，更靠前的短术语优先于与其重叠的长术语，
+        # 例如术语 "XA" 与 "ABCD" 作用于 "XABCD" 时替换的是 "XA"
+        return pattern.sub(replace, text)
+
+    def _build_glossary_matcher(self):
+        """
+        将术语词汇表编译为一个大小写不敏感的正则，按前缀合并为字典树，匹配代价与术语数量无关
+        返回: (pattern, {casefold 后的术语: 术语})
+        """
+        lookup = {}
+        # 按术语长度降序排列，仅大小写不同的重复术语保留先出现的那个
+        terms = [term for term in sorted(self.term_glossary.keys(), key=len, reverse=True) if term]
+        for term in terms:
+            lookup.setdefault(term.casefold(), term)
+
+        def fold(ch):
+            # 字典树按字符合并大小写变体；小写后长度变化的字符（如 "İ"）保持原样，
+            # 保证正则中的每个字符都来自术语本身的写法
+            lower = ch.lower()
+            return lower if len(lower) == 1 else ch
+
+        trie = {}
+        for term in terms:
+            node = trie
+            for ch in term:
+                node = node.setdefault(fold(ch), {})
+            node[""] = True
+
+        def to_regex(node):
+            alternatives = [re.escape(ch) + to_regex(child) for ch, child in node.items() if ch]
+            if not alternatives:
+                return ""
+            body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+            # 贪婪的可选分支：先尝试更长的术语，失败再回退到当前结尾
+            return "(?:" + body + ")?" if "" in node else body
+
+        return re.compile(to_regex(trie), re.IGNORECASE), lookup
 
     def load_glossary(self, glossary_dict):
         """
@@ -319,6 +448,7 @@ class TextNormalizer:
         """
         if glossary_dict and isinstance(glossary_dict, dict):
             self.term_glossary.update(glossary_dict)
+            self._invalidate_glossary()
 
     def load_glossary_from_yaml(self, glossary_path):
         """
@@ -342,6 +472,7 @@ class TextNormalizer:
                 external_glossary = yaml.safe_load(f)
                 if external_glossary and isinstance(external_glossary, dict):
                     self.term_glossary = external_glossary
+                    self._invalidate_glossary()
                     return True
         return False
 
@@ -362,8 +493,7 @@ class TextNormalizer:
         例如：xuan4 -> <pinyin_a>
         """
         # 声母韵母+声调数字
-        origin_pinyin_pattern = re.compile(TextNormalizer.PINYIN_TONE_PATTERN, re.IGNORECASE)
-        original_pinyin_list = re.findall(origin_pinyin_pattern, original_text)
+        original_pinyin_list = TextNormalizer._PINYIN_TONE_RE.findall(original_text)
         if len(original_pinyin_list) == 0:
             return (original_text, None)
         original_pinyin_list = list(set("".join(p) for p in original_pinyin_list))
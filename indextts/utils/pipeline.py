@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
+
+import torch
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _record_stream(obj, stream):
+    """
+    Mark the CUDA tensors in ``obj`` as used by ``stream``, so that the caching allocator does not reuse
+    their memory on the producer stream while the consumer stream still reads them.
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _record_stream(item, stream)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            _record_stream(item, stream)
+
+
+class StagePipeline:
+    """
+    Run a sequence of items through a chain of stages, each stage on its own worker thread with bounded
+    queues in between, e.g. GPT | s2mel | vocoder over the text segments.
+
+    While item N is in the last stage, item N+1 is in the previous one and so on, so the wall-clock time of
+    a long sequence approaches ``num_items * max(stage time)`` instead of ``num_items * sum(stage times)``.
+    The outputs are yielded in the order of the inputs.
+
+    On CUDA, each stage runs on its own stream, which first waits for the work queued on the caller's stream
+    before ``run()``, and the output of a stage is synchronized before it is handed to the next stage. Autograd and autocast are thread local: the stages must enter ``torch.no_grad()``
+    and ``torch.amp.autocast()`` themselves.
+    """
+
+    def __init__(self, stages: Sequence[Callable[[Any], Any]], queue_size: int = 1, device=None,
+                 names: Optional[Sequence[str]] = None):
+        """
+        Args:
+            stages: ``stage(output of the previous stage) -> output``, the first stage receives the input items
+            queue_size: max number of the items waiting between two stages
+            device: the device of the stages, a CUDA device enables the per-stage streams
+            names: stage names of the worker threads
+        """
+        assert len(stages) > 0, "at least one stage is required"
+        self.stages = list(stages)
+        self.queue_size = max(1, queue_size)
+        self.device = torch.device(device) if device is not None else None
+        self.names = list(names) if names is not None else [f"stage{i}" for i in range(len(stages))]
+        # busy time of each stage in seconds, for the last `run()`
+        self.stage_times: List[float] = [0.0] * len(self.stages)
+
+    def _use_cuda_streams(self):
+        return self.device is not None and self.device.type == "cuda" and torch.cuda.is_available()
+
+    @staticmethod
+    def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(q: queue.Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _feed(self, items: Iterable, out_q: queue.Queue, stop: threading.Event):
+        try:
+            for item in items:
+                if not self._put(out_q, item, stop):
+                    return
+        except BaseException as e:
+            self._put(out_q, _Failure(e), stop)
+            return
+        self._put(out_q, _END, stop)
+
+    def _work(self, index: int, in_q: queue.Queue, out_q: queue.Queue, stop: threading.Event,
+              ready: Optional[torch.cuda.Event] = None):
+        stage = self.stages[index]
+        stream = None
+        if self._use_cuda_streams():
+            stream = torch.cuda.Stream(device=self.device)
+            # the work queued on the caller's stream before `run()`, e.g. the conditioning tensors
+            stream.wait_event(ready)
+        while True:
+            item = self._get(in_q, stop)
+            if item is _END or isinstance(item, _Failure):
+                # forward the end of the sequence, or the error of an upstream stage
+                self._put(out_q, item, stop)
+                return
+            start = time.perf_counter()
+            try:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        _record_stream(item, stream)
+                        output = stage(item)
+                    stream.synchronize()
+                else:
+                    output = stage(item)
+            except BaseException as e:
+                self._put(out_q, _Failure(e), stop)
+                return
+            self.stage_times[index] += time.perf_counter() - start
+            if not self._put(out_q, output, stop):
+                return
+
+    def run(self, items: Iterable) -> Iterator:
+        """
+        Yields: the output of the last stage for each item, in order.
+        The exception of any stage is raised here, and the workers are stopped when the generator is closed.
+        """
+        self.stage_times = [0.0] * len(self.stages)
+        ready = None
+        if self._use_cuda_streams():
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(self.device))
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop), name="pipeline-feed",
+                                    daemon=True)]
+        for i in range(len(self.stages)):
+            threads.append(threading.Thread(target=self._work, args=(i, queues[i], queues[i + 1], stop, ready),
+                                            name=f"pipeline-{self.names[i]}", daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                output = queues[-1].get()
+                if output is _END:
+                    break
+                if isinstance(output, _Failure):
+                    raise output.error
+                yield output
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
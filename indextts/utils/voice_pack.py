@@ -0,0 +1,94 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+PACK_FORMAT = "indextts-voicepack"
+PACK_FORMAT_VERSION = "1"
+
+# the tensors of each kind of conditioning, see `IndexTTS2._compute_spk_conditioning()`
+SPK_FIELDS = ("spk_cond_emb", "S_ref", "ref_mel", "style", "prompt_condition")
+EMO_FIELDS = ("emo_cond_emb",)
+GPT_FIELDS = ("gpt_cond_latent",)
+KIND_FIELDS = {
+    "spk": SPK_FIELDS,
+    "emo": EMO_FIELDS,
+    "gpt": GPT_FIELDS,
+}
+
+
+def write_voice_pack(pack_path: str, voices: Dict[str, Dict[str, torch.Tensor]], index: Dict[str, Dict],
+                     model_version=None):
+    """
+    Write the precomputed conditioning of the voices into one safetensors file.
+    Args:
+        voices: {voice_name: {field: tensor}}, the fields are listed in ``KIND_FIELDS``
+        index: {voice_name: {"sha256": content hash of the audio, "source": audio path}}
+    """
+    tensors = {}
+    for name, fields in voices.items():
+        for field, tensor in fields.items():
+            tensors[f"{name}/{field}"] = tensor.detach().contiguous().cpu()
+    metadata = {
+        "format": PACK_FORMAT,
+        "format_version": PACK_FORMAT_VERSION,
+        "model_version": str(model_version),
+        "index": json.dumps(index, ensure_ascii=False),
+    }
+    if os.path.dirname(pack_path) != "":
+        os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+    tmp_path = f"{pack_path}.{os.getpid()}.tmp"
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, pack_path)
+
+
+class VoicePack:
+    """
+    Read only view of a voice pack built by ``indextts/voicepack_cli.py``.
+
+    The file is memory mapped by safetensors, a tensor is only read when its voice is requested.
+    The voices are looked up by the sha256 of the audio content, the same key as ``ConditioningCache``.
+    """
+
+    def __init__(self, pack_path: str, device=None):
+        self.pack_path = pack_path
+        self.device = str(device) if device is not None else "cpu"
+        self._file = safe_open(pack_path, framework="pt", device=self.device)
+        metadata = self._file.metadata() or {}
+        if metadata.get("format") != PACK_FORMAT:
+            raise ValueError(f"{pack_path} is not a voice pack file")
+        self.model_version = metadata.get("model_version")
+        self.index: Dict[str, Dict] = json.loads(metadata.get("index", "{}"))
+        self._names_by_hash = {info["sha256"]: name for name, info in self.index.items()}
+        self._keys = set(self._file.keys())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name: str):
+        return name in self.index
+
+    @property
+    def voices(self) -> List[str]:
+        return list(self.index.keys())
+
+    def name_of(self, digest: str) -> Optional[str]:
+        return self._names_by_hash.get(digest)
+
+    def get_voice(self, name: str, kind: str) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        Returns: the tensors of ``kind`` ("spk", "emo" or "gpt") of the voice, None if not in the pack
+        """
+        keys = [f"{name}/{field}" for field in KIND_FIELDS[kind]]
+        if not all(key in self._keys for key in keys):
+            return None
+        return {field: self._file.get_tensor(key) for field, key in zip(KIND_FIELDS[kind], keys)}
+
+    def get(self, digest: str, kind: str) -> Optional[Dict[str, torch.Tensor]]:
+        name = self.name_of(digest)
+        if name is None:
+            return None
+        return self.get_voice(name, kind)
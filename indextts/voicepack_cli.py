@@ -0,0 +1,87 @@
+import os
+import sys
+import warnings
+# Suppress warnings from tensorflow and other libraries
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".m4a")
+
+
+def find_voices(voice_dir, recursive=False):
+    """
+    Returns: [(voice_name, audio_path)], the voice name is the relative path without the extension
+    """
+    voices = []
+    for root, dirs, files in os.walk(voice_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(AUDIO_EXTENSIONS):
+                audio_path = os.path.join(root, file)
+                name = os.path.splitext(os.path.relpath(audio_path, voice_dir))[0].replace(os.sep, "/")
+                voices.append((name, audio_path))
+        if not recursive:
+            break
+    return voices
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="IndexTTS2 voice pack builder: precompute the conditioning of the voices")
+    parser.add_argument("voice_dir", type=str, help="Directory of the voice prompt audio files, e.g. 'voices'")
+    parser.add_argument("-o", "--output_path", type=str, default="voices.safetensors", help="Path to the output voice pack file. Default is 'voices.safetensors'")
+    parser.add_argument("-c", "--config", type=str, default="checkpoints/config.yaml", help="Path to the config file. Default is 'checkpoints/config.yaml'")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory. Default is 'checkpoints'")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-r", "--recursive", action="store_true", default=False, help="Also search the voices in the sub directories")
+    parser.add_argument("-f", "--force", action="store_true", default=False, help="Force to overwrite the output file if it exists")
+    parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on (cpu, cuda, mps, xpu)." )
+    parser.add_argument("--verbose", action="store_true", default=False, help="Enable verbose mode")
+    args = parser.parse_args()
+    if not os.path.isdir(args.voice_dir):
+        print(f"Voice directory {args.voice_dir} does not exist.")
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.exists(args.config):
+        print(f"Config file {args.config} does not exist.")
+        parser.print_help()
+        sys.exit(1)
+    if os.path.exists(args.output_path) and not args.force:
+        print(f"ERROR: Output file {args.output_path} already exists. Use --force to overwrite.")
+        parser.print_help()
+        sys.exit(1)
+
+    voices = find_voices(args.voice_dir, args.recursive)
+    if len(voices) == 0:
+        print(f"ERROR: No audio files found in {args.voice_dir}.")
+        sys.exit(1)
+
+    from indextts.infer_v2 import IndexTTS2
+    from indextts.utils.voice_pack import write_voice_pack
+    tts = IndexTTS2(cfg_path=args.config, model_dir=args.model_dir, use_fp16=args.fp16, device=args.device)
+
+    pack = {}
+    index = {}
+    for i, (name, audio_path) in enumerate(voices):
+        print(f">> [{i + 1}/{len(voices)}] {name}: {audio_path}")
+        try:
+            spk = tts._compute_spk_conditioning(audio_path, args.verbose)
+            emo_cond_emb = tts._compute_emo_conditioning(audio_path, args.verbose)
+            gpt_cond_latent = tts._compute_gpt_conditioning(spk["spk_cond_emb"])
+        except Exception as e:
+            print(f">> skip {audio_path}: {e}")
+            continue
+        pack[name] = dict(spk, emo_cond_emb=emo_cond_emb, gpt_cond_latent=gpt_cond_latent)
+        index[name] = {
+            "sha256": tts.cond_cache.hash_audio(audio_path),
+            "source": os.path.relpath(audio_path, args.voice_dir),
+        }
+    if len(pack) == 0:
+        print("ERROR: No voice was precomputed.")
+        sys.exit(1)
+    write_voice_pack(args.output_path, pack, index, model_version=tts.model_version)
+    print(f">> voice pack saved to: {args.output_path}, {len(pack)} voices")
+
+
+if __name__ == "__main__":
+    main()
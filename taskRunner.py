@@ -11,7 +11,7 @@ Behavior:
 - Read the YAML task file
 - Read story text from `story.path`
 - Chunk text using `make_chunks` logic
-- Use `indextts.infer_v2.IndexTTS2` to synthesize each chunk with `story.voice`
+- Use `indextts.infer_v2.IndexTTS2.infer_batch` to synthesize the chunks with `story.voice`
 - Concatenate chunk WAVs into `./task/{sanitized_title}.wav`
 """
 
@@ -169,15 +169,23 @@ def run_task(taskfile_path='./task/taskfile.yaml'):
 	tmpdir = Path(tempfile.mkdtemp(prefix='indextts_task_', dir=str(task_dir)))
 	tmp_files = []
 	try:
-		for i, chunk in enumerate(chunks, start=1):
-			out_path = tmpdir / f'chunk_{i:03d}.wav'
-			print(f'Generating chunk {i}/{len(chunks)} — preview: {chunk[:60]}')
-			try:
-				tts.infer(spk_audio_prompt=story_voice, text=chunk, output_path=str(out_path), verbose=False)
-				tmp_files.append(str(out_path))
-			except Exception as e:
-				print(f'Error generating chunk {i}:', e, file=sys.stderr)
-				traceback.print_exc()
+		jobs = [
+			{'spk_audio_prompt': story_voice, 'text': chunk, 'output_path': str(tmpdir / f'chunk_{i:03d}.wav')}
+			for i, chunk in enumerate(chunks, start=1)
+		]
+		print(f'Generating {len(jobs)} chunks in batches')
+		# infer_batch saves each window of chunks before starting the next one, and returns None for a failed chunk
+		try:
+			results = tts.infer_batch(jobs, verbose=False)
+		except Exception as e:
+			print('Error generating chunks:', e, file=sys.stderr)
+			traceback.print_exc()
+			results = [None] * len(jobs)
+		for i, path in enumerate(results, start=1):
+			if path is None:
+				print(f'Error generating chunk {i}: no audio produced', file=sys.stderr)
+			else:
+				tmp_files.append(path)
 
 		if not tmp_files:
 			print('No chunk files were produced; aborting', file=sys.stderr)
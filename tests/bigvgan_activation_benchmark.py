@@ -0,0 +1,53 @@
+import time
+
+import torch
+
+from indextts.s2mel.modules.bigvgan import activations
+from indextts.s2mel.modules.bigvgan.alias_free_activation.cpu.activation1d import Activation1d as CpuActivation1d
+from indextts.s2mel.modules.bigvgan.alias_free_activation.torch.act import Activation1d as TorchActivation1d
+
+
+def benchmark(module, x, repeats):
+    with torch.inference_mode():
+        module(x)  # warmup
+        start = time.perf_counter()
+        for _ in range(repeats):
+            module(x)
+        return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == "__main__":
+    """
+    Compare the CPU Activation1d with the reference torch path of BigVGAN, for the output and the speed.
+    ```
+    python tests/bigvgan_activation_benchmark.py
+    python tests/bigvgan_activation_benchmark.py --threads 4
+    ```
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads()")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(42)
+    print(f">> torch {torch.__version__}, {torch.get_num_threads()} threads")
+    # (channels, samples): the AMP blocks of bigvgan_v2_22khz_80band_256x, 1s of audio
+    shapes = [(768, 86 * 8), (384, 86 * 32), (192, 86 * 64), (96, 86 * 128), (48, 86 * 256)]
+    for act_cls in (activations.Snake, activations.SnakeBeta):
+        for channels, samples in shapes:
+            act = act_cls(channels, alpha_logscale=True)
+            with torch.no_grad():
+                for p in act.parameters():
+                    p.uniform_(-1.0, 1.0)
+            ref = TorchActivation1d(activation=act).eval()
+            cpu = CpuActivation1d(activation=act).eval()
+            cpu.load_state_dict(ref.state_dict())
+            x = torch.randn(1, channels, samples)
+            with torch.inference_mode():
+                diff = (ref(x) - cpu(x)).abs().max().item()
+            ref_ms = benchmark(ref, x, args.repeats)
+            cpu_ms = benchmark(cpu, x, args.repeats)
+            print(f"{act_cls.__name__:>9} C={channels:<4} T={samples:<6} max abs diff: {diff:.2e}  "
+                  f"torch: {ref_ms:7.2f}ms  cpu: {cpu_ms:7.2f}ms  speedup: {ref_ms / cpu_ms:.2f}x")
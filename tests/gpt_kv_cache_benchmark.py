@@ -0,0 +1,85 @@
+import time
+
+import torch
+import torchaudio
+from transformers.generation.streamers import BaseStreamer
+
+from indextts.infer import IndexTTS
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+
+class StepTimer(BaseStreamer):
+    """
+    Timestamp of every generated token.
+    """
+
+    def __init__(self):
+        self.times = []
+
+    def put(self, value):
+        self.times.append(time.perf_counter())
+
+    def end(self):
+        pass
+
+
+def per_token_latency(tts, auto_conditioning, text_tokens, num_tokens, kv_cache):
+    tts.gpt.inference_model.kv_cache = kv_cache
+    timer = StepTimer()
+    with torch.no_grad():
+        tts.gpt.inference_speech(
+            auto_conditioning, text_tokens,
+            cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=tts.device),
+            do_sample=False,
+            num_beams=1,
+            num_return_sequences=1,
+            max_generate_length=num_tokens,
+            # keep decoding to the full length
+            min_new_tokens=num_tokens,
+            streamer=timer,
+        )
+    # the first call is the prompt, then one call per step
+    return [b - a for a, b in zip(timer.times[1:], timer.times[2:])]
+
+
+if __name__ == "__main__":
+    """
+    Per-token latency of the IndexTTS GPT decoding on CPU with and without the KV cache.
+    With the KV cache the decode step cost stays flat as the sequence grows, without it every step
+    re-runs the whole prefix.
+    ```
+    python tests/gpt_kv_cache_benchmark.py checkpoints
+    python tests/gpt_kv_cache_benchmark.py checkpoints 600
+    ```
+    """
+    import sys
+    sys.path.append("..")
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    num_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    window = 50
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, use_fp16=False, device="cpu",
+                   use_cuda_kernel=False)
+    print(f">> torch {torch.__version__}, {torch.get_num_threads()} threads")
+    text = "晕 XUAN4 是 一 种 not very good GAN3 觉"
+    text_tokens = torch.tensor(tts.tokenizer.encode(text), dtype=torch.int32, device=tts.device).unsqueeze(0)
+    audio, sr = torchaudio.load("tests/sample_prompt.wav")
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+    auto_conditioning = MelSpectrogramFeatures()(audio).to(tts.device)
+
+    results = {}
+    for kv_cache in (True, False):
+        per_token_latency(tts, auto_conditioning, text_tokens, 8, kv_cache)  # warmup
+        results[kv_cache] = per_token_latency(tts, auto_conditioning, text_tokens, num_tokens, kv_cache)
+    tts.gpt.inference_model.kv_cache = True
+
+    print(f"{'tokens':>12} {'kv_cache ms/token':>18} {'no cache ms/token':>18}")
+    for start in range(0, num_tokens - 1, window):
+        row = []
+        for kv_cache in (True, False):
+            steps = results[kv_cache][start:start + window]
+            row.append(sum(steps) / len(steps) * 1000 if steps else float("nan"))
+        print(f"{start:>5}-{start + window:<6} {row[0]:>18.2f} {row[1]:>18.2f}")
+    for kv_cache in (True, False):
+        steps = results[kv_cache]
+        print(f">> kv_cache={kv_cache}: {len(steps) + 1} tokens in {sum(steps):.2f} seconds")
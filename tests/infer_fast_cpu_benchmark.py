@@ -0,0 +1,51 @@
+import time
+
+import torch
+
+from indextts.infer import IndexTTS
+
+
+def run(tts, prompt, text, segments_bucket_max_size):
+    tts.infer_fast(prompt, text, None, segments_bucket_max_size=segments_bucket_max_size)  # warmup
+    start = time.perf_counter()
+    sr, wav = tts.infer_fast(prompt, text, None, segments_bucket_max_size=segments_bucket_max_size)
+    elapsed = time.perf_counter() - start
+    return elapsed, wav.shape[0] / sr
+
+
+if __name__ == "__main__":
+    """
+    Throughput of `IndexTTS.infer_fast` on CPU on a multi-sentence text, one segment per batch
+    against the thread-aware balanced bucketing.
+    ```
+    python tests/infer_fast_cpu_benchmark.py checkpoints
+    python tests/infer_fast_cpu_benchmark.py checkpoints --threads 8
+    ```
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", nargs="?", default="checkpoints")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads()")
+    parser.add_argument("--prompt", type=str, default="tests/sample_prompt.wav")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tts = IndexTTS(cfg_path=f"{args.model_dir}/config.yaml", model_dir=args.model_dir, use_fp16=False,
+                   device="cpu", use_cuda_kernel=False)
+    print(f">> torch {torch.__version__}, {torch.get_num_threads()} threads")
+    text = "大家好，我现在正在bilibili 体验 ai 科技。说实话，来之前我绝对想不到！AI技术已经发展到这样匪夷所思的地步了！" \
+           "比如说，现在正在说话的其实是B站为我现场复刻的数字分身，简直就是平行宇宙的另一个我了。" \
+           "如果大家也想体验更多深入的AIGC功能，可以访问 bilibili studio，相信我，你们也会吃惊的。" \
+           "There is a vehicle arriving in dock number 7. Please be patient, it may take a while."
+    print(">> bucket sizes:", [len(b) for b in tts.bucket_segments_balanced(
+        tts.tokenizer.split_segments(tts.tokenizer.tokenize(text), max_text_tokens_per_segment=100),
+        *tts.cpu_bucket_params())])
+
+    results = {}
+    for bucket_max_size in (1, 4):
+        torch.manual_seed(42)
+        results[bucket_max_size] = run(tts, args.prompt, text, bucket_max_size)
+    for bucket_max_size, (elapsed, wav_length) in results.items():
+        print(f">> segments_bucket_max_size={bucket_max_size}: {elapsed:.2f} seconds for {wav_length:.2f} seconds "
+              f"of audio, RTF: {elapsed / wav_length:.4f}")
+    print(f">> speedup: {results[1][0] / results[4][0]:.2f}x")
@@ -0,0 +1,29 @@
+from indextts.utils.front import TextNormalizer
+
+if __name__ == "__main__":
+    # 按句缓存的 normalize 结果应与不缓存（整段 normalize）一致
+    cached = TextNormalizer(cache_size=1024)
+    uncached = TextNormalizer(cache_size=0)
+    cached.load()
+    uncached.zh_normalizer = cached.zh_normalizer
+    uncached.en_normalizer = cached.en_normalizer
+    cases = [
+        '大家好，我现在正在bilibili 体验 ai 科技，说实话，来之前我绝对想不到！AI技术已经发展到这样匪夷所思的地步了！',
+        "叶远随口答应一声，一定帮忙云云。教授看叶远的样子也知道，这事情多半是黄了。感谢您的收听，下期再见！",
+        "2010年7月16日在美国上映；2010年9月1日在中国内地上映。“我爱你！”的英语是“I love you!”",
+        "There is a vehicle arriving in dock number 7. Please be patient, it may take a while.",
+        "Dr. Smith met the U.S. Army at 3.5 p.m. on Jan. 5. It was cold! Was it? Yes, No. 5 was e.g. late.",
+        "The weather is really nice today, perfect for studying at home.\nThank you! 再见。",
+    ]
+    failed = 0
+    # 第二轮全部命中缓存
+    for _ in range(2):
+        for text in cases:
+            expected = uncached.normalize(text)
+            result = cached.normalize(text)
+            if result != expected:
+                failed += 1
+                print(f">> mismatch: {text}")
+                print(f"   cache_size=0: {expected}")
+                print(f"   cached:       {result}")
+    print(f">> {len(cases) * 2 - failed}/{len(cases) * 2} passed, {len(cached._cache)} sentences cached")
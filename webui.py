@@ -29,6 +29,8 @@ parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16
 parser.add_argument("--deepspeed", action="store_true", default=False, help="Use DeepSpeed to accelerate if available")
 parser.add_argument("--cuda_kernel", action="store_true", default=False, help="Use CUDA kernel for inference if available")
 parser.add_argument("--gui_seg_tokens", type=int, default=120, help="GUI: Max tokens per generation segment")
+parser.add_argument("--cond_cache_dir", type=str, default=None, help="Directory of the persistent voice conditioning cache")
+parser.add_argument("--voice_pack", type=str, default=None, help="Voice pack file built by `indextts-voicepack`")
 cmd_args = parser.parse_args()
 
 if not os.path.exists(cmd_args.model_dir):
@@ -58,7 +60,10 @@ tts = IndexTTS2(model_dir=cmd_args.model_dir,
                 use_fp16=cmd_args.fp16,
                 use_deepspeed=cmd_args.deepspeed,
                 use_cuda_kernel=cmd_args.cuda_kernel,
+                cond_cache_dir=cmd_args.cond_cache_dir,
                 )
+if cmd_args.voice_pack:
+    tts.load_voice_pack(cmd_args.voice_pack)
 # 支持的语言列表
 LANGUAGES = {
     "中文": "zh_CN",
@@ -419,7 +424,7 @@ with gr.Blocks(title="IndexTTS Demo") as demo:
             reading = reading_zh or reading_en
 
         # 添加到词汇表
-        tts.normalizer.term_glossary[term] = reading
+        tts.normalizer.load_glossary({term: reading})
 
         # 自动保存到文件
         try: